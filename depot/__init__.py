@@ -1,16 +1,25 @@
-"""Usage: depot [options] <package> [<package> ...]
+"""Usage: depot [options] serve
+       depot [options] <package> [<package> ...]
 
 -h --help                    show this help message and exit
 --version                    show program's version number and exit
 -s URI --storage=URI         URI for storage provider, checks $DEPOT_STORAGE or local://
--c NAME --codename=NAME      Debian distribution codename [default: lucid]
---component=NAME             Debian component name [default: main]
+-c NAME --codename=NAME      Debian distribution codename, or several separated by commas [default: lucid]
+--component=NAME             Debian component name, or several separated by commas [default: main]
 -a ARCH --architecture=ARCH  package architecture if not specified in package
 -k KEYID --gpg-key=KEYID     GPG key ID to use for signing
 --no-sign                    do not sign this upload
 --no-public                  do not make cloud files public-readable
 --force                      force upload, even if overwriting
 --pool-path=PATH             override pool path for the package
+--from=NAME                  codename, or codename/component, to copy name@version packages from
+-j N --jobs=N                number of packages to upload in parallel, 1 by default or 8 when serving
+--cache-dir=DIR              directory for local caches, checks $XDG_CACHE_HOME or ~/.cache/depot
+--cache-size=MB              maximum size of the local metadata cache [default: 512]
+--no-cache                   do not use or update local caches
+--timings                    show how long each metadata upload took
+--listen=ADDR                host:port or Unix socket path to serve on [default: 127.0.0.1:8373]
+--window=SECONDS             time to collect packages for one metadata commit when serving [default: 5]
 
 Example:
 depot -s s3://apt.example.com -c precise -k 6791B14F mypackage.deb
@@ -18,39 +27,98 @@ depot -s s3://apt.example.com -c precise -k 6791B14F mypackage.deb
 """
 
 from __future__ import print_function
+import atexit
+import logging
 import os
 import sys
 
 import docopt
 
-from .apt import AptRepository
-from .gpg import GPG
-from .storage import StorageWrapper
 from .version import __version_info__, __version__  # noqa
 
 
+def split_list(value):
+    """Parse a comma separated option value."""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
 def main():
     args = docopt.docopt(__doc__, version='depot '+__version__)
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    # Imported late so --help and --version don't pay for libcloud, gnupg and friends
+    import six
+    from .apt import AptRepository, AptRepositoryGroup
+    from .cache import default_cache_dir, HashCache, MetadataCache
+    from .storage import StorageWrapper
     if args.get('--pool-path') and len(args['<package>']) > 1:
         print('--pool-path can only be specified for a single package', file=sys.stderr)
         sys.exit(1)
+    try:
+        # Left unset when serving so the server picks its own pool size
+        jobs = int(args['--jobs']) if args['--jobs'] else None
+    except ValueError:
+        jobs = 0
+    if jobs is not None and jobs < 1:
+        print('--jobs must be a positive integer', file=sys.stderr)
+        sys.exit(1)
     if not args['--storage']:
         args['--storage'] = os.environ.get('DEPOT_STORAGE', 'local://')
+    if args['--no-cache']:
+        cache_dir = hash_cache = metadata_cache = None
+    else:
+        cache_dir = args['--cache-dir'] or default_cache_dir()
+        hash_cache = HashCache(os.path.join(cache_dir, 'hashes.json'))
+        # Saved even if the run fails part way, uploads that did finish are still useful
+        atexit.register(hash_cache.save)
+        metadata_cache = MetadataCache(os.path.join(cache_dir, 'metadata'), int(args['--cache-size'])*1024*1024)
     if args['--no-sign']:
         gpg = None
     else:
-        gpg = GPG(args['--gpg-key'])
-    storage = StorageWrapper(args['--storage'], args['--no-public'])
-    repo = AptRepository(storage, gpg, args['--codename'], args['--component'], args['--architecture'])
+        from .gpg import GPG
+        gpg = GPG(args['--gpg-key'], cache_path=cache_dir and os.path.join(cache_dir, 'gpg.json'))
+    storage = StorageWrapper(args['--storage'], args['--no-public'], hash_cache=hash_cache, metadata_cache=metadata_cache)
+    atexit.register(storage.close)
+    targets = [(codename, component) for codename in split_list(args['--codename']) for component in split_list(args['--component'])]
+    if not targets:
+        print('At least one codename and component required', file=sys.stderr)
+        sys.exit(1)
+    packages = args['<package>']
+    if packages and all(pkg_path.endswith('.rpm') for pkg_path in packages):
+        from .yum import YumRepository
+        repo = YumRepository(storage, gpg)
+    elif len(targets) == 1:
+        repo = AptRepository(storage, gpg, targets[0][0], targets[0][1], args['--architecture'])
+    else:
+        repo = AptRepositoryGroup(storage, gpg, targets, args['--architecture'])
+    if args['serve']:
+        try:
+            window = float(args['--window'])
+        except ValueError:
+            window = -1
+        if window < 0:
+            print('--window must be a number of seconds', file=sys.stderr)
+            sys.exit(1)
+        from .server import serve
+        print('Listening on {0}'.format(args['--listen']))
+        serve(repo, args['--listen'], window, jobs)
+        return
+    source_codename, _, source_component = (args['--from'] or '').partition('/')
+    uploads = []
     for pkg_path in args['<package>']:
         if '@' in pkg_path:
             print('Copying package {0}'.format(pkg_path))
-            repo.copy_package(pkg_path)
+            repo.copy_package(pkg_path, source_codename, source_component, args['--pool-path'])
+        else:
+            uploads.append(pkg_path)
+
+    results = repo.add_packages(uploads, args['--force'], args['--pool-path'], jobs or 1, open_fn=StorageWrapper.stream)
+    for pkg_path, uploaded in six.moves.zip(uploads, results):
+        if uploaded:
+            print('Uploaded package {0}'.format(pkg_path))
         else:
-            print('Uploading package {0}'.format(pkg_path))
-            fileobj = StorageWrapper.file(pkg_path)
-            if not repo.add_package(pkg_path, fileobj, args['--force'], args['--pool-path']):
-                print('{0} already uploaded, skipping (use --force to override)'.format(pkg_path))
-            fileobj.close()
+            print('{0} already uploaded, skipping (use --force to override)'.format(pkg_path))
     print('Uploading metadata')
-    repo.commit_metadata()
+    timings = repo.commit_metadata()
+    if args['--timings']:
+        for path, elapsed in sorted(six.iteritems(timings), key=lambda item: item[1], reverse=True):
+            print('{0:8.3f}s {1}'.format(elapsed, path))
@@ -1,20 +1,27 @@
 # coding=utf8
-import bz2
 import collections
+import functools
+import hashlib
+import itertools
 import os
+import random
 import re
 import tarfile
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 try:
     import lzma
 except ImportError:
     lzma = None
 
-import arpy
 import six
 
-from .utils import gzip_compress
+from .publish import Publisher
+from .repository import Repository, SupersededIndex
+from .storage import ConflictError
+from .utils import decompress, decompressor, encode_streams, gzip_compress, iter_lines, ReplayFile
 from .version import __version__
 
 
@@ -39,35 +46,466 @@ class AptMeta(collections.OrderedDict):
         return '\n'.join('{0}:{1}{2}'.format(key, '' if value[0] == '\n' else ' ', value) for key, value in six.iteritems(self) if value)
 
 
+class ArMember(object):
+    """A member of an ar archive being read sequentially, see iter_ar_members()."""
+
+    def __init__(self, name, size, fileobj):
+        self.name = name
+        self.size = size
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size) if size else b''
+        if len(data) != size:
+            raise ValueError('Truncated ar member {0}'.format(self.name))
+        self.remaining -= size
+        return data
+
+    def skip(self):
+        while self.remaining:
+            self.read(1024*1024)
+        if self.size % 2:
+            # Members are padded to an even size
+            self.fileobj.read(1)
+
+
+def iter_ar_members(fileobj):
+    """
+    Read an ar archive (i.e. a .deb) front to back without seeking. Each
+    member must be read, or not, before moving on to the next one.
+    """
+    if fileobj.read(8) != b'!<arch>\n':
+        raise ValueError('Not an ar archive')
+    while True:
+        header = fileobj.read(60)
+        if not header:
+            return
+        if len(header) != 60 or header[58:60] != b'`\n':
+            raise ValueError('Invalid ar header {0}'.format(repr(header)))
+        member = ArMember(header[:16].decode('ascii').rstrip(' ').rstrip('/'), int(header[48:58]), fileobj)
+        yield member
+        member.skip()
+
+
+class AptFileList(object):
+    """
+    Collect the files in a .deb's data member as the package streams past,
+    for Contents indexes. Data is pushed in with feed(), in chunks of any
+    size, so this can sit alongside an upload without reading the package a
+    second time. Only tar headers are looked at, the file data is skipped.
+    """
+    DATA_PREFIX = 'data.tar'
+    # Tar entries which are files as far as Contents is concerned
+    FILE_TYPES = (b'0', b'\0', b'1', b'2', b'7')
+
+    def __init__(self):
+        self.files = []
+        self.error = None
+        self._buf = b''
+        self._started = False
+        self._remaining = 0  # Bytes left in the current ar member
+        self._padding = 0
+        self._decompressor = None  # Set while in the data member
+        self._tar_buf = b''
+        self._tar_skip = 0
+        self._tar_collect = None  # (type, size) of a long name or pax header being read
+        self._tar_name = None  # Name for the next entry, from a long name or pax header
+        self._tar_done = False
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+        try:
+            self._feed_ar(data)
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        """Return the sorted file list, or None if it couldn't be read."""
+        if self.error is not None or not self._started or self._remaining or self._buf or (self._tar_buf and not self._tar_done):
+            return None
+        return sorted(set(self.files))
+
+    def _feed_ar(self, data):
+        self._buf += data
+        while self._buf:
+            if not self._started:
+                if len(self._buf) < 8:
+                    return
+                if self._buf[:8] != b'!<arch>\n':
+                    raise ValueError('Not an ar archive')
+                self._buf = self._buf[8:]
+                self._started = True
+            elif self._remaining:
+                data, self._buf = self._buf[:self._remaining], self._buf[self._remaining:]
+                self._remaining -= len(data)
+                if self._decompressor is not None and not self._tar_done:
+                    self._feed_tar(self._decompressor.decompress(data))
+                    if not self._remaining:
+                        self._decompressor = None
+            elif self._padding:
+                self._buf = self._buf[1:]
+                self._padding = 0
+            else:
+                if len(self._buf) < 60:
+                    return
+                header, self._buf = self._buf[:60], self._buf[60:]
+                if header[58:60] != b'`\n':
+                    raise ValueError('Invalid ar header {0}'.format(repr(header)))
+                name = header[:16].decode('ascii').rstrip(' ').rstrip('/')
+                self._remaining = int(header[48:58])
+                self._padding = self._remaining % 2
+                if name.startswith(self.DATA_PREFIX):
+                    self._decompressor = decompressor(name[len(self.DATA_PREFIX):])
+
+    def _feed_tar(self, data):
+        # Walk the buffer by offset and only cut it once at the end, slicing
+        # off every header as it went would copy the rest of a big chunk each time
+        buf = self._tar_buf + data if self._tar_buf else data
+        pos = 0
+        while pos < len(buf) and not self._tar_done:
+            if self._tar_skip:
+                skipped = min(self._tar_skip, len(buf) - pos)
+                pos += skipped
+                self._tar_skip -= skipped
+            elif self._tar_collect:
+                type, size = self._tar_collect
+                if len(buf) - pos < size:
+                    break
+                value = buf[pos:pos+size]
+                pos += size
+                self._tar_collect = None
+                self._tar_skip = -size % 512
+                if type == b'L':
+                    self._tar_name = value.rstrip(b'\0')
+                else:
+                    self._tar_name = self._pax_path(value) or self._tar_name
+            else:
+                if len(buf) - pos < 512:
+                    break
+                header = buf[pos:pos+512]
+                pos += 512
+                if header == b'\0' * 512:
+                    self._tar_done = True
+                    break
+                type = header[156:157]
+                size = tarfile.nti(header[124:136])
+                if type in (b'L', b'x'):
+                    self._tar_collect = (type, size)
+                    continue
+                name = header[:100].split(b'\0', 1)[0]
+                if header[257:262] == b'ustar' and header[345:346] != b'\0':
+                    name = header[345:500].split(b'\0', 1)[0] + b'/' + name
+                name, self._tar_name = self._tar_name or name, None
+                if type in self.FILE_TYPES:
+                    self._add(name)
+                self._tar_skip = size + (-size % 512)
+        self._tar_buf = buf[pos:]
+
+    @staticmethod
+    def _pax_path(data):
+        while data:
+            length, _, rest = data.partition(b' ')
+            record, data = rest[:int(length) - len(length) - 1], rest[int(length) - len(length) - 1:]
+            key, _, value = record.rstrip(b'\n').partition(b'=')
+            if key == b'path':
+                return value
+
+    def _add(self, name):
+        if not isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        if name.startswith('./'):
+            name = name[2:]
+        name = name.lstrip('/')
+        if name:
+            self.files.append(name)
+
+
 class AptPackage(AptMeta):
+    CONTROL_PREFIX = 'control.tar'
+
     def __init__(self, filename, fileobj=None, data=None, pool_path=None):
         self.name = filename
         self._pool_path = pool_path # Used for manual pool path overrides
+        self.files = None  # Filled in by tee_file_list()
         if not data:
-            if fileobj:
-                self.ar = arpy.Archive(filename or getattr(fileobj, 'name', None), fileobj)
-            else:
-                self.ar = arpy.Archive(filename)
-            self.ar.read_all_headers()
-            self.control_tar = tarfile.open('control.tar.gz', 'r:gz', fileobj=self.ar.archived_files['control.tar.gz'])
-            data = self.control_tar.extractfile('./control')
+            data = self.read_control(fileobj or open(filename, 'rb'))
         super(AptPackage, self).__init__(data)
 
+    @classmethod
+    def read_control(cls, fileobj):
+        """
+        Extract the control file from a .deb. This only reads up to the end
+        of the control member, leaving the (potentially huge) data member
+        unread, and never seeks so fileobj can be a stream.
+        """
+        for member in iter_ar_members(fileobj):
+            if member.name.startswith(cls.CONTROL_PREFIX):
+                ext = member.name[len(cls.CONTROL_PREFIX):]
+                control_tar = tarfile.open(fileobj=six.BytesIO(decompress(member.read(), ext)), mode='r:')
+                for name in ('./control', 'control'):
+                    try:
+                        control = control_tar.extractfile(name).read()
+                    except KeyError:
+                        continue
+                    return control if isinstance(control, str) else control.decode('utf-8')
+                raise ValueError('No control file found in {0}'.format(member.name))
+        raise ValueError('No control member found in package')
+
     @property
     def pool_path(self):
-        return self._pool_path or self['Filename'] or 'pool/{}'.format(self.name)
+        return self._pool_path or self.get('Filename') or 'pool/{}'.format(self.name)
+
+    @property
+    def contents_name(self):
+        """How the package is listed in Contents indexes."""
+        return '{0}/{1}'.format(self.get('Section') or 'misc', self['Package'])
+
+    def copy(self):
+        """A copy that can be changed without touching this one."""
+        pkg = AptPackage(self.name, data=str(self), pool_path=self._pool_path)
+        pkg.files = None if self.files is None else list(self.files)
+        return pkg
+
+    def tee_file_list(self, chunks):
+        """
+        Pass through the chunks of the .deb, reading the list of files it
+        installs in to self.files along the way. files is left as None if
+        the list can't be read.
+        """
+        file_list = AptFileList()
+        for chunk in chunks:
+            file_list.feed(chunk)
+            yield chunk
+        self.files = file_list.close()
+
+
+class AptStanza(object):
+    """
+    A stanza from a Packages file, kept as its raw text. Only the Package
+    and Version fields are pulled out up front, the full field parse only
+    happens once the stanza is modified. Unmodified stanzas are written
+    back out verbatim.
+    """
+    __slots__ = ('raw', 'key', 'meta')
+    FIELD_RE = re.compile(r'^(Package|Version):[ \t]*(.*?)[ \t]*$', re.M)
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.meta = None
+        fields = dict(self.FIELD_RE.findall(raw))
+        try:
+            self.key = (fields['Package'], fields['Version'])
+        except KeyError:
+            raise ValueError('Stanza has no Package and Version: {0}'.format(repr(raw[:100])))
+
+    def __getitem__(self, key):
+        return (self.meta or AptMeta(self.raw))[key]
+
+    def get(self, key, default=None):
+        return (self.meta or AptMeta(self.raw)).get(key, default)
+
+    def __contains__(self, key):
+        return key in (self.meta or AptMeta(self.raw))
+
+    def __setitem__(self, key, value):
+        if self.meta is None:
+            self.meta = AptMeta(self.raw)
+        self.meta[key] = value
+
+    def __str__(self):
+        return self.raw if self.meta is None else str(self.meta)
+
+
+class StaleIndexError(ValueError):
+    """The sidecar index doesn't match the Packages file it describes."""
+
+
+class AptPackagesIndex(object):
+    """
+    Sidecar index stored next to a Packages file. It records the byte range
+    of every stanza along with its (Package, Version) key, in file order, so
+    a commit can splice in new stanzas without parsing the untouched ones.
+    """
+
+    def __init__(self, data=None):
+        self.sha256 = None
+        self.size = None
+        self.entries = []  # [(key, offset, length),+]
+        if data:
+            lines = data.splitlines()
+            label, self.sha256, size = lines[0].split(' ')
+            if label != 'SHA256:':
+                raise ValueError('Can not parse index header: {0}'.format(repr(lines[0])))
+            self.size = int(size)
+            for line in lines[1:]:
+                offset, length, package, version = line.split(' ')
+                self.entries.append(((package, version), int(offset), int(length)))
+
+    def append(self, key, offset, length):
+        self.entries.append((key, offset, length))
+
+    def __str__(self):
+        lines = ['SHA256: {0} {1}'.format(self.sha256, self.size)]
+        lines.extend('{0} {1} {2} {3}'.format(offset, length, key[0], key[1]) for key, offset, length in self.entries)
+        return '\n'.join(lines) + '\n'
+
+
+def merge_stanzas(old, new, diff=None):
+    """
+    Merge sorted new (key, pkg) pairs in to the sorted old (key, raw)
+    stanzas of a Packages file, yielding (key, raw) in order. An added
+    package replaces an old stanza with the same key. Every step is reported
+    to diff, if given.
+    """
+    i = 0
+    last_key = None
+    for key, raw in old:
+        if diff is not None and last_key is not None and key <= last_key:
+            # Only a sorted file can be diffed by merging
+            diff.valid = False
+        last_key = key
+        while i < len(new) and new[i][0] < key:
+            new_raw = str(new[i][1])
+            if diff is not None:
+                diff.insert(new_raw)
+            yield new[i][0], new_raw
+            i += 1
+        if i < len(new) and new[i][0] == key:
+            # Replaced by an added package
+            new_raw = str(new[i][1])
+            if diff is not None:
+                diff.replace(raw, new_raw)
+            yield key, new_raw
+            i += 1
+        else:
+            if diff is not None:
+                diff.keep(raw)
+            yield key, raw
+    for key, pkg in new[i:]:
+        new_raw = str(pkg)
+        if diff is not None:
+            diff.insert(new_raw)
+        yield key, new_raw
+
+
+class AptPackagesDiff(object):
+    """
+    An ed script, as used by pdiffs, turning an old Packages file in to a new
+    one. It is built up stanza by stanza by merge_stanzas(), so only the
+    changed stanzas are held on to. Relies on every stanza being followed
+    by a blank line.
+    """
+
+    def __init__(self):
+        self.valid = True
+        self.line = 0  # Lines of the old file passed so far
+        self.hunks = []  # [(command, text),+] in file order
+
+    def keep(self, raw):
+        self.line += raw.count('\n') + 2
+
+    def insert(self, raw):
+        command = '{0}a'.format(self.line)
+        text = raw + '\n\n'
+        if self.hunks and self.hunks[-1][0] == command:
+            # Consecutive new stanzas go in one command
+            text = self.hunks.pop()[1] + text
+        self.hunks.append((command, text))
+
+    def replace(self, old_raw, raw):
+        lines = old_raw.count('\n') + 1
+        if old_raw != raw:
+            self.hunks.append(('{0},{1}c'.format(self.line + 1, self.line + lines), raw + '\n'))
+        self.line += lines + 1
+
+    def __len__(self):
+        return len(self.hunks)
+
+    def __str__(self):
+        # Last change first so the line numbers of earlier ones stay valid
+        return ''.join('{0}\n{1}.\n'.format(command, text) for command, text in reversed(self.hunks))
+
+
+class AptPackagesDiffIndex(AptMeta):
+    """
+    Packages.diff/Index, which lists the patches apt can use to bring an old
+    copy of the Packages file up to date instead of downloading all of it.
+    Each patch goes from the state listed in the history to the next one.
+    """
+    HASHES = [('SHA1', 'sha1'), ('SHA256', 'sha256')]
+
+    def __init__(self, data=''):
+        super(AptPackagesDiffIndex, self).__init__(data)
+        self.current = {}  # hash_type: (hash, size)
+        # name: {'history': {hash_type: (hash, size)}, 'patch': ..., 'download': ...}
+        self.patches = collections.OrderedDict()
+        for label, hash_type in self.HASHES:
+            if '{0}-Current'.format(label) in self:
+                hash, size = self['{0}-Current'.format(label)].split()
+                self.current[hash_type] = (hash, size)
+            for field, kind in (('History', 'history'), ('Patches', 'patch'), ('Download', 'download')):
+                for line in self.get('{0}-{1}'.format(label, field), '').splitlines():
+                    if not line.strip():
+                        continue
+                    hash, size, name = line.split()
+                    if kind == 'download':
+                        name = name[:-len('.gz')]
+                    entry = self.patches.setdefault(name, {'history': {}, 'patch': {}, 'download': {}})
+                    entry[kind][hash_type] = (hash, size)
+
+    @staticmethod
+    def hash_data(data):
+        return dict((hash_type, (getattr(hashlib, hash_type)(data).hexdigest(), str(len(data)))) for label, hash_type in AptPackagesDiffIndex.HASHES)
+
+    def add(self, name, old_hashes, patch, patch_gz):
+        """Record a patch from a file with old_hashes to the current one."""
+        self.patches[name] = {
+            'history': old_hashes,
+            'patch': self.hash_data(patch),
+            'download': self.hash_data(patch_gz),
+        }
+
+    def prune(self, keep):
+        """Drop all but the newest keep patches, returning the names dropped."""
+        names = list(self.patches)[:max(len(self.patches) - keep, 0)]
+        for name in names:
+            del self.patches[name]
+        return names
+
+    def __str__(self):
+        for label, hash_type in self.HASHES:
+            if hash_type in self.current:
+                self['{0}-Current'.format(label)] = '{0} {1}'.format(*self.current[hash_type])
+            for field, kind, suffix in (('History', 'history', ''), ('Patches', 'patch', ''), ('Download', 'download', '.gz')):
+                lines = [' {0} {1} {2}{3}'.format(entry[kind][hash_type][0], entry[kind][hash_type][1], name, suffix)
+                         for name, entry in six.iteritems(self.patches) if hash_type in entry[kind]]
+                self['{0}-{1}'.format(label, field)] = '\n' + '\n'.join(lines) if lines else ''
+        return super(AptPackagesDiffIndex, self).__str__() + '\n'
 
 
 class AptPackages(object):
     def __init__(self, storage, data):
         self.storage = storage
         self.packages = {}
+        self.added = {}
+        self.index = None  # Rebuilt on each pass through iter_chunks()
+        # Set to an AptPackagesDiff to have iter_chunks() fill it in, left
+        # as None afterwards if no diff could be made
+        self.diff = None
+        self.old_hashes = None  # Of the old file when diff is made, as in AptPackagesDiffIndex
         self._data = data  # For testing/debugging
+        self._old = []  # [(key, raw),+] in file order
         for buf in data.split('\n\n'):
+            buf = buf.strip('\n')
             if not buf.strip():
                 continue
-            pkg = AptPackage(None, data=buf)
-            self.packages[(pkg['Package'], pkg['Version'])] = pkg
+            pkg = AptStanza(buf)
+            self.packages[pkg.key] = pkg
+            self._old.append((pkg.key, buf))
 
     def add(self, pkg):
         hashes = self.storage.hashes(pkg.pool_path)
@@ -77,9 +515,126 @@ class AptPackages(object):
         pkg['SHA1'] = hashes['sha1'].hexdigest()
         pkg['SHA256'] = hashes['sha256'].hexdigest()
         self.packages[(pkg['Package'], pkg['Version'])] = pkg
+        self.added[(pkg['Package'], pkg['Version'])] = pkg
+
+    def _diffable(self):
+        """True if the old file is sorted and laid out the way depot writes it, so line numbers can be worked out per stanza."""
+        if not self._old:
+            return False
+        keys = [key for key, raw in self._old]
+        return (all(a < b for a, b in six.moves.zip(keys, keys[1:])) and
+                sum(len(raw) + 2 for key, raw in self._old) == len(self._data))
+
+    def iter_stanzas(self):
+        """Yield (key, raw stanza) in sorted order."""
+        if self.diff is not None:
+            if self._diffable():
+                self.old_hashes = AptPackagesDiffIndex.hash_data(self._data)
+                return merge_stanzas(self._old, sorted(six.iteritems(self.added)), self.diff)
+            self.diff = None
+        return ((key, str(pkg)) for key, pkg in sorted(six.iteritems(self.packages), key=lambda k: k[0]))
+
+    def iter_chunks(self):
+        """Yield the serialized index a stanza at a time, recording offsets in self.index."""
+        self.index = AptPackagesIndex()
+        offset = 0
+        for key, raw in self.iter_stanzas():
+            self.index.append(key, offset, len(raw))
+            offset += len(raw) + 2
+            # Every stanza ends with a blank line, as in Debian's own archives
+            yield raw
+            yield '\n\n'
+        self.index.size = offset
 
     def __str__(self, extra_fn=None):
-        return '\n\n'.join(str(pkg) for key, pkg in sorted(six.iteritems(self.packages), key=lambda k: k[0]))
+        return ''.join(self.iter_chunks())
+
+
+class AptSplicedPackages(AptPackages):
+    """
+    Update an existing Packages file using its sidecar index. The old file is
+    streamed through, untouched stanzas are copied byte for byte and only the
+    added packages are serialized. Raises StaleIndexError from iter_chunks()
+    if the file doesn't match the index, in which case the caller should fall
+    back to a full AptPackages parse.
+    """
+
+    def __init__(self, storage, path, chunks, index):
+        super(AptSplicedPackages, self).__init__(storage, '')
+        self.path = path
+        self.chunks = chunks
+        self.old_index = index
+
+    def _iter_old_stanzas(self):
+        it = iter(self.chunks)
+        buf = b''
+        pos = 0  # File offset of buf[0]
+        layout = True  # Separated by blank lines, see AptPackages._diffable()
+        for i, (key, offset, length) in enumerate(self.old_index.entries):
+            while pos + len(buf) < offset + length:
+                chunk = next(it, None)
+                if chunk is None:
+                    raise StaleIndexError('{0} is shorter than its index'.format(self.path))
+                buf += chunk
+            start = offset - pos
+            if start != (2 if i else 0) or buf[:start] != b'\n\n'[:start]:
+                layout = False
+            yield key, buf[start:start+length]
+            buf = buf[start+length:]
+            pos = offset + length
+        # Read the rest so the download hashes cover the whole file
+        tail = buf
+        size = pos + len(buf)
+        for chunk in it:
+            if len(tail) < 2:
+                tail += chunk[:2]
+            size += len(chunk)
+        if size != self.old_index.size or self.storage.hashes(self.path)['sha256'].hexdigest() != self.old_index.sha256:
+            raise StaleIndexError('{0} does not match its index'.format(self.path))
+        if self.diff is not None:
+            if self.old_index.entries and layout and tail[:2] == b'\n\n' and size == pos + 2:
+                hashes = self.storage.hashes(self.path)
+                self.old_hashes = dict((hash_type, (hashes[hash_type].hexdigest(), str(size))) for label, hash_type in AptPackagesDiffIndex.HASHES)
+            else:
+                self.diff = None
+
+    def iter_stanzas(self):
+        return merge_stanzas(self._iter_old_stanzas(), sorted(six.iteritems(self.packages), key=lambda k: k[0]), self.diff)
+
+
+class AptByHashIndex(SupersededIndex):
+    """
+    Sidecar stored next to an index directory's by-hash/ listing every
+    by-hash/SHA256 copy in it, along with when it stopped being current.
+    Copies are kept around for a while after that so clients holding an
+    older Release can still fetch the indexes it lists.
+    """
+
+
+def merge_contents(old_lines, new):
+    """
+    Merge new files, as {path: set(location)}, in to the sorted lines of a
+    Contents index, yielding the lines of the new index.
+    """
+    paths = sorted(new)
+    i = 0
+
+    def line(path, locations):
+        return '{0}\t{1}\n'.format(path, ','.join(sorted(locations)))
+    for old_line in old_lines:
+        if not old_line.strip():
+            continue
+        path, locations = old_line.rsplit(None, 1)
+        while i < len(paths) and paths[i] < path:
+            yield line(paths[i], new[paths[i]])
+            i += 1
+        if i < len(paths) and paths[i] == path:
+            yield line(path, new[path].union(locations.split(',')))
+            i += 1
+        else:
+            yield old_line + '\n'
+    for path in paths[i:]:
+        yield line(path, new[path])
 
 
 class AptRelease(AptMeta):
@@ -92,6 +647,7 @@ class AptRelease(AptMeta):
             self['Origin'] = 'Depot {0}'.format(__version__)
             self['Date'] = ''  # Will be regenerated, but lock the order
             self['Codename'] = self.codename
+            self['Acquire-By-Hash'] = 'yes'
             # These are filled in using add_metadata()
             self['Architectures'] = ''
             self['Components'] = ''
@@ -142,9 +698,24 @@ class AptRelease(AptMeta):
         return super(AptRelease, self).__str__()
 
 
-class AptRepository(object):
+class AptRepository(Repository):
     # ex. mypgk@1.0
     COPY_SPEC_RE = re.compile(r'^([\w_-]+)@(.+?)$')
+    # Encodings published for each Packages and Sources index
+    INDEX_EXTENSIONS = ['', '.gz', '.bz2'] + (['.lzma'] if lzma else [])
+    # Number of metadata uploads in flight during commit_metadata()
+    PUBLISH_JOBS = 8
+    # Number of architectures whose Packages indexes are rebuilt at once
+    REBUILD_JOBS = 4
+    # Tries at commit_metadata() before giving up on a conflict, and the
+    # base delay in seconds between them
+    COMMIT_ATTEMPTS = 5
+    COMMIT_BACKOFF = 0.5
+    # Number of Packages pdiffs kept in each Packages.diff/Index
+    PDIFF_RETENTION = 30
+    # Seconds a by-hash copy is kept once it is no longer current, long
+    # enough for anyone holding an older Release to finish with it
+    BY_HASH_RETENTION = 3 * 24 * 60 * 60
 
     def __init__(self, storage, gpg, codename, component='main', architecture=None):
         self.storage = storage
@@ -154,9 +725,19 @@ class AptRepository(object):
         self.architecture = architecture
         self.dirty_packages = {}  # arch: [pkg,+]
         self.dirty_sources = False
+        # Guards dirty_packages when add_package is called from multiple threads
+        self._lock = threading.Lock()
+        # Uploads inline unless replaced by commit_metadata()
+        self.publisher = Publisher(self.storage)
+        self._etags = {}
+        self._by_hash = {}  # directory: set(digest)
+        self._contents = set()  # Architectures with a new Contents index
 
-    def add_package(self, path, fileobj=None, force=False, pool_path=None):
-        fileobj = fileobj or open(path, 'rb')
+    def open_package(self, path, fileobj=None, pool_path=None):
+        """Parse a package, returning (pkg, arch, fileobj) with fileobj ready to pass to upload_package()."""
+        # Everything read while parsing the control data is kept so the
+        # upload can stream the package without reading it twice
+        fileobj = ReplayFile(fileobj or open(path, 'rb'))
         path = os.path.basename(path)
         pkg = AptPackage(path, fileobj, pool_path=pool_path)
         # Check that we have an arch if needed
@@ -165,90 +746,424 @@ class AptRepository(object):
             arch = self.architecture
             if not arch:
                 raise ValueError('Architechture required when adding packages for "any"')
+        return pkg, arch, fileobj
 
-        # Check that the package doesn't already exist
-        if not force and pkg.pool_path in self.storage:
-            return False
+    def upload_package(self, pkg, arch, fileobj, dirty=True):
+        # Stream up the actual package file, reading its file list on the way
+        self.storage.upload(pkg.pool_path, pkg.tee_file_list(fileobj.replay()))
+        if dirty:
+            self.mark_dirty(pkg, arch)
 
-        # Stream up the actual package file
-        fileobj.seek(0, 0)
-        self.storage.upload(pkg.pool_path, fileobj)
-        self.dirty_packages.setdefault(arch, []).append(pkg)
-        return True
+    def mark_dirty(self, pkg, arch):
+        """Queue an uploaded package for the next commit_metadata()."""
+        with self._lock:
+            self.dirty_packages.setdefault(arch, []).append(pkg)
 
-    def copy_package(self, package):
+    def reset_dirty(self):
+        """Forget everything queued for commit_metadata()."""
+        with self._lock:
+            self.dirty_packages = {}
+
+    def copy_package(self, package, source_codename=None, source_component=None, pool_path=None):
+        """
+        Add a package that is already published, e.g. to promote it from one
+        codename to another. package is name@version and the source defaults
+        to this codename and component. The control data, size and hashes
+        come from the source Packages indexes so the package itself is never
+        downloaded, and it is only copied in storage if pool_path moves it.
+        Returns the architectures it was copied for.
+        """
         md = self.COPY_SPEC_RE.match(package)
         if not md:
-            raise ValueError('Unable to parse {0)'.format(repr(package)))
-        #package_name = md.group(1)
-        #package_version = md.group(2)
-        #package_component = md.group(3)
-        raise NotImplementedError('TODO finish this')
+            raise ValueError('Unable to parse {0}'.format(repr(package)))
+        key = (md.group(1), md.group(2))
+        source_codename = source_codename or self.codename
+        source_component = source_component or self.component
+        if (source_codename, source_component) == (self.codename, self.component) and not pool_path:
+            raise ValueError('Can not copy {0} on to itself'.format(package))
+        release_raw = self.storage.download('dists/{0}/Release'.format(source_codename), skip_hash=True)
+        if release_raw is None:
+            raise ValueError('Codename {0} not found'.format(source_codename))
+        archs = []
+        for arch in AptRelease(self.storage, source_codename, release_raw)['Architectures'].split():
+            packages_path = 'dists/{0}/{1}/binary-{2}/Packages'.format(source_codename, source_component, arch)
+            stanza = AptPackages(self.storage, self.storage.download(packages_path, skip_hash=True) or '').packages.get(key)
+            if stanza is None:
+                continue
+            source_path = AptMeta(str(stanza))['Filename']
+            pkg = AptPackage(os.path.basename(source_path), data=str(stanza), pool_path=pool_path)
+            # The package is never downloaded, so the index is the only place to get these
+            if not all(pkg.get(field) for field in ('Size', 'MD5sum', 'SHA1', 'SHA256')):
+                raise ValueError('{0} in {1}/{2} has no size or hashes'.format(package, source_codename, source_component))
+            self.storage.set_hashes(source_path, pkg['Size'], pkg['MD5sum'], pkg['SHA1'], pkg['SHA256'])
+            if pkg.pool_path != source_path:
+                self.storage.copy(source_path, pkg.pool_path)
+            pkg.files = self.read_contents('dists/{0}/{1}/Contents-{2}.gz'.format(source_codename, source_component, arch), pkg.contents_name)
+            self.mark_dirty(pkg, arch)
+            archs.append(arch)
+        if not archs:
+            raise ValueError('{0} not found in {1}/{2}'.format(package, source_codename, source_component))
+        return archs
+
+    def read_contents(self, path, location):
+        """
+        Find the files listed for a package in a Contents index. Contents
+        doesn't record versions, so this is every file of every version of
+        it in the index.
+        """
+        chunks = self.storage.download_iter(path, skip_hash=True)
+        if chunks is None:
+            return None
+        gz = decompressor('.gz')
+        files = []
+        for line in iter_lines(gz.decompress(chunk) for chunk in chunks):
+            if line.strip():
+                name, locations = line.rsplit(None, 1)
+                if location in locations.split(','):
+                    files.append(name)
+        return files
+
+    def upload_index(self, path, chunks, callback=None, etags=None, extensions=None):
+        """
+        Encode an index once in to every format in extensions, by default
+        INDEX_EXTENSIONS, and queue the uploads. The first format is the one
+        read back by the next commit. callback runs once it is uploaded and
+        given etags it is only written if it hasn't changed since it was
+        downloaded. The other formats are only uploaded once it has been,
+        and given etags only if they haven't changed since it was read
+        either, so a publisher that loses a race part way through can't
+        leave them out of step with it.
+        """
+        extensions = extensions or self.INDEX_EXTENSIONS
+        if etags is not None:
+            self.storage.record_etags([path+ext for ext in extensions[1:]], etags)
+        streams = encode_streams(chunks, extensions)
+
+        def uploaded():
+            self.publish_by_hash(path+extensions[0])
+            for ext, fileobj in streams[1:]:
+                self.publisher.upload(path+ext, fileobj, callback=functools.partial(self.publish_by_hash, path+ext), etags=etags)
+            if callback:
+                callback()
+        self.publisher.upload(path+extensions[0], streams[0][1], callback=uploaded, etags=etags)
+
+    def publish_by_hash(self, path):
+        """Copy a freshly uploaded index to by-hash/SHA256/<digest> in its directory."""
+        digest = self.storage.hashes(path)['sha256'].hexdigest()
+        directory = os.path.dirname(path)
+        self.storage.copy(path, '{0}/by-hash/SHA256/{1}'.format(directory, digest))
+        with self._lock:
+            self._by_hash.setdefault(directory, set()).add(digest)
+
+    def commit_by_hash(self, release=None):
+        """
+        Record the by-hash copies made this commit in each directory's
+        by-hash.idx, returning the paths of copies that have expired. They
+        should only be deleted once the new Release is in place. Anything
+        else the new release lists stays current too, several indexes can
+        share a directory (e.g. every Contents-<arch>.gz) and not all of
+        them are rewritten each commit.
+        """
+        listed = {}  # directory: set(digest)
+        if release is not None:
+            for path, (digest, size) in six.iteritems(release.hashes['sha256']):
+                directory = os.path.dirname('dists/{0}/{1}'.format(self.codename, path))
+                listed.setdefault(directory, set()).add(digest)
+        now = time.time()
+        expired = []
+        for directory, digests in sorted(six.iteritems(self._by_hash)):
+            index_path = '{0}/by-hash.idx'.format(directory)
+            index = AptByHashIndex(self.storage.download(index_path, skip_hash=True, etags=self._etags))
+            for digest in index.update(digests | listed.get(directory, set()), now, self.BY_HASH_RETENTION):
+                expired.append('{0}/by-hash/SHA256/{1}'.format(directory, digest))
+            self.publisher.upload(index_path, str(index), etags=self._etags)
+        return expired
 
     def commit_package_metadata(self, arch, pkgs):
         # Update the Packages file
         packages_path = 'dists/{0}/{1}/binary-{2}/Packages'.format(self.codename, self.component, arch)
-        packages = AptPackages(self.storage, self.storage.download(packages_path, skip_hash=True) or '')
+        index_path = packages_path + '.idx'
+        packages = None
+
+        def write_index():
+            # The sidecar records the hash of the Packages file it describes
+            packages.index.sha256 = self.storage.hashes(packages_path)['sha256'].hexdigest()
+            self.publisher.upload(index_path, str(packages.index), etags=self._etags)
+            self.commit_packages_diff(packages_path, packages)
+
+        index_raw = self.storage.download(index_path, skip_hash=True, etags=self._etags)
+        if index_raw:
+            chunks = self.storage.download_iter(packages_path, etags=self._etags)
+            if chunks is not None:
+                packages = AptSplicedPackages(self.storage, packages_path, chunks, AptPackagesIndex(index_raw))
+                packages.diff = AptPackagesDiff()
+                for pkg in pkgs:
+                    packages.add(pkg)
+                try:
+                    self.upload_index(packages_path, packages.iter_chunks(), callback=write_index, etags=self._etags)
+                except StaleIndexError:
+                    # Something other than depot wrote the Packages file, do it the slow way
+                    packages = None
+        if packages is None:
+            packages = AptPackages(self.storage, self.storage.download(packages_path, skip_hash=True, etags=self._etags) or '')
+            packages.diff = AptPackagesDiff()
+            for pkg in pkgs:
+                packages.add(pkg)
+            self.upload_index(packages_path, packages.iter_chunks(), callback=write_index, etags=self._etags)
+        self.commit_contents_metadata(arch, pkgs)
+
+    def commit_contents_metadata(self, arch, pkgs):
+        """
+        Merge the files of the new packages in to Contents-<arch>.gz, which is
+        read back as a stream so only the new packages are ever unpacked.
+        """
+        files = {}  # path: set(location)
         for pkg in pkgs:
-            packages.add(pkg)
-        packages_raw = str(packages)
-        self.storage.upload(packages_path, packages_raw)
-        self.storage.upload(packages_path+'.gz', gzip_compress(packages_raw))
-        self.storage.upload(packages_path+'.bz2', bz2.compress(packages_raw))
-        if lzma:
-            self.storage.upload(packages_path+'.lzma', lzma.compress(packages_raw))
+            for path in pkg.files or ():
+                files.setdefault(path, set()).add(pkg.contents_name)
+        if not files:
+            return
+        contents_path = 'dists/{0}/{1}/Contents-{2}'.format(self.codename, self.component, arch)
+        chunks = self.storage.download_iter(contents_path+'.gz', skip_hash=True, etags=self._etags)
+        old_lines = []
+        if chunks is not None:
+            gz = decompressor('.gz')
+            old_lines = iter_lines(gz.decompress(chunk) for chunk in chunks)
+        self.upload_index(contents_path, merge_contents(old_lines, files), etags=self._etags, extensions=['.gz'])
+        with self._lock:
+            self._contents.add(arch)
+
+    def commit_packages_diff(self, packages_path, packages):
+        """
+        Add a pdiff from the old Packages file to the one just uploaded and
+        update Packages.diff/Index, so apt can fetch only the changes. If the
+        history doesn't end at the old file, or no diff could be made, it is
+        started over from the new file.
+        """
+        diff_index_path = packages_path + '.diff/Index'
+        diff_index = AptPackagesDiffIndex(self.storage.download(diff_index_path, skip_hash=True, etags=self._etags) or '')
+        diff = packages.diff
+        dropped = []
+        patch_name = None
+        if diff is None or not diff.valid or packages.old_hashes != diff_index.current:
+            dropped = diff_index.prune(0)
+        elif diff:
+            patch_name = base_name = time.strftime('%Y-%m-%d-%H%M.%S', time.gmtime())
+            for n in itertools.count(1):
+                if patch_name not in diff_index.patches:
+                    break
+                patch_name = '{0}.{1}'.format(base_name, n)
+            patch = str(diff)
+            patch_gz = gzip_compress(patch, patch_name)
+            diff_index.add(patch_name, packages.old_hashes, patch, patch_gz)
+        hashes = self.storage.hashes(packages_path)
+        diff_index.current = dict((hash_type, (hashes[hash_type].hexdigest(), str(hashes['size'].size))) for label, hash_type in diff_index.HASHES)
+        dropped.extend(diff_index.prune(self.PDIFF_RETENTION))
+
+        def write_diff_index():
+            # Only point at the new patch once it is in place, and only
+            # delete old ones once nothing points at them
+            self.publisher.upload(diff_index_path, str(diff_index), callback=diff_index_uploaded, etags=self._etags)
+
+        def diff_index_uploaded():
+            self.publish_by_hash(diff_index_path)
+            for name in dropped:
+                self.storage.delete('{0}.diff/{1}.gz'.format(packages_path, name))
+        if patch_name in diff_index.patches:
+            self.publisher.upload('{0}.diff/{1}.gz'.format(packages_path, patch_name), patch_gz, callback=write_diff_index)
+        else:
+            write_diff_index()
+
+    def commit_all_package_metadata(self, archs):
+        """
+        Rebuild the Packages index for each architecture, several at a time.
+        The heavy lifting (transfers, compression and hashing) releases the
+        GIL, so threads give real parallelism here without having to ship
+        packages and storage connections between processes.
+        """
+        jobs = min(self.REBUILD_JOBS, len(archs))
+        if jobs <= 1:
+            for arch in archs:
+                self.commit_package_metadata(arch, self.dirty_packages[arch])
+            return
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(lambda arch: self.commit_package_metadata(arch, self.dirty_packages[arch]), archs)
+        finally:
+            pool.close()
+            pool.join()
 
     def commit_sources_metadata(self):
         # Update the Sources file
         sources_path = 'dists/{0}/{1}/source/Sources'.format(self.codename, self.component)
         if sources_path in self.storage:
             return
-        sources_content = ''
-        self.storage.upload(sources_path, sources_content)
-        self.storage.upload(sources_path+'.gz', gzip_compress(sources_content))
-        self.storage.upload(sources_path+'.bz2', bz2.compress(sources_content))
-        if lzma:
-            self.storage.upload(sources_path+'.lzma', lzma.compress(sources_content))
+        self.upload_index(sources_path, [''])
         self.dirty_sources = True
 
-    def commit_release_metadata(self, archs):
-        # Update Release
-        release_path = 'dists/{0}/Release'.format(self.codename)
-        release = AptRelease(self.storage, self.codename, self.storage.download(release_path, skip_hash=True) or '')
+    def add_release_metadata(self, release, archs):
+        """Record this component's indexes for archs in release."""
         for arch in archs:
             release.add_metadata(self.component, arch)
             release_packages_path = '{0}/binary-{1}/Packages'.format(self.component, arch)
-            release.update_hash(release_packages_path)
-            release.update_hash(release_packages_path+'.gz')
-            release.update_hash(release_packages_path+'.bz2')
-            if lzma:
-                release.update_hash(release_packages_path+'.lzma')
+            for ext in self.INDEX_EXTENSIONS:
+                release.update_hash(release_packages_path+ext)
+            release.update_hash(release_packages_path+'.diff/Index')
+            if arch in self._contents:
+                release.update_hash('{0}/Contents-{1}.gz'.format(self.component, arch))
         if self.dirty_sources:
             release_sources_path = '{0}/source/Sources'.format(self.component)
-            release.update_hash(release_sources_path)
-            release.update_hash(release_sources_path+'.gz')
-            release.update_hash(release_sources_path+'.bz2')
-            if lzma:
-                release.update_hash(release_sources_path+'.lzma')
-            self.dirty_sources = False
+            for ext in self.INDEX_EXTENSIONS:
+                release.update_hash(release_sources_path+ext)
+
+    def commit_release_metadata(self, archs, components=None):
+        """
+        Build, upload and sign Release. components is [(repo, archs)] for
+        every component of this codename committed with it, by default just
+        this one.
+        """
+        components = components or [(self, archs)]
+        # Release lists the hashes of all the indexes so they have to be uploaded first
+        self.publisher.wait()
+        release_path = 'dists/{0}/Release'.format(self.codename)
+        release = AptRelease(self.storage, self.codename, self.storage.download(release_path, skip_hash=True, etags=self._etags) or '')
+        for repo, repo_archs in components:
+            repo.add_release_metadata(release, repo_archs)
         # Force the date to regenerate
         release['Date'] = None
+        # Releases from before by-hash was published need it switched on
+        release['Acquire-By-Hash'] = 'yes'
         release_raw = str(release)
-        self.storage.upload(release_path, release_raw)
+        expired = []
+        for repo, repo_archs in components:
+            expired.extend(repo.commit_by_hash(release))
+        self.publisher.wait()
+        # Release is the commit point, if another publisher got there first
+        # this raises ConflictError and the whole commit is retried
+        self.publisher.upload(release_path, release_raw, etags=self._etags)
 
         # GPG signing
         if self.gpg:
+            # Upload the pubkey to be nice
+            self.publisher.upload('pubkey.gpg', self.gpg.public_key())
+            # Signing overlaps with the Release upload, but the signatures
+            # only go up once Release is in place
+            in_release_raw, release_gpg_raw = self.gpg.sign_release(release_raw)
+            self.publisher.wait()
             # Fun fact, even debian's own tools don't seem to support this InRelease file
             in_release_path = 'dists/{0}/InRelease'.format(self.codename)
-            self.storage.upload(in_release_path, self.gpg.sign(release_raw))
-            self.storage.upload(release_path+'.gpg', self.gpg.sign(release_raw, detach=True))
+            self.publisher.upload(in_release_path, in_release_raw)
+            self.publisher.upload(release_path+'.gpg', release_gpg_raw)
+        self.publisher.wait()
+        for path in expired:
+            self.storage.delete(path)
 
-            # Upload the pubkey to be nice
-            self.storage.upload('pubkey.gpg', self.gpg.public_key())
+    def commit_metadata(self, repos=None):
+        """
+        Rebuild and upload all metadata for the dirty packages. Returns
+        {path: seconds} for each upload. repos is every component of this
+        codename to commit along with this one under a single Release, by
+        default just this one.
+
+        Packages and Release are written conditionally on them not having
+        changed since they were read. If another publisher commits in the
+        meantime the whole commit is redone on top of its indexes, so any
+        number of publishers can share a repository without overwriting each
+        other, and everything added since the last commit goes out in one
+        rewrite.
+        """
+        repos = repos or [self]
+        for attempt in itertools.count(1):
+            try:
+                timings = self._commit_metadata(repos)
+            except ConflictError:
+                if attempt >= self.COMMIT_ATTEMPTS:
+                    raise
+                # Jittered so racing publishers don't collide again
+                time.sleep(random.uniform(0, self.COMMIT_BACKOFF * 2 ** attempt))
+                continue
+            for repo in repos:
+                repo.dirty_packages = {}
+                repo.dirty_sources = False
+            return timings
+
+    def _commit_metadata(self, repos):
+        # ETags of the indexes as read this attempt, shared as they all
+        # go out under the same Release
+        etags = {}
+        publisher = Publisher(self.storage, self.PUBLISH_JOBS)
+        components = []
+        try:
+            for repo in repos:
+                repo._etags = etags
+                repo._by_hash = {}
+                repo._contents = set()
+                repo.publisher = publisher
+                # Sorted so the output doesn't depend on the order packages finished uploading
+                archs = sorted(repo.dirty_packages)
+                repo.commit_all_package_metadata(archs)
+                repo.commit_sources_metadata()
+                components.append((repo, archs))
+            self.commit_release_metadata(components[0][1], components)
+            return publisher.timings
+        finally:
+            publisher.close()
+            for repo in repos:
+                repo.publisher = Publisher(self.storage)
+
+
+class AptRepositoryGroup(AptRepository):
+    """
+    Several (codename, component) targets in the same storage, published
+    together. Packages are uploaded to the pool and hashed once and then
+    added to every target. Different codenames commit in parallel, the
+    components of each codename commit together under one Release.
+    """
+    # Number of codenames committed at once
+    COMMIT_JOBS = 4
+
+    def __init__(self, storage, gpg, targets, architecture=None):
+        super(AptRepositoryGroup, self).__init__(storage, gpg, None, None, architecture)
+        if not targets:
+            raise ValueError('At least one codename and component required')
+        self.repos = [AptRepository(storage, gpg, codename, component, architecture) for codename, component in targets]
+
+    def mark_dirty(self, pkg, arch):
+        # Each target fills in its own fields on commit
+        for repo in self.repos:
+            repo.mark_dirty(pkg.copy(), arch)
+
+    def reset_dirty(self):
+        for repo in self.repos:
+            repo.reset_dirty()
+
+    def copy_package(self, package, source_codename=None, source_component=None, pool_path=None):
+        archs = []
+        for repo in self.repos:
+            for arch in repo.copy_package(package, source_codename, source_component, pool_path):
+                if arch not in archs:
+                    archs.append(arch)
+        return archs
 
     def commit_metadata(self):
-        for arch, packages in six.iteritems(self.dirty_packages):
-            self.commit_package_metadata(arch, packages)
-        self.commit_sources_metadata()
-        self.commit_release_metadata(six.iterkeys(self.dirty_packages))
-        self.dirty_packages = {}
+        """Commit every target. Returns {path: seconds} for each upload."""
+        by_codename = collections.OrderedDict()
+        for repo in self.repos:
+            by_codename.setdefault(repo.codename, []).append(repo)
+
+        def commit(repos):
+            return repos[0].commit_metadata(repos)
+        jobs = min(self.COMMIT_JOBS, len(by_codename))
+        if jobs <= 1:
+            results = [commit(repos) for repos in by_codename.values()]
+        else:
+            pool = ThreadPool(jobs)
+            try:
+                results = pool.map(commit, list(by_codename.values()))
+            finally:
+                pool.close()
+                pool.join()
+        timings = collections.OrderedDict()
+        for codename_timings in results:
+            timings.update(codename_timings)
+        return timings
@@ -0,0 +1,213 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'depot')
+
+
+def atomic_write(path, data):
+    """Write a file via a rename so readers never see a partial write."""
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class HashCache(object):
+    """
+    Persistent cache of object content hashes. Entries are keyed by object
+    URI and are only valid while the object's size and ETag (or the mtime
+    based hash libcloud uses for local storage) still match, so an object
+    that has been rewritten is never trusted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self.path, 'rb') as f:
+                self._entries = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key, size, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry['size'] == int(size) and entry['etag'] == etag:
+            return entry
+
+    def set(self, key, size, etag, md5, sha1, sha256):
+        with self._lock:
+            self._entries[key] = {'size': int(size), 'etag': etag, 'md5': md5, 'sha1': sha1, 'sha256': sha256}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._entries, sort_keys=True).encode('utf-8')
+            self._dirty = False
+        atomic_write(self.path, data)
+
+
+class MetadataCache(object):
+    """
+    On-disk cache of downloaded objects, keyed by object URI and validated
+    against the object's size and ETag so an unchanged object never has to
+    be transferred again. Objects uploaded through the same StorageWrapper
+    are cached on the way up too. Anything bigger than max_size / 8 isn't
+    cached at all, and the least recently used entries are evicted once the
+    cache grows past max_size bytes.
+    """
+
+    # Packages themselves are never read back, so don't let them push out metadata
+    UNCACHED_EXTENSIONS = ('.deb', '.udeb', '.ddeb', '.rpm')
+
+    def __init__(self, path, max_size=512*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Bytes of cached data, None until the first evict() counts it
+        self._size = None
+
+    def _paths(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name), os.path.join(self.path, name + '.json')
+
+    def get(self, key, size, etag):
+        """Return an open file with the cached data, or None if it's missing or stale."""
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            if meta['key'] != key or meta['size'] != int(size) or meta['etag'] != etag:
+                return None
+            fileobj = open(data_path, 'rb')
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # Bump the mtime so eviction is least recently used
+        try:
+            os.utime(data_path, None)
+        except OSError:
+            pass
+        return fileobj
+
+    def wants(self, key):
+        return not key.endswith(self.UNCACHED_EXTENSIONS)
+
+    def writer(self, key):
+        return MetadataCacheWriter(self, key)
+
+    def _commit(self, key, tmp_path, size, etag):
+        data_path, meta_path = self._paths(key)
+        try:
+            replaced = os.path.getsize(data_path)
+        except OSError:
+            replaced = 0
+        os.rename(tmp_path, data_path)
+        atomic_write(meta_path, json.dumps({'key': key, 'size': int(size), 'etag': etag}).encode('utf-8'))
+        with self._lock:
+            if self._size is not None:
+                self._size += int(size) - replaced
+            full = self._size is None or self._size > self.max_size
+        # The directory is only scanned when something has to go
+        if full:
+            self.evict()
+
+    def evict(self):
+        """Scan the cache, removing the least recently used entries until it fits in max_size."""
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.path):
+                if name.endswith('.json') or name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            entries.sort()
+            while total > self.max_size and entries:
+                mtime, size, name = entries.pop(0)
+                for path in (os.path.join(self.path, name), os.path.join(self.path, name + '.json')):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                total -= size
+            self._size = total
+
+
+class MetadataCacheWriter(object):
+    """Collects an object's data as it streams past, see MetadataCache.writer()."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        if not os.path.isdir(cache.path):
+            try:
+                os.makedirs(cache.path)
+            except OSError:
+                pass
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.path, prefix='.tmp')
+        self.fileobj = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self.fileobj is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_size // 8:
+            # Too big to be worth caching
+            self.abort()
+        else:
+            self.fileobj.write(data)
+
+    def commit(self, etag):
+        if self.fileobj is None:
+            return
+        self.fileobj.close()
+        self.fileobj = None
+        self.cache._commit(self.key, self.tmp_path, self.size, etag)
+
+    def abort(self):
+        if self.fileobj is None:
+            return
+        self.fileobj.close()
+        self.fileobj = None
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
@@ -1,11 +1,23 @@
 import getpass
+import json
 import os
+import re
+import time
 
 import gnupg
 
+from .cache import atomic_write
+
+SIGNATURE_ARMOR = '-----BEGIN PGP SIGNATURE-----'
+# Trailing whitespace, which clearsigning leaves out of the signed text
+TRAILING_SPACE_RE = re.compile(r'[ \t\r]$', re.M)
+
 
 class GPG(object):
-    def __init__(self, keyid, key=None, home=None):
+    # How long a successful check of the signing key is trusted for, in seconds
+    VERIFY_TTL = 24 * 60 * 60
+
+    def __init__(self, keyid, key=None, home=None, cache_path=None):
         self.gpg = gnupg.GPG(use_agent=False, gnupghome=home)
         if key:
             if not home:
@@ -17,23 +29,80 @@ class GPG(object):
             # Compat with how Freight does it.
             self.keyid = os.environ.get('GPG')
         self.passphrase = None
+        self.cache_path = cache_path
+        self._public_key = None
         self._verify()
 
     def _verify(self):
         """Some sanity checks on GPG."""
         if not self.keyid:
             raise ValueError('No GPG key specified for signing, did you mean to use --no-sign?')
-        sign = self.gpg.sign('', keyid=self.keyid)
-        if 'secret key not available' in sign.stderr:
-            raise ValueError('Key not found')
-        elif 'NEED_PASSPHRASE' in sign.stderr:
+        cached = self._load_cache()
+        if cached and time.time() - cached['checked'] < self.VERIFY_TTL:
+            needs_passphrase = cached['needs_passphrase']
+            self._public_key = cached.get('public_key')
+        else:
+            sign = self.gpg.sign('', keyid=self.keyid)
+            if 'secret key not available' in sign.stderr:
+                raise ValueError('Key not found')
+            needs_passphrase = 'NEED_PASSPHRASE' in sign.stderr
+            self._save_cache(checked=time.time(), needs_passphrase=needs_passphrase)
+        if needs_passphrase:
             self.passphrase = getpass.getpass('Passphrase for GPG key: ')
 
+    def _keyring_mtime(self):
+        """Latest change to the keyrings, so a cached check is dropped if the keys change."""
+        home = self.gpg.gnupghome or os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+        mtimes = [os.path.getmtime(os.path.join(home, name)) for name in ('secring.gpg', 'private-keys-v1.d', 'pubring.gpg', 'pubring.kbx')
+                  if os.path.exists(os.path.join(home, name))]
+        return max(mtimes) if mtimes else 0
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8')).get(self.keyid)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry and entry['home'] == self.gpg.gnupghome and entry['mtime'] == self._keyring_mtime():
+            return entry
+
+    def _save_cache(self, **fields):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            entries = {}
+        entry = entries.setdefault(self.keyid, {})
+        entry.update(fields, home=self.gpg.gnupghome, mtime=self._keyring_mtime())
+        atomic_write(self.cache_path, json.dumps(entries, sort_keys=True).encode('utf-8'))
+
     def sign(self, data, detach=False):
         sign = self.gpg.sign(data, keyid=self.keyid, passphrase=self.passphrase, detach=detach)
         if not sign:
             raise ValueError(sign.stderr)
         return str(sign)
 
+    def sign_release(self, data):
+        """
+        Return (InRelease, Release.gpg) for a Release file. A clearsignature
+        is a text mode signature of the canonical text, which verifies just
+        the same as a detached signature of it, so one gpg run gives both.
+        That only holds if no line ends in whitespace and there is no final
+        newline, true of Release files depot writes, anything else is signed
+        a second time.
+        """
+        in_release = self.sign(data)
+        if data.endswith('\n') or TRAILING_SPACE_RE.search(data):
+            return in_release, self.sign(data, detach=True)
+        return in_release, in_release[in_release.index(SIGNATURE_ARMOR):]
+
     def public_key(self):
-        return self.gpg.export_keys(self.keyid)
+        if not self._public_key:
+            self._public_key = self.gpg.export_keys(self.keyid)
+            if self._load_cache():
+                self._save_cache(public_key=self._public_key)
+        return self._public_key
@@ -0,0 +1,81 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class Publisher(object):
+    """
+    Upload metadata objects concurrently. Everything queued with upload() is
+    independent, wait() is the barrier between stages that depend on each
+    other (e.g. indexes before Release, Release before its signatures). With
+    jobs=0 uploads happen inline in upload(). The time taken by each upload
+    is recorded in timings. Given the etags recorded by a download, an upload
+    only goes through if the object hasn't changed since, otherwise the
+    ConflictError comes out of upload() or wait().
+    """
+
+    def __init__(self, storage, jobs=0):
+        self.storage = storage
+        self.pool = ThreadPool(jobs) if jobs > 0 else None
+        self.timings = collections.OrderedDict()  # path: seconds
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def upload(self, path, data, callback=None, etags=None):
+        """Queue an upload. callback is run once it finishes, and may queue more uploads."""
+        if self.pool is None:
+            return self._upload(path, data, callback, etags)
+        result = self.pool.apply_async(self._upload, (path, data, callback, etags))
+        with self._lock:
+            self._pending.append(result)
+
+    def _upload(self, path, data, callback, etags=None):
+        start = time.time()
+        try:
+            if etags is not None:
+                self.storage.upload_if(path, data, etags.get(path))
+            else:
+                self.storage.upload(path, data)
+        finally:
+            close = getattr(data, 'close', None)
+            if close:
+                close()
+        elapsed = time.time() - start
+        with self._lock:
+            self.timings[path] = elapsed
+        if callback:
+            callback()
+
+    def wait(self):
+        """Block until every queued upload, including ones queued by callbacks, has finished."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending, self._pending = self._pending, []
+            for result in pending:
+                result.get()
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
@@ -0,0 +1,112 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+from multiprocessing.pool import ThreadPool
+
+import six
+
+
+class Repository(object):
+    """
+    Adding packages, shared by the apt and yum repositories. Subclasses
+    provide open_package() and upload_package(), which queues the package
+    for the next commit_metadata() unless passed dirty=False.
+    """
+
+    def add_package(self, path, fileobj=None, force=False, pool_path=None):
+        pkg, arch, fileobj = self.open_package(path, fileobj, pool_path)
+
+        # Check that the package doesn't already exist
+        if not force and pkg.pool_path in self.storage:
+            return False
+
+        self.upload_package(pkg, arch, fileobj)
+        return True
+
+    def add_packages(self, paths, force=False, pool_path=None, jobs=1, open_fn=None):
+        """
+        Add several packages at once, returning a list of which were uploaded.
+        All packages are parsed first so that whether each one already exists
+        is resolved with a single batched storage query, then the uploads run
+        on up to jobs threads. Each input is only held open while it is being
+        read, so with remote inputs at most jobs downloads are running at once.
+        """
+        open_fn = open_fn or (lambda path: open(path, 'rb'))
+        pool = ThreadPool(jobs) if jobs > 1 and len(paths) > 1 else None
+        map_fn = pool.map if pool else lambda fn, it: list(six.moves.map(fn, it))
+
+        def pool_path_of(path):
+            # Only the headers are read, the rest of the stream is dropped
+            fileobj = open_fn(path)
+            try:
+                return self.open_package(path, fileobj, pool_path)[0].pool_path
+            finally:
+                fileobj.close()
+
+        def upload(path):
+            fileobj = open_fn(path)
+            try:
+                self.upload_package(*self.open_package(path, fileobj, pool_path))
+            finally:
+                fileobj.close()
+        try:
+            if force:
+                map_fn(upload, paths)
+                return [True] * len(paths)
+            pool_paths = map_fn(pool_path_of, paths)
+            existing = self.storage.exists(pool_paths)
+            map_fn(upload, [path for path, path_pool_path in six.moves.zip(paths, pool_paths) if path_pool_path not in existing])
+            return [path_pool_path not in existing for path_pool_path in pool_paths]
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+
+class SupersededIndex(object):
+    """
+    Sidecar listing published objects along with when each stopped being
+    current, so they can be kept around for a while after that for clients
+    still working from older metadata.
+    """
+
+    def __init__(self, data=None):
+        self.entries = collections.OrderedDict()  # name: time superseded, or None while current
+        for line in (data or '').splitlines():
+            name, superseded = line.split(' ')
+            self.entries[name] = None if superseded == '-' else float(superseded)
+
+    def update(self, current, now, retention):
+        """Mark current as the current names, returning the names that have expired."""
+        for name in sorted(current):
+            self.entries[name] = None
+        expired = []
+        for name, superseded in list(six.iteritems(self.entries)):
+            if name in current:
+                continue
+            if superseded is None:
+                self.entries[name] = now
+            elif now - superseded > retention:
+                del self.entries[name]
+                expired.append(name)
+        return expired
+
+    def __str__(self):
+        return ''.join('{0} {1}\n'.format(name, '-' if superseded is None else int(superseded))
+                       for name, superseded in six.iteritems(self.entries))
@@ -0,0 +1,293 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import posixpath
+import socket
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+
+
+class Batch(object):
+    """Packages waiting on the same metadata commit."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.packages = []  # [(pkg, arch)]
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class CommitQueue(object):
+    """
+    Accept packages for a repository and commit their metadata in batches.
+    The first package added starts a window of window seconds and everything
+    added before it closes goes out in a single commit_metadata(). Package
+    files are uploaded by a fixed pool of threads so their storage
+    connections stay open between requests. Packages from a batch whose
+    commit fails are already in the pool, so they go out with the next one.
+    """
+
+    # Number of package uploads run at once unless jobs is given
+    UPLOAD_JOBS = 8
+
+    def __init__(self, repo, window=5.0, jobs=None):
+        self.repo = repo
+        self.window = window
+        self.commits = 0
+        self.last_commit = None
+        self._batch = None
+        self._retry = []  # [(pkg, arch)] from failed commits
+        self._closed = False
+        self._cond = threading.Condition()
+        self._upload_pool = ThreadPool(jobs or self.UPLOAD_JOBS)
+        self._thread = threading.Thread(target=self._run, name='depot-commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._batch.packages) if self._batch else 0
+
+    def add(self, path, fileobj, force=False, pool_path=None):
+        """
+        Upload a package and block until the metadata commit including it
+        has finished. Returns False if the package was already uploaded.
+        """
+        pkg, arch = self._upload_pool.apply(self._upload, (path, fileobj, force, pool_path))
+        if pkg is None:
+            return False
+        with self._cond:
+            if self._closed:
+                raise ValueError('Commit queue is closed')
+            if self._batch is None:
+                self._batch = Batch(time.time() + self.window)
+                self._cond.notify()
+            batch = self._batch
+            batch.packages.append((pkg, arch))
+        batch.wait()
+        return True
+
+    def _upload(self, path, fileobj, force, pool_path):
+        pkg, arch, fileobj = self.repo.open_package(path, fileobj, pool_path)
+        if not force and pkg.pool_path in self.repo.storage:
+            return None, None
+        # Marked dirty when its batch commits, not now
+        self.repo.upload_package(pkg, arch, fileobj, dirty=False)
+        return pkg, arch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._batch is None and not self._closed:
+                    self._cond.wait()
+                if self._batch is None:
+                    return
+                # Hold the batch open until its window closes, close() cuts it short
+                while not self._closed and time.time() < self._batch.deadline:
+                    self._cond.wait(self._batch.deadline - time.time())
+                batch, self._batch = self._batch, None
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # Only this thread marks packages dirty, adds go through batches
+        packages, self._retry = self._retry + batch.packages, []
+        for pkg, arch in packages:
+            self.repo.mark_dirty(pkg, arch)
+        try:
+            self.repo.commit_metadata()
+        except Exception as e:
+            self.repo.reset_dirty()
+            self._retry = packages
+            batch.finish(e)
+            return
+        self.commits += 1
+        self.last_commit = time.time()
+        hash_cache = self.repo.storage.hash_cache
+        if hash_cache:
+            hash_cache.save()
+        batch.finish()
+
+    def close(self):
+        """Commit anything still pending and stop."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._upload_pool.close()
+        self._upload_pool.join()
+
+
+class BodyFile(object):
+    """Read at most length bytes of a request body."""
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        """Read and discard whatever is left."""
+        while self.read(64*1024):
+            pass
+
+    def close(self):
+        pass
+
+
+class DepotRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    PUT /packages/<filename>[?force=1&pool_path=...] with the package as the
+    body adds it, responding once its metadata has been committed. pool_path
+    must be a normalized path under pool/.
+    GET /status describes the commit queue.
+    """
+
+    server_version = 'depot'
+
+    def do_PUT(self):
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return self.send_json(411, {'error': 'Content-Length required'})
+        body = BodyFile(self.rfile, length)
+        status, data = self.put_package(body)
+        # Read the rest of the body so the client isn't reset mid-upload
+        body.drain()
+        self.send_json(status, data)
+
+    def put_package(self, body):
+        url = urlparse(self.path)
+        if not url.path.startswith('/packages/'):
+            return 404, {'error': 'Not found'}
+        filename = os.path.basename(unquote(url.path[len('/packages/'):]))
+        if not filename:
+            return 400, {'error': 'Package filename required'}
+        query = parse_qs(url.query)
+        force = query.get('force', ['0'])[0] not in ('', '0', 'false')
+        pool_path = query.get('pool_path', [None])[0]
+        if pool_path is not None and not (pool_path.startswith('pool/') and posixpath.normpath(pool_path) == pool_path):
+            return 400, {'error': 'pool_path must be under pool/'}
+        try:
+            uploaded = self.server.queue.add(filename, body, force, pool_path)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            self.log_error('Error adding %s: %s', filename, e)
+            return 500, {'error': str(e)}
+        return 201 if uploaded else 200, {'package': filename, 'uploaded': uploaded}
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            return self.send_json(404, {'error': 'Not found'})
+        queue = self.server.queue
+        self.send_json(200, {
+            'pending': queue.pending,
+            'commits': queue.commits,
+            'last_commit': queue.last_commit,
+        })
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets don't have a client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        sys.stderr.write('{0} - - [{1}] {2}\n'.format(self.address_string(), self.log_date_time_string(), format % args))
+
+
+class DepotHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, queue):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DepotRequestHandler)
+        self.queue = queue
+
+
+class DepotUnixHTTPServer(DepotHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+    def server_close(self):
+        DepotHTTPServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(listen, queue):
+    """
+    Create a server for queue listening on listen, either host:port or a
+    path to a Unix socket.
+    """
+    if '/' in listen:
+        return DepotUnixHTTPServer(listen, queue)
+    host, _, port = listen.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError('Unable to parse listen address {0}'.format(repr(listen)))
+    return DepotHTTPServer((host or '127.0.0.1', port), queue)
+
+
+def serve(repo, listen, window=5.0, jobs=None):
+    queue = CommitQueue(repo, window, jobs)
+    server = make_server(listen, queue)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.close()
@@ -1,32 +1,99 @@
+import base64
 import hashlib
+import itertools
+import logging
 import os
+import shutil
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 import six
 import libcloud.security
+from lockfile.mkdirlockfile import MkdirLockFile
+from libcloud.common.types import LibcloudError
+from libcloud.storage.base import Object
 from libcloud.storage.providers import get_driver
 from libcloud.storage.types import ContainerDoesNotExistError, ObjectDoesNotExistError
-from six.moves.urllib.parse import urlparse
+from libcloud.utils.xml import findtext
+from six.moves.urllib.parse import urlencode, urlparse
+
+from .utils import iter_fixed_chunks, IterFile
 
 # Include the current cURL CA bundle as a fallback
 _base_path = os.path.abspath(os.path.dirname(__file__))
 libcloud.security.CA_CERTS_PATH.append(os.path.join(_base_path, 'cacert.pem'))
 
+log = logging.getLogger(__name__)
+
+
+class ConflictError(Exception):
+    """A conditional write failed because the object changed underneath us."""
+
 
 class Sizer(object):
-    def __init__(self):
-        self.size = 0
+    def __init__(self, size=0):
+        self.size = size
 
     def update(self, data):
         self.size += len(data)
 
 
+class Digest(object):
+    """Stand-in for a hashlib object when only the final digest is known."""
+
+    def __init__(self, hexdigest):
+        self._hexdigest = hexdigest
+
+    def hexdigest(self):
+        return self._hexdigest
+
+
+class _FileLock(object):
+    def __init__(self, lock, timeout=30):
+        self.lock = lock
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.lock.acquire(timeout=self.timeout)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+
 class StorageWrapper(object):
-    def __init__(self, uri, no_public=False):
+    # Read size for file uploads
+    READ_SIZE = 1024 * 1024
+    # Objects bigger than one part go up as S3 multipart uploads, S3's minimum part size is 5MB
+    PART_SIZE = 8 * 1024 * 1024
+    # Number of multipart parts in flight at once
+    PART_JOBS = 4
+    # Whether a thread lock is enough for upload_if() to be atomic, only
+    # true of storage that no other process can write to
+    PROCESS_LOCAL = False
+
+    def __init__(self, uri, no_public=False, hash_cache=None, metadata_cache=None):
         self.uri = urlparse(uri)
         self.no_public = no_public
-        self.storage = self._get_storage(self.uri)
+        self.hash_cache = hash_cache
+        self.metadata_cache = metadata_cache
+        # libcloud connections aren't safe to share between threads, so each
+        # thread gets its own container object.
+        self._local = threading.local()
+        self._local.storage = self._get_storage(self.uri)
         self._hashes = {}
+        self._listings = {}  # prefix: set(path)
+        self._lock = threading.Lock()
+        self._part_pool = None
+        self._cas_locks = {}
+        self._cas_warned = False
+
+    @property
+    def storage(self):
+        storage = getattr(self._local, 'storage', None)
+        if storage is None:
+            storage = self._local.storage = self._get_storage(self.uri)
+        return storage
 
     def upload(self, path, data):
         if isinstance(data, six.binary_type):
@@ -34,7 +101,7 @@ class StorageWrapper(object):
             return self.upload(path, (data,))
         elif hasattr(data, 'read'):
             # File-like object
-            def it(size=4096):
+            def it(size=self.READ_SIZE):
                 buf = data.read(size)
                 while buf:
                     yield buf
@@ -42,7 +109,7 @@ class StorageWrapper(object):
             return self.upload(path, it())
         else:
             # Just try iterating
-            self._update_hashes(path, '')
+            hashes = self._new_hashes()
             path_root, path_ext = os.path.splitext(path)
             extra = {}
             if path_ext == '.gz':
@@ -53,51 +120,429 @@ class StorageWrapper(object):
                 if self.uri.scheme.startswith('s3'):
                     extra['acl'] = 'public-read'
                 # Other clouds here
-            return self.storage.upload_object_via_stream((self._update_hashes(path, buf, False) for buf in data), path, extra=extra)
+            # Hashed separately for each upload, so uploads racing to the
+            # same path can't mix their data in one set of hashes
+            data = self._hash_stream(data, hashes)
+            cache_key = self._cache_key(path)
+            cache_writer = None
+            if self.metadata_cache and self.metadata_cache.wants(cache_key):
+                cache_writer = self.metadata_cache.writer(cache_key)
+            if cache_writer:
+                data = self._tee(data, cache_writer)
+            try:
+                if self.uri.scheme.startswith('s3'):
+                    obj = self._upload_s3(path, data, extra)
+                else:
+                    obj = self.storage.upload_object_via_stream(data, path, extra=extra)
+            except Exception:
+                if cache_writer:
+                    cache_writer.abort()
+                raise
+            if cache_writer:
+                if obj is not None:
+                    cache_writer.commit(obj.hash)
+                else:
+                    cache_writer.abort()
+            self._uploaded(path, hashes, obj)
+            return obj
+
+    def _uploaded(self, path, hashes, obj):
+        """Record a finished upload in the listings, hashes and hash cache."""
+        self._hashes[path] = hashes
+        self._update_listing(path)
+        if self.hash_cache and obj is not None:
+            self.hash_cache.set(
+                self._cache_key(path), hashes['size'].size, obj.hash,
+                hashes['md5'].hexdigest(), hashes['sha1'].hexdigest(), hashes['sha256'].hexdigest())
+
+    def _upload_s3(self, path, data, extra):
+        """
+        Small objects go up in a single PUT. Anything bigger than PART_SIZE
+        is sent as a multipart upload with up to PART_JOBS parts in flight.
+        The data is still consumed in order, so the hashes come out the same.
+        """
+        parts = iter_fixed_chunks(data, self.PART_SIZE)
+        first = next(parts, b'')
+        if len(first) < self.PART_SIZE:
+            return self.storage.upload_object_via_stream(iter([first]), path, extra=extra)
+
+        driver = self.storage.driver
+        object_path = driver._get_object_path(self.storage, path)
+        headers = {'Content-Type': extra['content_type']}
+        if extra.get('acl'):
+            headers['x-amz-acl'] = extra['acl']
+        response = driver.connection.request(object_path + '?uploads', method='POST', headers=headers)
+        upload_id = findtext(element=response.object, xpath='UploadId', namespace=driver.namespace)
+        if not upload_id:
+            raise LibcloudError('Unable to start multipart upload of {0}'.format(path), driver=driver)
+
+        part_pool = self._get_part_pool()
+        pending = []
+        etags = []
+        size = 0
+        try:
+            for number, part in enumerate(itertools.chain([first], parts), 1):
+                size += len(part)
+                pending.append(part_pool.apply_async(self._upload_part, (object_path, upload_id, number, part)))
+                # Bound how many parts are held in memory at once
+                while len(pending) > self.PART_JOBS:
+                    etags.append(pending.pop(0).get())
+            etags.extend(result.get() for result in pending)
+            etag = self._complete_multipart(object_path, upload_id, etags)
+        except Exception:
+            driver.connection.request('{0}?{1}'.format(object_path, urlencode({'uploadId': upload_id})), method='DELETE')
+            raise
+        return Object(name=path, size=size, hash=etag.replace('"', ''), extra=extra, meta_data=None,
+                      container=self.storage, driver=driver)
+
+    def _get_part_pool(self):
+        # Shared by every thread uploading, only started once something needs it
+        with self._lock:
+            if self._part_pool is None:
+                self._part_pool = ThreadPool(self.PART_JOBS)
+            return self._part_pool
+
+    def close(self):
+        """Stop the threads multipart uploads ran on, once nothing else is uploading."""
+        with self._lock:
+            part_pool, self._part_pool = self._part_pool, None
+        if part_pool is not None:
+            part_pool.close()
+            part_pool.join()
+
+    def _upload_part(self, object_path, upload_id, number, data):
+        # Runs on the part pool, self.storage is this thread's own connection
+        driver = self.storage.driver
+        headers = {'Content-MD5': base64.b64encode(hashlib.md5(data).digest()).decode('ascii')}
+        params = urlencode({'partNumber': number, 'uploadId': upload_id})
+        response = driver.connection.request('{0}?{1}'.format(object_path, params), method='PUT', data=data, headers=headers)
+        if response.status != 200:
+            raise LibcloudError('Error uploading part {0} of {1}'.format(number, object_path), driver=driver)
+        return number, response.headers['etag']
+
+    def _complete_multipart(self, object_path, upload_id, etags):
+        driver = self.storage.driver
+        body = ['<CompleteMultipartUpload>']
+        for number, etag in sorted(etags):
+            body.append('<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(number, etag))
+        body.append('</CompleteMultipartUpload>')
+        params = urlencode({'uploadId': upload_id})
+        response = driver.connection.request('{0}?{1}'.format(object_path, params), method='POST', data=''.join(body))
+        etag = findtext(element=response.object, xpath='ETag', namespace=driver.namespace)
+        if response.status != 200 or not etag:
+            # S3 can return a 200 with an error document for this one
+            raise LibcloudError('Error completing multipart upload of {0}'.format(object_path), driver=driver)
+        return etag
+
+    def upload_if(self, path, data, etag):
+        """
+        Upload data only if the object's current ETag is still etag, or if
+        etag is None only if the object doesn't exist. Raises ConflictError
+        otherwise. S3 enforces this server-side with If-Match/If-None-Match,
+        local storage with a lock directory. Other storage has no way to do
+        it atomically, there the check only keeps out other threads in this
+        process and a warning is logged, as concurrent publishers from
+        elsewhere can still overwrite each other.
+        """
+        if self.uri.scheme.startswith('s3'):
+            return self._upload_if_s3(path, data, etag)
+        with self._cas_lock(path):
+            try:
+                current = self.storage.get_object(path).hash
+            except ObjectDoesNotExistError:
+                current = None
+            if current != etag:
+                raise ConflictError('{0} has been modified'.format(path))
+            return self.upload(path, data)
+
+    def _cas_lock(self, path):
+        if self.uri.scheme == 'local':
+            # Lock directories go under a .lock folder, which the local driver leaves out of listings
+            driver = self.storage.driver
+            lock_path = os.path.join(driver.base_path, self.storage.name, '.lock', path.replace('/', '_'))
+            if not os.path.isdir(os.path.dirname(lock_path)):
+                try:
+                    os.makedirs(os.path.dirname(lock_path))
+                except OSError:
+                    pass
+            return _FileLock(MkdirLockFile(lock_path, threaded=True))
+        with self._lock:
+            if not self.PROCESS_LOCAL and not self._cas_warned:
+                self._cas_warned = True
+                log.warning('%s:// storage has no conditional writes, publishing from more than one place at once is not safe', self.uri.scheme)
+            return self._cas_locks.setdefault(path, threading.Lock())
+
+    def _upload_if_s3(self, path, data, etag):
+        # Conditional writes are a single PUT, so no streaming or multipart here
+        if hasattr(data, 'read'):
+            data = data.read()
+        driver = self.storage.driver
+        hashes = self._new_hashes()
+        for buf in self._hash_stream([data], hashes):
+            pass
+        headers = {'Content-Type': 'application/x-gzip' if path.endswith('.gz') else 'text/plain'}
+        if etag is None:
+            headers['If-None-Match'] = '*'
+        else:
+            headers['If-Match'] = '"{0}"'.format(etag)
+        if not self.no_public:
+            headers['x-amz-acl'] = 'public-read'
+        try:
+            response = driver.connection.request(driver._get_object_path(self.storage, path), method='PUT', data=data, headers=headers)
+        except LibcloudError as e:
+            # Non-2xx codes libcloud doesn't expect come back as a generic error
+            if 'Status code: 412' in str(e):
+                raise ConflictError('{0} has been modified'.format(path))
+            raise
+        if response.status in (409, 412):
+            raise ConflictError('{0} has been modified'.format(path))
+        elif response.status != 200:
+            raise LibcloudError('Error uploading {0}, status code {1}'.format(path, response.status), driver=driver)
+        obj = Object(name=path, size=len(data), hash=response.headers['etag'].replace('"', ''), extra={}, meta_data=None,
+                     container=self.storage, driver=driver)
+        cache_key = self._cache_key(path)
+        if self.metadata_cache and self.metadata_cache.wants(cache_key):
+            cache_writer = self.metadata_cache.writer(cache_key)
+            cache_writer.write(data)
+            cache_writer.commit(obj.hash)
+        self._uploaded(path, hashes, obj)
+        return obj
+
+    def copy(self, src, dst):
+        """
+        Copy an object within the container. S3 and local storage copy
+        server-side so the data never comes through here, anything else
+        falls back to streaming it down and back up.
+        """
+        if self.uri.scheme.startswith('s3'):
+            self._copy_s3(src, dst)
+        elif self.uri.scheme == 'local':
+            driver = self.storage.driver
+            base_path = os.path.join(driver.base_path, self.storage.name)
+            dst_path = os.path.join(base_path, dst)
+            if not os.path.isdir(os.path.dirname(dst_path)):
+                os.makedirs(os.path.dirname(dst_path))
+            shutil.copyfile(os.path.join(base_path, src), dst_path)
+        else:
+            data = self.download_iter(src, skip_hash=True)
+            if data is None:
+                raise ObjectDoesNotExistError(value=None, driver=self.storage.driver, object_name=src)
+            self.upload(dst, data)
+            return
+        if src in self._hashes:
+            self._hashes[dst] = self._hashes[src]
+        self._update_listing(dst)
+
+    def _copy_s3(self, src, dst):
+        driver = self.storage.driver
+        headers = {'x-amz-copy-source': driver._get_object_path(self.storage, src)}
+        if not self.no_public:
+            headers['x-amz-acl'] = 'public-read'
+        response = driver.connection.request(driver._get_object_path(self.storage, dst), method='PUT', headers=headers)
+        # A copy can fail after S3 has already sent a 200, the error is in the body
+        if response.status != 200 or response.object is None or not response.object.tag.endswith('CopyObjectResult'):
+            raise LibcloudError('Error copying {0} to {1}'.format(src, dst), driver=driver)
+
+    def set_hashes(self, path, size, md5, sha1, sha256):
+        """Record already known hashes for an object, e.g. from an index, so hashes() doesn't need to fetch it."""
+        self._hashes[path] = {
+            'md5': Digest(md5),
+            'sha1': Digest(sha1),
+            'sha256': Digest(sha256),
+            'size': Sizer(int(size)),
+        }
+
+    def delete(self, path):
+        try:
+            obj = self.storage.get_object(path)
+        except ObjectDoesNotExistError:
+            return False
+        self.storage.delete_object(obj)
+        self._update_listing(path, exists=False)
+        return True
+
+    def record_etags(self, paths, etags):
+        """Record the current ETag of each path in etags without downloading it, None if it doesn't exist."""
+        for path in paths:
+            try:
+                etags[path] = self.storage.get_object(path).hash
+            except ObjectDoesNotExistError:
+                etags[path] = None
 
-    def download(self, path, skip_hash=False):
+    def download(self, path, skip_hash=False, etags=None):
         # Assumption, this isn't a big file
-        it = self.download_iter(path, skip_hash)
+        it = self.download_iter(path, skip_hash, etags)
         if it:
             return ''.join(it)
 
-    def download_iter(self, path, skip_hash=False):
+    def download_iter(self, path, skip_hash=False, etags=None):
+        """Stream an object, or None if it doesn't exist. The ETag seen is recorded in the etags dict if given, for upload_if()."""
         try:
             obj = self.storage.get_object(path)
         except ObjectDoesNotExistError:
+            obj = None
+        if etags is not None:
+            etags[path] = obj.hash if obj else None
+        if obj is None:
             return None
-        if not skip_hash:
-            self._update_hashes(path, '')
-        return (
-            buf if skip_hash else self._update_hashes(path, buf, False)
-            for buf in self.storage.download_object_as_stream(obj)
-        )
+        data = self._download_object(path, obj)
+        if skip_hash:
+            return data
+        return self._hash_stream(data, self._new_hashes(), path)
 
-    def __contains__(self, path):
+    def _download_object(self, path, obj):
+        """Stream an object's data, from the metadata cache if it has an unchanged copy."""
+        key = self._cache_key(path)
+        if not (self.metadata_cache and self.metadata_cache.wants(key)):
+            for buf in self.storage.download_object_as_stream(obj):
+                yield buf
+            return
+        cached = self.metadata_cache.get(key, obj.size, obj.hash)
+        if cached:
+            with cached:
+                buf = cached.read(self.READ_SIZE)
+                while buf:
+                    yield buf
+                    buf = cached.read(self.READ_SIZE)
+            return
+        cache_writer = self.metadata_cache.writer(key)
         try:
-            self.storage.get_object(path)
-            return True
-        except ObjectDoesNotExistError:
-            return False
+            for buf in self._tee(self.storage.download_object_as_stream(obj), cache_writer):
+                yield buf
+        except BaseException:
+            # Including GeneratorExit if the caller stops early
+            cache_writer.abort()
+            raise
+        cache_writer.commit(obj.hash)
+
+    @staticmethod
+    def _tee(data, fileobj):
+        for buf in data:
+            fileobj.write(buf)
+            yield buf
+
+    def __contains__(self, path):
+        return path in self.exists([path])
+
+    def exists(self, paths):
+        """
+        Return the subset of paths that exist in storage. Paths are grouped by
+        directory and each directory with more than one path is answered by a
+        single prefix listing, which is cached for the life of this object.
+        """
+        found = set()
+        by_prefix = {}
+        for path in paths:
+            listing = self._find_listing(path)
+            if listing is not None:
+                if path in listing:
+                    found.add(path)
+            else:
+                dirname = os.path.dirname(path)
+                by_prefix.setdefault(dirname + '/' if dirname else '', []).append(path)
+        for prefix, prefix_paths in six.iteritems(by_prefix):
+            # Not worth a listing for one object
+            listing = self._list_prefix(prefix) if len(prefix_paths) > 1 else None
+            if listing is not None:
+                found.update(path for path in prefix_paths if path in listing)
+                continue
+            for path in prefix_paths:
+                try:
+                    self.storage.get_object(path)
+                    found.add(path)
+                except ObjectDoesNotExistError:
+                    pass
+        return found
+
+    def _find_listing(self, path):
+        with self._lock:
+            for prefix, listing in six.iteritems(self._listings):
+                if path.startswith(prefix):
+                    return listing
+
+    def _list_prefix(self, prefix):
+        """
+        List everything under prefix, or return None if the driver can only
+        list the whole container, in which case checking each path is cheaper.
+        """
+        if self.uri.scheme == 'local':
+            base_path = os.path.join(self.storage.driver.base_path, self.storage.name)
+            listing = set()
+            for dirpath, dirnames, filenames in os.walk(os.path.join(base_path, prefix)):
+                # Lock directories, see _cas_lock()
+                dirnames[:] = [name for name in dirnames if name != '.lock']
+                rel = os.path.relpath(dirpath, base_path)
+                listing.update(name if rel == '.' else '{0}/{1}'.format(rel.replace(os.sep, '/'), name) for name in filenames)
+        else:
+            try:
+                objects = self.storage.driver.list_container_objects(self.storage, ex_prefix=prefix)
+            except TypeError:
+                # No server-side prefix filter
+                return None
+            listing = set(obj.name for obj in objects if obj.name.startswith(prefix))
+        with self._lock:
+            self._listings[prefix] = listing
+        return listing
+
+    def _update_listing(self, path, exists=True):
+        listing = self._find_listing(path)
+        if listing is not None:
+            with self._lock:
+                if exists:
+                    listing.add(path)
+                else:
+                    listing.discard(path)
 
-    def _update_hashes(self, path, data, reset=True):
-        if reset or path not in self._hashes:
-            self._hashes[path] = {
-                'md5': hashlib.md5(),
-                'sha1': hashlib.sha1(),
-                'sha256': hashlib.sha256(),
-                'size': Sizer(),
-            }
-        if data:
-            for hasher in six.itervalues(self._hashes[path]):
-                hasher.update(data)
-        return data
+    @staticmethod
+    def _new_hashes():
+        return {
+            'md5': hashlib.md5(),
+            'sha1': hashlib.sha1(),
+            'sha256': hashlib.sha256(),
+            'size': Sizer(),
+        }
+
+    def _hash_stream(self, data, hashes, path=None):
+        """Pass data through, updating hashes. Given a path they are recorded for it once the data is finished."""
+        for buf in data:
+            for hasher in six.itervalues(hashes):
+                hasher.update(buf)
+            yield buf
+        if path is not None:
+            self._hashes[path] = hashes
 
     def hashes(self, path):
-        if path not in self._hashes:
-            self._update_hashes(path, '')
+        if path not in self._hashes and not (self.hash_cache and self._cached_hashes(path)):
+            self._hashes[path] = self._new_hashes()
         return self._hashes[path]
 
+    def _cache_key(self, path):
+        # Deliberately leaves out any credentials in the URI
+        return '{0}://{1}{2}/{3}'.format(self.uri.scheme, self.uri.hostname or '', self.uri.path.rstrip('/'), path)
+
+    def _cached_hashes(self, path):
+        """
+        Fill in the hashes for an object we didn't upload this run, from the
+        hash cache if it is still valid for the object and otherwise by
+        hashing a download of it. Returns False if the object doesn't exist.
+        """
+        try:
+            obj = self.storage.get_object(path)
+        except ObjectDoesNotExistError:
+            return False
+        entry = self.hash_cache.get(self._cache_key(path), obj.size, obj.hash)
+        if entry:
+            self.set_hashes(path, entry['size'], entry['md5'], entry['sha1'], entry['sha256'])
+        else:
+            hashes = self._new_hashes()
+            for buf in self._hash_stream(self.storage.download_object_as_stream(obj), hashes):
+                pass
+            self._hashes[path] = hashes
+            self.hash_cache.set(
+                self._cache_key(path), obj.size, obj.hash,
+                hashes['md5'].hexdigest(), hashes['sha1'].hexdigest(), hashes['sha256'].hexdigest())
+        return True
+
     @classmethod
     def file(cls, uri_or_path):
         """
@@ -118,6 +563,20 @@ class StorageWrapper(object):
             tmp.seek(0, 0)
             return tmp
 
+    @classmethod
+    def stream(cls, uri_or_path):
+        """
+        Like file(), but remote objects are streamed as they are read rather
+        than copied to a temporary file first. The result is not seekable.
+        """
+        uri = urlparse(uri_or_path)
+        if not uri.scheme:
+            return open(uri_or_path, 'rb')
+        it = cls(uri_or_path).download_iter(uri.path.lstrip('/'), skip_hash=True)
+        if not it:
+            raise ValueError('{0} not found'.format(uri_or_path))
+        return IterFile(it)
+
     @classmethod
     def _get_storage(cls, uri):
         """
@@ -16,9 +16,28 @@
 # limitations under the License.
 #
 
+import bz2
+import functools
 import gzip
+import hashlib
+import itertools
+import sys
+import tempfile
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import six
+from six.moves import queue
 
 
 def gzip_compress(data, filename='<data>'):
@@ -27,3 +46,284 @@ def gzip_compress(data, filename='<data>'):
     gz.write(data)
     gz.close()
     return gz_data.getvalue()
+
+
+def decompress(data, ext):
+    """Decompress an in-memory blob based on its file extension."""
+    if ext == '.gz':
+        return gzip.GzipFile(fileobj=six.BytesIO(data), mode='rb').read()
+    elif ext == '.bz2':
+        return bz2.decompress(data)
+    elif ext in ('.xz', '.lzma'):
+        if not lzma:
+            raise ValueError('lzma support is not available')
+        return lzma.decompress(data)
+    elif ext == '.zst':
+        if not zstandard:
+            raise ValueError('zstd support requires the zstandard package')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif not ext:
+        return data
+    raise ValueError('Unknown encoding {0}'.format(repr(ext)))
+
+
+class IdentityDecompressor(object):
+    def decompress(self, data):
+        return data
+
+
+def decompressor(ext):
+    """Return an object with a decompress() method to incrementally decode data with the given file extension."""
+    if ext == '.gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif ext == '.bz2':
+        return bz2.BZ2Decompressor()
+    elif ext in ('.xz', '.lzma'):
+        if not lzma:
+            raise ValueError('lzma support is not available')
+        return lzma.LZMADecompressor()
+    elif ext == '.zst':
+        if not zstandard:
+            raise ValueError('zstd support requires the zstandard package')
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif not ext:
+        return IdentityDecompressor()
+    raise ValueError('Unknown encoding {0}'.format(repr(ext)))
+
+
+def iter_lines(chunks):
+    """Split an iterable of byte strings in to lines, without the newlines."""
+    buf = b''
+    for chunk in chunks:
+        lines = (buf + chunk).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line
+    if buf:
+        yield buf
+
+
+def iter_decompress(chunks, ext):
+    """Decompress an iterable of byte strings as a stream, handling concatenated gzip/bzip2/xz members."""
+    decoder = decompressor(ext)
+    for chunk in chunks:
+        while chunk:
+            data = decoder.decompress(chunk)
+            if data:
+                yield data
+            # Anything past the end of a member starts another one
+            chunk = getattr(decoder, 'unused_data', b'')
+            if chunk:
+                decoder = decompressor(ext)
+    flush = getattr(decoder, 'flush', None)
+    if flush:
+        data = flush()
+        if data:
+            yield data
+
+
+# Leading bytes of each compressed format open_decompressed() understands
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', '.gz'),
+    (b'BZh', '.bz2'),
+    (b'\xfd7zXZ\x00', '.xz'),
+    (b'\x28\xb5\x2f\xfd', '.zst'),
+]
+
+
+def open_decompressed(fileobj, read_size=64*1024):
+    """
+    Wrap a file, which doesn't need to be seekable, so reads from it are
+    decompressed if it holds gzip, bzip2, xz or zstd data. The format is
+    found from the first few bytes rather than a file extension.
+    """
+    head = fileobj.read(8)
+    chunks = itertools.chain([head], iter(functools.partial(fileobj.read, read_size), b''))
+    for magic, ext in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return IterFile(iter_decompress(chunks, ext))
+    return IterFile(chunks)
+
+
+def iter_fixed_chunks(chunks, size):
+    """Regroup an iterable of byte strings in to chunks of exactly size bytes, except the last."""
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+        while buf_len >= size:
+            data = b''.join(buf)
+            yield data[:size]
+            buf = [data[size:]]
+            buf_len -= size
+    if buf_len:
+        yield b''.join(buf)
+
+
+class ReplayFile(object):
+    """
+    Wrap a file, which doesn't need to be seekable, and remember everything
+    read from it so the whole stream can be iterated again from the start
+    without a second read of the underlying file.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.buffer = []
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.buffer.append(data)
+        return data
+
+    def replay(self, chunk_size=1024*1024):
+        buffer, self.buffer = self.buffer, []
+        for data in buffer:
+            if data:
+                yield data
+        data = self.fileobj.read(chunk_size)
+        while data:
+            yield data
+            data = self.fileobj.read(chunk_size)
+
+
+class IterFile(object):
+    """Minimal read-only file object over an iterator of byte strings."""
+
+    def __init__(self, it):
+        self.it = iter(it)
+        self.buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.it, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        if size < 0:
+            data, self.buf = self.buf, b''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def close(self):
+        close = getattr(self.it, 'close', None)
+        if close:
+            close()
+
+
+class CompressorFile(object):
+    """Adapt a bz2/lzma style compressor object to a writable file."""
+
+    def __init__(self, compressor, fileobj):
+        self.compressor = compressor
+        self.fileobj = fileobj
+
+    def write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def close(self):
+        if self.compressor:
+            self.fileobj.write(self.compressor.flush())
+
+
+class HashingFile(object):
+    """Pass writes through to a file, keeping a hash and count of everything written."""
+
+    def __init__(self, fileobj, hash_type='sha1'):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(hash_type)
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def open_encoder(ext, fileobj):
+    """Return a writable file that encodes data for the given file extension into fileobj."""
+    if ext == '.gz':
+        return gzip.GzipFile('<data>', 'wb', fileobj=fileobj)
+    elif ext == '.bz2':
+        return CompressorFile(bz2.BZ2Compressor(), fileobj)
+    elif ext in ('.lzma', '.xz'):
+        if not lzma:
+            raise ValueError('lzma support is not available')
+        return CompressorFile(lzma.LZMACompressor(), fileobj)
+    elif not ext:
+        return CompressorFile(None, fileobj)
+    raise ValueError('Unknown encoding {0}'.format(repr(ext)))
+
+
+class EncoderThread(threading.Thread):
+    """Encode chunks pulled off a queue into a spooled temporary file."""
+
+    def __init__(self, ext, spool_size):
+        super(EncoderThread, self).__init__()
+        self.daemon = True
+        self.ext = ext
+        self.queue = queue.Queue(maxsize=8)
+        self.fileobj = tempfile.SpooledTemporaryFile(spool_size)
+        self.exc_info = None
+
+    def run(self):
+        try:
+            encoder = open_encoder(self.ext, self.fileobj)
+            for chunk in iter(self.queue.get, None):
+                encoder.write(chunk)
+            encoder.close()
+        except Exception:
+            self.exc_info = sys.exc_info()
+            # Keep draining so the producer never blocks on a dead thread
+            for chunk in iter(self.queue.get, None):
+                pass
+
+
+def encode_streams(chunks, extensions, spool_size=16*1024*1024, buffer_size=64*1024):
+    """
+    Encode a single stream of chunks in to several formats at once, like
+    ['', '.gz', '.bz2']. The input is only iterated once and each encoder
+    runs in its own thread, since zlib, bz2 and lzma all release the GIL.
+    Returns a list of (extension, fileobj) with each file rewound to the
+    start. Output larger than spool_size is spilled to disk.
+    """
+    threads = [EncoderThread(ext, spool_size) for ext in extensions]
+    for thread in threads:
+        thread.start()
+
+    def feed(data):
+        for thread in threads:
+            thread.queue.put(data)
+
+    try:
+        buf = []
+        buf_len = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            buf_len += len(chunk)
+            if buf_len >= buffer_size:
+                feed(b''.join(buf))
+                buf = []
+                buf_len = 0
+        if buf:
+            feed(b''.join(buf))
+    finally:
+        feed(None)
+        for thread in threads:
+            thread.join()
+    for thread in threads:
+        if thread.exc_info:
+            six.reraise(*thread.exc_info)
+    results = []
+    for thread in threads:
+        thread.fileobj.seek(0, 0)
+        results.append((thread.ext, thread.fileobj))
+    return results
@@ -20,3 +20,5 @@ from .filelists import YumFileLists  # noqa
 from .other import YumOther  # noqa
 from .primary import YumPrimary  # noqa
 from .repomd import YumRepoMD  # noqa
+from .repository import YumRepository  # noqa
+from .rpm import RpmPackage  # noqa
@@ -17,15 +17,183 @@
 #
 
 import collections
+import itertools
+import re
+import tempfile
+import threading
 
 from defusedxml import lxml
+from lxml import etree
 from lxml.builder import ElementMaker
 from lxml.etree import QName
 import six
 
+from ..utils import HashingFile, IterFile, open_decompressed, open_encoder
+
+# Enough XML to find the <package> blocks in a metadata file without parsing it
+RAW_DECLARATION_RE = re.compile(br'^\s*<\?xml[^>]*?(?:encoding=["\']([\w-]+)["\'])?[^>]*\?>')
+RAW_ROOT_RE = re.compile(br'<([\w.-]+)(?:\s[^>]*)?>')
+RAW_PACKAGE_START_RE = re.compile(br'<package[\s>]')
+RAW_PACKAGE_END = b'</package>'
+RAW_PACKAGE_START_TAG_RE = re.compile(br'<package(\s[^>]*)?>')
+RAW_VERSION_RE = re.compile(br'<version(\s[^>]*?)/?>')
+RAW_ATTRIB_RE = re.compile(br'([\w:-]+)=(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def copy_attrib(elm):
+    """Copy the attributes of an element, so values don't keep the element itself alive once it is discarded."""
+    return collections.OrderedDict(elm.attrib.items())
+
+
+def raw_text(data):
+    """Decode text pulled out of raw XML, or None if it would need unescaping."""
+    if data is None or b'&' in data:
+        return None
+    return data.decode('utf-8')
+
+
+def raw_attrib(data):
+    """Parse the attributes in a raw start tag, or None if any would need unescaping."""
+    attrib = collections.OrderedDict()
+    for key, double, single in RAW_ATTRIB_RE.findall(data):
+        value = raw_text(double or single)
+        if value is None:
+            return None
+        attrib[key.decode('utf-8')] = value
+    return attrib
+
+
+def raw_package_fields(data):
+    """
+    The pkgid, name, arch and version of a raw filelists or other <package>
+    block, or None if they can't be read without parsing it.
+    """
+    start = RAW_PACKAGE_START_TAG_RE.match(data)
+    version = RAW_VERSION_RE.search(data)
+    if not start or not version:
+        return None
+    fields = raw_attrib(start.group(1))
+    version = raw_attrib(version.group(1))
+    if fields is None or version is None or not all(key in fields for key in ('pkgid', 'name', 'arch')):
+        return None
+    fields['version'] = version
+    return fields
+
+
+class YumRawSpool(object):
+    """
+    Where the YumRawPackages of a metadata file keep their bytes, in memory
+    up to max_size and spilled to disk past that.
+    """
+
+    def __init__(self, max_size=16*1024*1024):
+        self.fileobj = tempfile.SpooledTemporaryFile(max_size)
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        """Store data, returning its offset."""
+        with self._lock:
+            offset = self.size
+            self.fileobj.seek(offset)
+            self.fileobj.write(data)
+            self.size += len(data)
+            return offset
+
+    def read(self, offset, length):
+        with self._lock:
+            self.fileobj.seek(offset)
+            return self.fileobj.read(length)
+
+
+class YumRawPackage(object):
+    """
+    A <package> block kept as the bytes it was read as, see
+    YumMeta.iter_packages(), in memory or given a spool in that. The few
+    fields needed to key it come from PackageClass.raw_fields(), reading
+    anything else parses it in to a PackageClass which is dropped again
+    afterwards. Setting a field keeps the parsed package, which it then
+    stands in for. Until then it is encoded as the original bytes.
+    """
+
+    def __init__(self, package_class, data, fields, root_start, root_end, spool=None):
+        self.package_class = package_class
+        self.fields = fields
+        self._root = (root_start, root_end)
+        self._package = None
+        self._spool = spool
+        if spool is None:
+            self._data = data
+        else:
+            self._data = (spool.write(data), len(data))
+
+    @property
+    def data(self):
+        """The original bytes, or None once it has been changed."""
+        if self._package is not None:
+            return None
+        if self._spool is None:
+            return self._data
+        return self._spool.read(*self._data)
+
+    @property
+    def package(self):
+        """The parsed package. Parsed afresh each time until it is changed, so nothing holds on to it."""
+        if self._package is not None:
+            return self._package
+        root = lxml.fromstring(self._root[0] + self.data + self._root[1])
+        return self.package_class.from_element(root[0])
+
+    @property
+    def materialized(self):
+        return self._package is not None
+
+    def materialize(self):
+        """Keep the parsed package from now on, returning it to be changed in place."""
+        if self._package is None:
+            self._package = self.package
+            self._data = self._spool = None
+        return self._package
+
+    def __getitem__(self, key):
+        if self._package is None and key in self.fields:
+            return self.fields[key]
+        return self.package[key]
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+
+    def __contains__(self, key):
+        return key in self.package
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._package is None and name in self.fields:
+            return self.fields[name]
+        return getattr(self.package, name)
+
+    def full_version(self):
+        return '{epoch}:{ver}-{rel}'.format(**self['version'])
+
+    def to_element(self, E):
+        return self.package.to_element(E)
+
 
 class YumMeta(collections.OrderedDict):
     nsmap = {}
+    XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+    # Set by metadata made of a list of packages, which is then loaded one
+    # package at a time, see iter_packages()
+    PackageClass = None
+    # Raw package bytes past this are spooled to disk, see from_file()
+    RAW_SPOOL_SIZE = 16 * 1024 * 1024
 
     def __init__(self, *args, **kwargs):
         self.filename = kwargs.pop('filename') if 'filename' in kwargs else None
@@ -33,24 +201,181 @@ class YumMeta(collections.OrderedDict):
 
     @classmethod
     def from_file(cls, filename=None, fileobj=None, *args, **kwargs):
-        fileobj = fileobj or open(filename, 'rb')
+        """
+        Load a metadata file. With raw=True, metadata made of packages keeps
+        each one as a YumRawPackage, see iter_packages(), with their bytes
+        in a YumRawSpool.
+        """
+        raw = kwargs.pop('raw', False)
+        if cls.PackageClass is None:
+            fileobj = open_decompressed(fileobj or open(filename, 'rb'))
+            kwargs['filename'] = filename
+            kwargs['root'] = lxml.parse(fileobj)
+            return cls.from_element(*args, **kwargs)
         kwargs['filename'] = filename
-        kwargs['root'] = lxml.parse(fileobj)
-        return cls.from_element(*args, **kwargs)
+        self = cls(*args, **kwargs)
+        spool = YumRawSpool(cls.RAW_SPOOL_SIZE) if raw else None
+        for pkg in cls.iter_packages(filename, fileobj, raw=raw, spool=spool):
+            self.add_package(pkg)
+        return self
+
+    @classmethod
+    def iter_packages(cls, filename=None, fileobj=None, raw=False, spool=None):
+        """
+        Yield the packages in a metadata file one at a time without building
+        the whole document in memory. Each <package> element is discarded
+        once it has been turned in to a PackageClass. The file can be gzip,
+        bzip2, xz or zstd compressed.
+
+        With raw=True the packages aren't parsed at all. Each <package> block
+        is cut out of the file as bytes and yielded as a YumRawPackage, which
+        iter_encode() writes back out verbatim, so loading and re-encoding
+        only costs as much as the packages that are actually looked at.
+        Given a YumRawSpool their bytes are kept there.
+        """
+        fileobj = open_decompressed(fileobj or open(filename, 'rb'))
+        if raw:
+            for pkg in cls.iter_raw_packages(fileobj, spool=spool):
+                yield pkg
+            return
+        # Entities are never expanded and nothing is fetched, the same
+        # protection defusedxml gives lxml.parse()
+        for event, elm in etree.iterparse(fileobj, events=('end',), tag='{*}package', resolve_entities=False, no_network=True):
+            yield cls.PackageClass.from_element(elm)
+            elm.clear()
+            # Drop the references the root holds to finished packages
+            while elm.getprevious() is not None:
+                del elm.getparent()[0]
+
+    @classmethod
+    def iter_raw_packages(cls, fileobj, read_size=64*1024, spool=None):
+        """
+        The raw=True half of iter_packages(), given a decompressed file.
+        Anything that can't be passed through verbatim, a DOCTYPE, another
+        encoding or namespaces that don't match nsmap, falls back to parsing.
+        """
+        buf = b''
+        root = None
+        while root is None:
+            data = fileobj.read(read_size)
+            buf += data
+            decl = RAW_DECLARATION_RE.match(buf)
+            start = decl.end() if decl else 0
+            if b'<!' in buf[start:buf.find(b'<', start) + 2]:
+                break
+            root = RAW_ROOT_RE.search(buf, start)
+            if not data:
+                break
+        if root is None or (decl and (decl.group(1) or b'UTF-8').upper() not in (b'UTF-8', b'UTF8')):
+            root_elm = None
+        else:
+            root_start, root_end = root.group(0), '</{0}>'.format(root.group(1).decode('utf-8')).encode('utf-8')
+            root_elm = lxml.fromstring(root_start + root_end) if not root_start.endswith(b'/>') else None
+        if root_elm is None or dict(root_elm.nsmap) != cls.nsmap:
+            # Parse it after all, starting over with what has been read so far
+            chunks = itertools.chain([buf], iter(lambda: fileobj.read(read_size), b''))
+            for pkg in cls.iter_packages(fileobj=IterFile(chunks)):
+                yield pkg
+            return
+
+        count = 0
+        buf = buf[root.end():]
+        eof = False
+        while True:
+            match = RAW_PACKAGE_START_RE.search(buf)
+            end = buf.find(RAW_PACKAGE_END, match.start()) if match else -1
+            if end == -1:
+                if eof:
+                    break
+                data = fileobj.read(read_size)
+                eof = not data
+                # Only keep from a package start that might still be coming
+                buf = buf[match.start() if match else max(len(buf) - len(b'<package '), 0):] + data
+                continue
+            data = buf[match.start():end + len(RAW_PACKAGE_END)]
+            buf = buf[end + len(RAW_PACKAGE_END):]
+            fields = None if b'<!' in data else cls.PackageClass.raw_fields(data)
+            if fields is None:
+                # Comments or CDATA, or fields that need unescaping
+                pkg = YumRawPackage(cls.PackageClass, data, {}, root_start, root_end).package
+            else:
+                pkg = YumRawPackage(cls.PackageClass, data, fields, root_start, root_end, spool)
+            count += 1
+            yield pkg
+        if 'packages' in root_elm.attrib and int(root_elm.attrib['packages']) != count:
+            raise ValueError('Expected {0} packages, found {1}'.format(root_elm.attrib['packages'], count))
 
     @classmethod
     def from_element(cls, root, *args, **kwargs):
+        if cls.PackageClass is None:
+            raise NotImplementedError
+        self = cls(*args, **kwargs)
+        for elm in root.findall('{*}package'):
+            self.add_package(cls.PackageClass.from_element(elm))
+        return self
+
+    def add_package(self, pkg):
         raise NotImplementedError
 
     def to_element(self, E):
+        return self.root_to_element(E, [pkg.to_element(E) for pkg in six.itervalues(self)])
+
+    def root_to_element(self, E, sub):
         raise NotImplementedError
 
+    def iter_encode(self):
+        """
+        Yield the encoded document a package at a time, so neither the whole
+        tree nor the whole output is ever in memory. Byte for byte the same
+        as serializing to_element() in one go.
+        """
+        E = ElementMaker(nsmap=self.nsmap)
+        yield self.XML_DECLARATION
+        if self.PackageClass is None or not self:
+            yield lxml.tostring(self.to_element(E), encoding='UTF-8', xml_declaration=False)
+            return
+        # Each package is serialized inside the real root element so it
+        # picks up the namespace declarations from there instead of
+        # repeating them, then only its own part of the output is kept
+        root = self.root_to_element(E, [])
+        root.text = ''
+        data = lxml.tostring(root, encoding='UTF-8', xml_declaration=False)
+        start = data[:data.index(b'>') + 1]
+        end = data[len(start):]
+        yield start
+        for pkg in six.itervalues(self):
+            if isinstance(pkg, YumRawPackage) and not pkg.materialized:
+                # Untouched since it was read, pass it through
+                yield pkg.data
+                continue
+            root.append(pkg.to_element(E))
+            data = lxml.tostring(root, encoding='UTF-8', xml_declaration=False)
+            del root[0]
+            yield data[len(start):-len(end)]
+        yield end
+
     def encode(self):
-        return lxml.tostring(
-            self.to_element(ElementMaker(nsmap=self.nsmap)),
-            xml_declaration=True,
-            encoding='UTF-8',
-        )
+        return b''.join(self.iter_encode())
+
+    def write(self, fileobj, ext='.gz'):
+        """
+        Stream the encoded document in to fileobj, compressed for the given
+        file extension. Returns the checksum, size, open-size and
+        open-checksum fields for its YumRepoMDData, all worked out on the way
+        through.
+        """
+        compressed = HashingFile(fileobj)
+        encoder = open_encoder(ext, compressed)
+        encoded = HashingFile(encoder)
+        for chunk in self.iter_encode():
+            encoded.write(chunk)
+        encoder.close()
+        return collections.OrderedDict([
+            ('checksum', compressed.hexdigest()),
+            ('size', str(compressed.size)),
+            ('open-size', str(encoded.size)),
+            ('open-checksum', encoded.hexdigest()),
+        ])
 
 
 class YumData(collections.OrderedDict):
@@ -0,0 +1,214 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import os
+import sqlite3
+
+import six
+
+from ..utils import HashingFile, iter_decompress, open_encoder
+
+
+class YumDatabase(object):
+    """
+    One of the sqlite databases yum can use instead of parsing the XML
+    metadata, in the createrepo version 10 schema. Packages are added and
+    removed by pkgid, with triggers cleaning up the rows that belong to them.
+    """
+    VERSION = 10
+    SCHEMA = []
+
+    def __init__(self, path, create=False):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = six.text_type
+        if create:
+            self.conn.execute('CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)')
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+            self.conn.execute('INSERT INTO db_info VALUES (?, ?)', (self.VERSION, ''))
+
+    @classmethod
+    def from_chunks(cls, path, chunks, ext='.bz2'):
+        """Write out a downloaded database, returning None unless it is the current schema."""
+        with open(path, 'wb') as f:
+            for data in iter_decompress(chunks, ext):
+                f.write(data)
+        self = cls(path)
+        try:
+            version, checksum = self.info()
+        except sqlite3.DatabaseError:
+            version = None
+        if version != self.VERSION:
+            self.conn.close()
+            return None
+        return self
+
+    def info(self):
+        """Return (dbversion, checksum), the checksum being that of the XML the database matches."""
+        return self.conn.execute('SELECT dbversion, checksum FROM db_info').fetchone()
+
+    def remove_package(self, pkgid):
+        self.conn.execute('DELETE FROM packages WHERE pkgId = ?', (pkgid,))
+
+    def add_package(self, pkg):
+        raise NotImplementedError
+
+    def insert_package(self, values):
+        """Insert a row in to packages, returning its pkgKey."""
+        sql = 'INSERT INTO packages VALUES (NULL{0})'.format(', ?' * len(values))
+        return self.conn.execute(sql, values).lastrowid
+
+    def write(self, fileobj, checksum, ext='.bz2'):
+        """
+        Record the checksum of the matching XML, then stream the database in
+        to fileobj compressed for the given file extension. Returns the
+        checksum, size, open-size and open-checksum fields for its
+        YumRepoMDData.
+        """
+        self.conn.execute('UPDATE db_info SET checksum = ?', (checksum,))
+        self.conn.commit()
+        self.conn.close()
+        compressed = HashingFile(fileobj)
+        encoder = open_encoder(ext, compressed)
+        encoded = HashingFile(encoder)
+        with open(self.path, 'rb') as f:
+            for data in iter(lambda: f.read(64*1024), b''):
+                encoded.write(data)
+        encoder.close()
+        return collections.OrderedDict([
+            ('checksum', compressed.hexdigest()),
+            ('size', str(compressed.size)),
+            ('open-size', str(encoded.size)),
+            ('open-checksum', encoded.hexdigest()),
+        ])
+
+
+def dependency_rows(entries, pkg_key, pre=False):
+    for entry in entries or []:
+        row = [entry.get('name'), entry.get('flags'), entry.get('epoch'), entry.get('ver'), entry.get('rel'), pkg_key]
+        if pre:
+            row.append('TRUE' if entry.get('pre') in ('1', 'true', 'TRUE') else 'FALSE')
+        yield row
+
+
+def to_int(value):
+    return int(value) if value else None
+
+
+class YumPrimaryDatabase(YumDatabase):
+    DEPENDENCIES = ['provides', 'conflicts', 'obsoletes']
+    SCHEMA = [
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, version TEXT, epoch TEXT, '
+        'release TEXT, summary TEXT, description TEXT, url TEXT, time_file INTEGER, time_build INTEGER, rpm_license TEXT, '
+        'rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT, rpm_sourcerpm TEXT, rpm_header_start INTEGER, '
+        'rpm_header_end INTEGER, rpm_packager TEXT, size_package INTEGER, size_installed INTEGER, size_archive INTEGER, '
+        'location_href TEXT, location_base TEXT, checksum_type TEXT)',
+        'CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER)',
+        'CREATE TABLE requires (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER, pre BOOLEAN DEFAULT FALSE)',
+    ] + [
+        'CREATE TABLE {0} (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)'.format(name)
+        for name in DEPENDENCIES
+    ] + [
+        'CREATE INDEX packagename ON packages (name)',
+        'CREATE INDEX packageId ON packages (pkgId)',
+        'CREATE INDEX filenames ON files (name)',
+        'CREATE INDEX pkgfiles ON files (pkgKey)',
+        'CREATE INDEX pkgprovides ON provides (pkgKey)',
+        'CREATE INDEX providesname ON provides (name)',
+        'CREATE INDEX pkgrequires ON requires (pkgKey)',
+        'CREATE INDEX requiresname ON requires (name)',
+        'CREATE INDEX pkgconflicts ON conflicts (pkgKey)',
+        'CREATE INDEX pkgobsoletes ON obsoletes (pkgKey)',
+        'CREATE TRIGGER removals AFTER DELETE ON packages BEGIN '
+        'DELETE FROM files WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM requires WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM provides WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM conflicts WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM obsoletes WHERE pkgKey = old.pkgKey; '
+        'END',
+    ]
+
+    def add_package(self, pkg):
+        version = pkg.get('version', {})
+        time = pkg.get('time', {})
+        size = pkg.get('size', {})
+        fmt = pkg.get('format', {})
+        header_range = fmt.get('header-range', {})
+        pkg_key = self.insert_package([
+            pkg['checksum'], pkg['name'], pkg['arch'], version.get('ver'), version.get('epoch'), version.get('rel'),
+            pkg.get('summary'), pkg.get('description'), pkg.get('url'), to_int(time.get('file')), to_int(time.get('build')),
+            fmt.get('license'), fmt.get('vendor'), fmt.get('group'), fmt.get('buildhost'), fmt.get('sourcerpm'),
+            to_int(header_range.get('start')), to_int(header_range.get('end')), pkg.get('packager'),
+            to_int(size.get('package')), to_int(size.get('installed')), to_int(size.get('archive')),
+            pkg.get('location'), None, 'sha',
+        ])
+        self.conn.executemany('INSERT INTO files VALUES (?, ?, ?)', [
+            (path, file_type or 'file', pkg_key) for file_type, path in getattr(fmt, 'files', [])
+        ])
+        self.conn.executemany('INSERT INTO requires VALUES (?, ?, ?, ?, ?, ?, ?)', dependency_rows(fmt.get('requires'), pkg_key, pre=True))
+        for name in self.DEPENDENCIES:
+            sql = 'INSERT INTO {0} VALUES (?, ?, ?, ?, ?, ?)'.format(name)
+            self.conn.executemany(sql, dependency_rows(fmt.get(name), pkg_key))
+
+
+class YumFileListsDatabase(YumDatabase):
+    # Letters used in filelist.filetypes
+    FILE_TYPES = {None: 'f', 'file': 'f', 'dir': 'd', 'ghost': 'g'}
+    SCHEMA = [
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)',
+        'CREATE TABLE filelist (pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT)',
+        'CREATE INDEX keyfile ON filelist (pkgKey)',
+        'CREATE INDEX pkgId ON packages (pkgId)',
+        'CREATE INDEX dirnames ON filelist (dirname)',
+        'CREATE TRIGGER remove_filelist AFTER DELETE ON packages BEGIN '
+        'DELETE FROM filelist WHERE pkgKey = old.pkgKey; '
+        'END',
+    ]
+
+    def add_package(self, pkg):
+        pkg_key = self.insert_package([pkg.pkgid])
+        # One row per directory, with the names and types of the files in it
+        dirs = collections.OrderedDict()
+        for file_type, path in pkg.files:
+            dirname, basename = os.path.split(path)
+            names, types = dirs.setdefault(dirname, ([], []))
+            names.append(basename)
+            types.append(self.FILE_TYPES.get(file_type, 'f'))
+        self.conn.executemany('INSERT INTO filelist VALUES (?, ?, ?, ?)', (
+            (pkg_key, key, '/'.join(value[0]), ''.join(value[1])) for key, value in six.iteritems(dirs)
+        ))
+
+
+class YumOtherDatabase(YumDatabase):
+    SCHEMA = [
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)',
+        'CREATE TABLE changelog (pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT)',
+        'CREATE INDEX keychange ON changelog (pkgKey)',
+        'CREATE INDEX pkgId ON packages (pkgId)',
+        'CREATE TRIGGER remove_changelogs AFTER DELETE ON packages BEGIN '
+        'DELETE FROM changelog WHERE pkgKey = old.pkgKey; '
+        'END',
+    ]
+
+    def add_package(self, pkg):
+        pkg_key = self.insert_package([pkg.pkgid])
+        self.conn.executemany('INSERT INTO changelog VALUES (?, ?, ?, ?)', [
+            (pkg_key, attrib.get('author'), to_int(attrib.get('date')), text) for attrib, text in pkg.changelogs
+        ])
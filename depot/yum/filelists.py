@@ -18,7 +18,7 @@
 
 import six
 
-from .base import YumMeta, YumData
+from .base import copy_attrib, raw_package_fields, YumMeta, YumData
 
 
 class YumFileListsPackage(YumData):
@@ -29,8 +29,12 @@ class YumFileListsPackage(YumData):
         self.arch = arch
         self.files = []
 
+    @classmethod
+    def raw_fields(cls, data):
+        return raw_package_fields(data)
+
     def version_from_element(self, key, elm):
-        return elm.attrib
+        return copy_attrib(elm)
 
     def file_from_element(self, key, elm):
         self.files.append((elm.attrib.get('type'), elm.text))
@@ -59,13 +63,8 @@ class YumFileLists(YumMeta):
     PackageClass = YumFileListsPackage
     nsmap = {None: 'http://linux.duke.edu/metadata/filelists'}
 
-    @classmethod
-    def from_element(cls, root, *args, **kwargs):
-        self = cls(*args, **kwargs)
-        for elm in root.findall('{*}package'):
-            pkg = self.PackageClass.from_element(elm)
-            self[pkg.pkgid] = pkg  # Should this be a (name, arch, ver) tuple like YumPrimary?
-        return self
+    def add_package(self, pkg):
+        self[pkg.pkgid] = pkg  # Should this be a (name, arch, ver) tuple like YumPrimary?
 
-    def to_element(self, E):
-        return E.filelists(*[pkg.to_element(E) for pkg in six.itervalues(self)], packages=str(len(self)))
+    def root_to_element(self, E, sub):
+        return E.filelists(*sub, packages=str(len(self)))
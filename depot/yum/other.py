@@ -36,7 +36,7 @@
 
 import six
 
-from .base import YumMeta, YumData
+from .base import copy_attrib, raw_package_fields, YumMeta, YumData
 
 
 class YumOtherPackage(YumData):
@@ -47,11 +47,15 @@ class YumOtherPackage(YumData):
         self.arch = arch
         self.changelogs = []
 
+    @classmethod
+    def raw_fields(cls, data):
+        return raw_package_fields(data)
+
     def version_from_element(self, key, elm):
-        return elm.attrib
+        return copy_attrib(elm)
 
     def changelog_from_element(self, key, elm):
-        self.changelogs.append((elm.attrib, elm.text))
+        self.changelogs.append((copy_attrib(elm), elm.text))
         return self.NoInsert
 
     def version_to_element(self, E, key, value):
@@ -77,13 +81,8 @@ class YumOther(YumMeta):
     PackageClass = YumOtherPackage
     nsmap = {None: 'http://linux.duke.edu/metadata/other'}
 
-    @classmethod
-    def from_element(cls, root, *args, **kwargs):
-        self = cls(*args, **kwargs)
-        for elm in root.findall('{*}package'):
-            pkg = self.PackageClass.from_element(elm)
-            self[pkg.pkgid] = pkg  # Should this be a (name, arch, ver) tuple like YumPrimary?
-        return self
+    def add_package(self, pkg):
+        self[pkg.pkgid] = pkg  # Should this be a (name, arch, ver) tuple like YumPrimary?
 
-    def to_element(self, E):
-        return E.otherdata(*[pkg.to_element(E) for pkg in six.itervalues(self)], packages=str(len(self)))
+    def root_to_element(self, E, sub):
+        return E.otherdata(*sub, packages=str(len(self)))
@@ -16,9 +16,16 @@
 # limitations under the License.
 #
 
+import re
+
 import six
 
-from .base import YumMeta, YumData
+from .base import copy_attrib, raw_attrib, raw_text, RAW_VERSION_RE, YumMeta, YumData
+
+# The fields YumPrimary keys packages by, as they appear in a raw <package> block
+RAW_NAME_RE = re.compile(br'<name>([^<]*)</name>')
+RAW_ARCH_RE = re.compile(br'<arch>([^<]*)</arch>')
+RAW_CHECKSUM_RE = re.compile(br'<checksum(?:\s[^>]*)?>([^<]*)</checksum>')
 
 
 class YumPrimaryFormat(YumData):
@@ -29,10 +36,10 @@ class YumPrimaryFormat(YumData):
         self.files = []
 
     def header_range_from_element(self, key, elm):
-        return elm.attrib
+        return copy_attrib(elm)
 
     def provides_from_element(self, key, elm):
-        return [entry.attrib for entry in elm.findall('{*}entry')]
+        return [copy_attrib(entry) for entry in elm.findall('{*}entry')]
     requires_from_element = provides_from_element
     conflicts_from_element = provides_from_element
     obsoletes_from_element = provides_from_element
@@ -80,11 +87,28 @@ class YumPrimaryPackage(YumData):
         super(YumPrimaryPackage, self).__init__(*args, **kwargs)
         self.type = type
 
+    @classmethod
+    def raw_fields(cls, data):
+        """The name, arch, version and checksum of a raw <package> block, see YumRawPackage."""
+        matches = [regex.search(data) for regex in (RAW_NAME_RE, RAW_ARCH_RE, RAW_VERSION_RE, RAW_CHECKSUM_RE)]
+        if not all(matches):
+            return None
+        name, arch, version, checksum = matches
+        fields = {
+            'name': raw_text(name.group(1)),
+            'arch': raw_text(arch.group(1)),
+            'version': raw_attrib(version.group(1)),
+            'checksum': raw_text(checksum.group(1)),
+        }
+        if not all(value is not None for value in six.itervalues(fields)):
+            return None
+        return fields
+
     def location_from_element(self, key, elm):
         return elm.attrib['href']
 
     def version_from_element(self, key, elm):
-        return elm.attrib
+        return copy_attrib(elm)
     time_from_element = version_from_element
     size_from_element = version_from_element
 
@@ -133,13 +157,8 @@ class YumPrimary(YumMeta):
         'rpm': 'http://linux.duke.edu/metadata/rpm',
     }
 
-    @classmethod
-    def from_element(cls, root, *args, **kwargs):
-        self = cls(*args, **kwargs)
-        for elm in root.findall('{*}package'):
-            pkg = self.PackageClass.from_element(elm)
-            self[(pkg['name'], pkg['arch'], pkg.full_version())] = pkg
-        return self
-
-    def to_element(self, E):
-        return E.metadata(*[pkg.to_element(E) for pkg in six.itervalues(self)], packages=str(len(self)))
+    def add_package(self, pkg):
+        self[(pkg['name'], pkg['arch'], pkg.full_version())] = pkg
+
+    def root_to_element(self, E, sub):
+        return E.metadata(*sub, packages=str(len(self)))
@@ -0,0 +1,262 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import functools
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+import six
+
+from ..publish import Publisher
+from ..repository import Repository, SupersededIndex
+from ..storage import ConflictError
+from ..utils import IterFile, ReplayFile
+from .base import YumRawPackage
+from .database import YumFileListsDatabase, YumOtherDatabase, YumPrimaryDatabase
+from .filelists import YumFileLists
+from .other import YumOther
+from .primary import YumPrimary
+from .repomd import YumRepoMD, YumRepoMDData
+from .rpm import RpmPackage
+
+
+class YumRepository(Repository):
+    """
+    A yum repository updated in place. Only the headers of new RPMs are
+    read, the existing metadata is streamed in and back out with them merged
+    in, so there is no need for a local copy of every package to run
+    createrepo over.
+    """
+    # Metadata types maintained by commit_metadata(), as named in repomd.xml,
+    # and the sqlite database published alongside each as <type>_db
+    METADATA = [
+        ('primary', YumPrimary, YumPrimaryDatabase),
+        ('filelists', YumFileLists, YumFileListsDatabase),
+        ('other', YumOther, YumOtherDatabase),
+    ]
+    # Encoded metadata bigger than this is spooled to disk before uploading
+    SPOOL_SIZE = 16 * 1024 * 1024
+    # Number of metadata uploads in flight during commit_metadata()
+    PUBLISH_JOBS = 4
+    # Tries at commit_metadata() before giving up on a conflict, and the
+    # base delay in seconds between them
+    COMMIT_ATTEMPTS = 5
+    COMMIT_BACKOFF = 0.5
+    # Seconds metadata is kept once repomd.xml no longer lists it, long
+    # enough for anyone holding an older repomd.xml to finish with it
+    METADATA_RETENTION = 3 * 24 * 60 * 60
+    # When each superseded metadata file stopped being listed
+    SUPERSEDED_PATH = 'repodata/superseded.idx'
+
+    def __init__(self, storage, gpg=None):
+        self.storage = storage
+        self.gpg = gpg
+        self.dirty_packages = []  # [(pkg, upload time),+]
+        # Guards dirty_packages when add_package is called from multiple threads
+        self._lock = threading.Lock()
+
+    def open_package(self, path, fileobj=None, pool_path=None):
+        """Parse an RPM, returning (pkg, arch, fileobj) with fileobj ready to pass to upload_package()."""
+        fileobj = ReplayFile(fileobj or open(path, 'rb'))
+        pkg = RpmPackage(os.path.basename(path), fileobj, pool_path=pool_path)
+        return pkg, pkg.arch, fileobj
+
+    def upload_package(self, pkg, arch, fileobj, dirty=True):
+        self.storage.upload(pkg.pool_path, fileobj.replay())
+        if dirty:
+            self.mark_dirty(pkg, arch)
+
+    def mark_dirty(self, pkg, arch):
+        """Queue an uploaded package for the next commit_metadata()."""
+        with self._lock:
+            self.dirty_packages.append((pkg, time.time()))
+
+    def reset_dirty(self):
+        """Forget everything queued for commit_metadata()."""
+        with self._lock:
+            self.dirty_packages = []
+
+    def load_metadata(self, repomd):
+        """
+        Read the metadata listed in repomd, returning {type: YumMeta}.
+        Types repomd doesn't list start out empty, a listed file that is
+        missing raises ValueError rather than wiping out every package in
+        it. Packages are kept raw, so only the ones that are replaced or
+        looked at are ever parsed.
+        """
+        metadata = {}
+        for md_type, cls, db_cls in self.METADATA:
+            if md_type not in repomd:
+                metadata[md_type] = cls()
+                continue
+            location = repomd[md_type]['location']
+            chunks = self.storage.download_iter(location, skip_hash=True)
+            if chunks is None:
+                raise ValueError('{0} is listed in repomd.xml but missing'.format(location))
+            metadata[md_type] = cls.from_file(fileobj=IterFile(chunks), raw=True)
+        return metadata
+
+    def commit_metadata(self):
+        """
+        Merge the dirty packages in to the metadata and publish a new
+        repomd.xml. Returns {path: seconds} for each upload.
+
+        The metadata files are named by checksum and the old ones are kept
+        for METADATA_RETENTION so they stay valid for anyone mid-update, and
+        repomd.xml is written conditionally. If another publisher commits in
+        the meantime the whole commit is redone on top of its metadata.
+        """
+        for attempt in itertools.count(1):
+            try:
+                timings = self._commit_metadata()
+            except ConflictError:
+                if attempt >= self.COMMIT_ATTEMPTS:
+                    raise
+                # Jittered so racing publishers don't collide again
+                time.sleep(random.uniform(0, self.COMMIT_BACKOFF * 2 ** attempt))
+                continue
+            self.reset_dirty()
+            return timings
+
+    def write_database(self, index, meta, old_data, added, removed, checksum):
+        """
+        Build the sqlite database for a metadata type in to a temporary
+        file, returning (fileobj, info) as for YumMeta.write(). The published
+        database is updated in place with just the added and removed packages
+        if it matches the XML they are being merged in to, otherwise it is
+        rebuilt from every package in meta.
+        """
+        md_type, cls, db_cls = self.METADATA[index]
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            db = None
+            db_data = old_data.get(md_type + '_db')
+            if db_data and md_type in old_data and db_data.get('database_version') == str(db_cls.VERSION):
+                chunks = self.storage.download_iter(db_data['location'], skip_hash=True)
+                db = chunks is not None and db_cls.from_chunks(path, chunks)
+                if db and db.info()[1] != old_data[md_type]['checksum']:
+                    db.conn.close()
+                    db = None
+            if db:
+                for pkgid in removed:
+                    db.remove_package(pkgid)
+                pkgs = (pkgs[index] for pkgs in six.itervalues(added))
+            else:
+                os.unlink(path)
+                db = db_cls(path, create=True)
+                pkgs = six.itervalues(meta)
+            for pkg in pkgs:
+                # Parsed once here and dropped with the row, not kept for the life of meta
+                db.add_package(pkg.package if isinstance(pkg, YumRawPackage) else pkg)
+            fileobj = tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+            info = db.write(fileobj, checksum)
+            fileobj.seek(0)
+            return fileobj, info
+        finally:
+            os.unlink(path)
+
+    def _commit_metadata(self):
+        etags = {}
+        repomd_raw = self.storage.download('repodata/repomd.xml', skip_hash=True, etags=etags)
+        repomd = YumRepoMD.from_file(fileobj=six.BytesIO(repomd_raw)) if repomd_raw else YumRepoMD()
+        old_data = dict(repomd)
+        metadata = self.load_metadata(repomd)
+        primary, filelists, other = metadata['primary'], metadata['filelists'], metadata['other']
+        # What changed, for updating the databases
+        added = collections.OrderedDict()  # pkgid: (primary, filelists, other)
+        removed = set()
+        for pkg, file_time in self.dirty_packages:
+            hashes = self.storage.hashes(pkg.pool_path)
+            checksum = hashes['sha1'].hexdigest()
+            old = primary.get((pkg.name, pkg.arch, pkg.full_version()))
+            if old is not None:
+                # filelists and other are keyed by the checksum being replaced
+                filelists.pop(old['checksum'], None)
+                other.pop(old['checksum'], None)
+                if added.pop(old['checksum'], None) is None:
+                    removed.add(old['checksum'])
+            pkgs = added[checksum] = (
+                pkg.primary(checksum, hashes['size'].size, pkg.pool_path, file_time),
+                pkg.filelists(checksum),
+                pkg.other(checksum),
+            )
+            for meta, pkg_meta in six.moves.zip((primary, filelists, other), pkgs):
+                meta.add_package(pkg_meta)
+
+        now = str(int(time.time()))
+        publisher = Publisher(self.storage, self.PUBLISH_JOBS)
+        try:
+            for index, (md_type, cls, db_cls) in enumerate(self.METADATA):
+                fileobj = tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+                info = metadata[md_type].write(fileobj)
+                fileobj.seek(0)
+                data = repomd[md_type] = YumRepoMDData(md_type)
+                data['checksum'] = info['checksum']
+                data['timestamp'] = now
+                data['size'] = info['size']
+                data['open-size'] = info['open-size']
+                data['open-checksum'] = info['open-checksum']
+                data['location'] = 'repodata/{0}-{1}.xml.gz'.format(info['checksum'], md_type)
+                publisher.upload(data['location'], fileobj)
+                # The database records which XML it matches
+                fileobj, db_info = self.write_database(index, metadata[md_type], old_data, added, removed, info['checksum'])
+                db_data = repomd[md_type + '_db'] = YumRepoMDData(md_type + '_db')
+                db_data['location'] = 'repodata/{0}-{1}.sqlite.bz2'.format(db_info['checksum'], md_type)
+                db_data['checksum'] = db_info['checksum']
+                db_data['timestamp'] = now
+                db_data['size'] = db_info['size']
+                db_data['open-size'] = db_info['open-size']
+                db_data['open-checksum'] = db_info['open-checksum']
+                db_data['database_version'] = str(db_cls.VERSION)
+                publisher.upload(db_data['location'], fileobj)
+            expired = self.commit_superseded(old_data, repomd, etags, publisher)
+            repomd.revision = max(repomd.revision + 1, int(now))
+            repomd_raw = repomd.encode()
+            callback = None
+            if self.gpg:
+                # Only goes up once repomd.xml has, so losing the race leaves the old pair matching
+                callback = functools.partial(publisher.upload, 'repodata/repomd.xml.asc', self.gpg.sign(repomd_raw, detach=True))
+            publisher.wait()
+            # Everything it refers to is in place, publish repomd.xml
+            publisher.upload('repodata/repomd.xml', repomd_raw, callback=callback, etags=etags)
+            publisher.wait()
+        finally:
+            publisher.close()
+        for location in expired:
+            self.storage.delete(location)
+        return publisher.timings
+
+    def commit_superseded(self, old_data, repomd, etags, publisher):
+        """
+        Record the metadata old_data listed that repomd no longer does in
+        the superseded index, returning the locations that have expired.
+        They should only be deleted once the new repomd.xml is in place.
+        """
+        index = SupersededIndex(self.storage.download(self.SUPERSEDED_PATH, skip_hash=True, etags=etags))
+        for data in six.itervalues(old_data):
+            # Metadata from before the index was kept starts out current
+            index.entries.setdefault(data['location'], None)
+        current = set(data['location'] for data in six.itervalues(repomd))
+        expired = index.update(current, time.time(), self.METADATA_RETENTION)
+        publisher.upload(self.SUPERSEDED_PATH, str(index), etags=etags)
+        return expired
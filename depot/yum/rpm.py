@@ -0,0 +1,279 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import os
+import re
+import struct
+
+import six
+
+from .filelists import YumFileListsPackage
+from .other import YumOtherPackage
+from .primary import YumPrimaryFormat, YumPrimaryPackage
+
+# Header tags, see rpmtag.h
+NAME = 1000
+VERSION = 1001
+RELEASE = 1002
+EPOCH = 1003
+SUMMARY = 1004
+DESCRIPTION = 1005
+BUILDTIME = 1006
+BUILDHOST = 1007
+SIZE = 1009
+VENDOR = 1011
+LICENSE = 1014
+PACKAGER = 1015
+GROUP = 1016
+URL = 1020
+ARCH = 1022
+OLDFILENAMES = 1027
+FILEMODES = 1030
+FILEFLAGS = 1037
+SOURCERPM = 1044
+ARCHIVESIZE = 1046
+PROVIDENAME = 1047
+REQUIREFLAGS = 1048
+REQUIRENAME = 1049
+REQUIREVERSION = 1050
+CONFLICTFLAGS = 1053
+CONFLICTNAME = 1054
+CONFLICTVERSION = 1055
+CHANGELOGTIME = 1080
+CHANGELOGNAME = 1081
+CHANGELOGTEXT = 1082
+OBSOLETENAME = 1090
+SOURCEPACKAGE = 1106
+PROVIDEFLAGS = 1112
+PROVIDEVERSION = 1113
+OBSOLETEFLAGS = 1114
+OBSOLETEVERSION = 1115
+DIRINDEXES = 1116
+BASENAMES = 1117
+DIRNAMES = 1118
+# Signature header tags
+SIG_PAYLOADSIZE = 1007
+
+# Dependency flags
+SENSE_LESS = 2
+SENSE_GREATER = 4
+SENSE_EQUAL = 8
+SENSE_PREREQ = 64
+SENSE_SCRIPT_PRE = 512
+SENSE_SCRIPT_POST = 1024
+FLAG_NAMES = {
+    SENSE_LESS: 'LT',
+    SENSE_GREATER: 'GT',
+    SENSE_EQUAL: 'EQ',
+    SENSE_LESS | SENSE_EQUAL: 'LE',
+    SENSE_GREATER | SENSE_EQUAL: 'GE',
+}
+FILE_GHOST = 64
+
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+
+
+def read_header(fileobj, pad=False):
+    """
+    Read an RPM header structure, returning ({tag: value}, bytes read).
+    Integer and string array tags give lists, string tags a single string.
+    With pad the header is followed by padding to an 8 byte boundary, as
+    the signature header is.
+    """
+    intro = fileobj.read(16)
+    if len(intro) != 16 or intro[:4] != HEADER_MAGIC:
+        raise ValueError('Invalid RPM header')
+    count, store_size = struct.unpack('>II', intro[8:16])
+    index = fileobj.read(16 * count)
+    store = fileobj.read(store_size)
+    if len(index) != 16 * count or len(store) != store_size:
+        raise ValueError('Truncated RPM header')
+    size = 16 + len(index) + len(store)
+    if pad and size % 8:
+        fileobj.read(8 - size % 8)
+        size += 8 - size % 8
+    header = {}
+    for i in range(count):
+        tag, type, offset, n = struct.unpack('>iiii', index[i*16:i*16+16])
+        if type in (6, 8, 9):
+            # STRING, STRING_ARRAY, I18NSTRING are all NUL terminated
+            values = []
+            for _ in range(n):
+                end = store.index(b'\0', offset)
+                values.append(store[offset:end].decode('utf-8', 'replace'))
+                offset = end + 1
+            header[tag] = values if type == 8 else values[0] if values else ''
+        elif type in (2, 3, 4, 5):
+            fmt = {2: 'B', 3: 'H', 4: 'I', 5: 'Q'}[type]
+            header[tag] = list(struct.unpack('>{0}{1}'.format(n, fmt), store[offset:offset + n * struct.calcsize(fmt)]))
+        elif type == 7:
+            header[tag] = store[offset:offset + n]
+    return header, size
+
+
+def split_evr(evr):
+    """Split [epoch:]version[-release] in to its parts."""
+    epoch, _, version = evr.rpartition(':')
+    version, _, release = version.partition('-')
+    return epoch or '0', version, release or None
+
+
+class RpmPackage(object):
+    """
+    An RPM's headers, read from the front of the file without touching the
+    payload so fileobj can be a stream. Converts to the primary, filelists
+    and other metadata for it.
+    """
+    # How many of the newest changelog entries go in to other.xml
+    CHANGELOG_LIMIT = 10
+    # Files listed in primary.xml as well as filelists.xml, as createrepo does
+    PRIMARY_FILES_RE = re.compile(r'^(.*bin/.*|/etc/.*|/usr/lib/sendmail)$')
+
+    def __init__(self, filename, fileobj=None, pool_path=None):
+        self.filename = os.path.basename(filename)
+        self._pool_path = pool_path  # Used for manual pool path overrides
+        fileobj = fileobj or open(filename, 'rb')
+        lead = fileobj.read(96)
+        if len(lead) != 96 or lead[:4] != LEAD_MAGIC:
+            raise ValueError('{0} is not an RPM'.format(filename))
+        self.signature, signature_size = read_header(fileobj, pad=True)
+        self.header_start = 96 + signature_size
+        self.header, header_size = read_header(fileobj)
+        self.header_end = self.header_start + header_size
+        if NAME not in self.header or VERSION not in self.header:
+            raise ValueError('{0} has no name or version'.format(filename))
+
+    def get(self, tag, default=''):
+        return self.header.get(tag, default)
+
+    @property
+    def name(self):
+        return self.header[NAME]
+
+    @property
+    def arch(self):
+        # Source packages claim the arch they were built on
+        if SOURCEPACKAGE in self.header or SOURCERPM not in self.header:
+            return 'src'
+        return self.get(ARCH, 'noarch')
+
+    @property
+    def version(self):
+        return collections.OrderedDict([
+            ('epoch', str(self.get(EPOCH, [0])[0])),
+            ('ver', self.header[VERSION]),
+            ('rel', self.get(RELEASE)),
+        ])
+
+    def full_version(self):
+        return '{epoch}:{ver}-{rel}'.format(**self.version)
+
+    @property
+    def pool_path(self):
+        return self._pool_path or 'Packages/{0}'.format(self.filename)
+
+    def files(self):
+        """Return [(type, path),+] for every file in the package."""
+        if BASENAMES in self.header:
+            dirnames = self.header[DIRNAMES]
+            paths = [dirnames[index] + basename for index, basename in six.moves.zip(self.header[DIRINDEXES], self.header[BASENAMES])]
+        else:
+            paths = self.get(OLDFILENAMES, [])
+        modes = self.get(FILEMODES, [])
+        flags = self.get(FILEFLAGS, [])
+        files = []
+        for i, path in enumerate(paths):
+            file_type = None
+            if i < len(modes) and modes[i] & 0o170000 == 0o040000:
+                file_type = 'dir'
+            elif i < len(flags) and flags[i] & FILE_GHOST:
+                file_type = 'ghost'
+            files.append((file_type, path))
+        return files
+
+    def dependencies(self, name_tag, flags_tag, version_tag):
+        """Return the entries for rpm:provides, rpm:requires and so on."""
+        entries = []
+        seen = set()
+        for name, flags, evr in six.moves.zip(self.get(name_tag, []), self.get(flags_tag, []), self.get(version_tag, [])):
+            # rpmlib() dependencies are for rpm itself, not the package manager
+            if name.startswith('rpmlib(') or (name, flags, evr) in seen:
+                continue
+            seen.add((name, flags, evr))
+            entry = collections.OrderedDict([('name', name)])
+            if flags & 0xe and evr:
+                entry['flags'] = FLAG_NAMES[flags & 0xe]
+                entry['epoch'], entry['ver'], rel = split_evr(evr)
+                if rel is not None:
+                    entry['rel'] = rel
+            if name_tag == REQUIRENAME and flags & (SENSE_PREREQ | SENSE_SCRIPT_PRE | SENSE_SCRIPT_POST):
+                entry['pre'] = '1'
+            entries.append(entry)
+        return entries
+
+    def primary(self, checksum, size, location, file_time):
+        """Build the primary.xml entry, given details of the uploaded file."""
+        pkg = YumPrimaryPackage('rpm')
+        pkg['name'] = self.name
+        pkg['arch'] = self.arch
+        pkg['version'] = self.version
+        pkg['checksum'] = checksum
+        pkg['summary'] = self.get(SUMMARY)
+        pkg['description'] = self.get(DESCRIPTION)
+        pkg['packager'] = self.get(PACKAGER)
+        pkg['url'] = self.get(URL)
+        pkg['time'] = collections.OrderedDict([('file', str(int(file_time))), ('build', str(self.get(BUILDTIME, [0])[0]))])
+        pkg['size'] = collections.OrderedDict([
+            ('package', str(size)),
+            ('installed', str(self.get(SIZE, [0])[0])),
+            ('archive', str((self.signature.get(SIG_PAYLOADSIZE) or self.get(ARCHIVESIZE, [0]))[0])),
+        ])
+        pkg['location'] = location
+        fmt = YumPrimaryFormat()
+        fmt['license'] = self.get(LICENSE)
+        fmt['vendor'] = self.get(VENDOR)
+        fmt['group'] = self.get(GROUP)
+        fmt['buildhost'] = self.get(BUILDHOST)
+        fmt['sourcerpm'] = self.get(SOURCERPM)
+        fmt['header-range'] = collections.OrderedDict([('start', str(self.header_start)), ('end', str(self.header_end))])
+        fmt['provides'] = self.dependencies(PROVIDENAME, PROVIDEFLAGS, PROVIDEVERSION)
+        fmt['requires'] = self.dependencies(REQUIRENAME, REQUIREFLAGS, REQUIREVERSION)
+        for key, tags in (('conflicts', (CONFLICTNAME, CONFLICTFLAGS, CONFLICTVERSION)), ('obsoletes', (OBSOLETENAME, OBSOLETEFLAGS, OBSOLETEVERSION))):
+            entries = self.dependencies(*tags)
+            if entries:
+                fmt[key] = entries
+        fmt.files = [(file_type, path) for file_type, path in self.files() if self.PRIMARY_FILES_RE.match(path)]
+        pkg['format'] = fmt
+        return pkg
+
+    def filelists(self, checksum):
+        pkg = YumFileListsPackage(checksum, self.name, self.arch)
+        pkg['version'] = self.version
+        pkg.files = self.files()
+        return pkg
+
+    def other(self, checksum):
+        pkg = YumOtherPackage(checksum, self.name, self.arch)
+        pkg['version'] = self.version
+        changelogs = list(six.moves.zip(self.get(CHANGELOGTIME, []), self.get(CHANGELOGNAME, []), self.get(CHANGELOGTEXT, [])))
+        # Stored newest first, listed oldest first
+        for date, author, text in reversed(changelogs[:self.CHANGELOG_LIMIT]):
+            pkg.changelogs.append((collections.OrderedDict([('author', author), ('date', str(date))]), text))
+        return pkg
@@ -0,0 +1,117 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import threading
+
+import pytest
+from libcloud.storage.types import ContainerDoesNotExistError, ObjectDoesNotExistError
+
+from depot.storage import StorageWrapper
+
+
+class MemoryObject(object):
+    def __init__(self, name, data, container):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.hash = hashlib.md5(data).hexdigest()
+        self.extra = {}
+        self.meta_data = {}
+        self.container = container
+        self.driver = container.driver
+
+
+class MemoryContainer(object):
+    """Just enough of a libcloud container to back a StorageWrapper in tests."""
+
+    def __init__(self, name, driver):
+        self.name = name
+        self.driver = driver
+        self.objects = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_object(self, name):
+        self.calls.append(('get_object', name))
+        try:
+            return self.objects[name]
+        except KeyError:
+            raise ObjectDoesNotExistError(value=None, driver=self.driver, object_name=name)
+
+    def upload_object_via_stream(self, iterator, object_name, extra=None, **kwargs):
+        self.calls.append(('upload', object_name))
+        obj = MemoryObject(object_name, b''.join(iterator), self)
+        with self.lock:
+            self.objects[object_name] = obj
+        return obj
+
+    def download_object_as_stream(self, obj, chunk_size=None):
+        self.calls.append(('download', obj.name))
+        chunk_size = chunk_size or 1000
+        for i in range(0, len(obj.data), chunk_size):
+            yield obj.data[i:i+chunk_size]
+
+    def list_objects(self):
+        self.calls.append(('list', None))
+        return list(self.objects.values())
+
+    def delete_object(self, obj):
+        self.calls.append(('delete', obj.name))
+        with self.lock:
+            del self.objects[obj.name]
+        return True
+
+
+class MemoryDriver(object):
+    containers = None
+
+    def __init__(self, key, secret=None, **kwargs):
+        pass
+
+    def get_container(self, name):
+        try:
+            return self.containers[name]
+        except KeyError:
+            raise ContainerDoesNotExistError(value=None, driver=self, container_name=name)
+
+    def create_container(self, name):
+        container = self.containers[name] = MemoryContainer(name, self)
+        return container
+
+    def list_container_objects(self, container, ex_prefix=None):
+        # Prefix listings, like S3
+        container.calls.append(('list', ex_prefix))
+        return [obj for obj in container.objects.values() if obj.name.startswith(ex_prefix or '')]
+
+
+@pytest.fixture
+def memory_storage():
+    """A StorageWrapper backed by an in-memory container at memory://bucket."""
+    class Driver(MemoryDriver):
+        containers = {}
+
+    class MemoryStorageWrapper(StorageWrapper):
+        # Nothing outside this process can see it
+        PROCESS_LOCAL = True
+
+        @classmethod
+        def _get_driver(cls, name):
+            return Driver
+
+    return MemoryStorageWrapper('memory://bucket')
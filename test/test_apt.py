@@ -1,10 +1,18 @@
-import os
+import gzip
 import hashlib
+import io
+import os
+import re
+import tarfile
+import time
+from multiprocessing.pool import ThreadPool
 
 import pytest
-from pretend import call_recorder, call, stub
+from pretend import call_recorder, call, raiser, stub
 
-from depot.apt import AptPackages, AptRelease, AptRepository
+from depot import utils
+from depot.apt import iter_ar_members, AptByHashIndex, AptPackage, AptPackages, AptPackagesDiff, AptPackagesDiffIndex, AptPackagesIndex, AptRelease, AptRepository, AptRepositoryGroup, AptSplicedPackages, AptStanza, merge_contents, StaleIndexError
+from depot.storage import ConflictError
 
 def fixture_path(*path):
     return os.path.join(os.path.dirname(__file__), 'data', *path)
@@ -17,6 +25,145 @@ def storage():
         upload=lambda path, fileobj: None,
     )
 
+def apply_ed(data, script):
+    """Just enough of ed to apply a pdiff."""
+    lines = data.splitlines()
+    commands = iter(script.splitlines())
+    for command in commands:
+        md = re.match(r'^(\d+)(?:,(\d+))?([acd])$', command)
+        start, end = int(md.group(1)), int(md.group(2) or md.group(1))
+        text = list(iter(lambda: next(commands), '.')) if md.group(3) != 'd' else []
+        if md.group(3) == 'a':
+            lines[start:start] = text
+        else:
+            lines[start-1:end] = text
+    return ''.join(line + '\n' for line in lines)
+
+
+def make_deb(control, control_ext='.gz', data='data'):
+    """Build a minimal .deb in memory."""
+    tar_data = io.BytesIO()
+    tar = tarfile.open(fileobj=tar_data, mode='w')
+    info = tarfile.TarInfo('./control')
+    info.size = len(control)
+    tar.addfile(info, io.BytesIO(control))
+    tar.close()
+    tar_data = tar_data.getvalue()
+    if control_ext == '.gz':
+        tar_data = utils.gzip_compress(tar_data)
+    elif control_ext == '.xz':
+        tar_data = utils.lzma.compress(tar_data)
+    elif control_ext == '.zst':
+        tar_data = utils.zstandard.ZstdCompressor().compress(tar_data)
+    out = [b'!<arch>\n']
+    for name, body in [('debian-binary', b'2.0\n'), ('control.tar' + control_ext, tar_data), ('data.tar', data)]:
+        out.append('{0:<16}{1:<12}{2:<6}{3:<6}{4:<8}{5:<10}`\n'.format(name + '/', 0, 0, 0, 100644, len(body)).encode('ascii'))
+        out.append(body)
+        if len(body) % 2:
+            out.append(b'\n')
+    return b''.join(out)
+
+
+def make_data_tar(files, format=tarfile.GNU_FORMAT):
+    """Build an uncompressed data.tar holding files, each containing its own name."""
+    tar_data = io.BytesIO()
+    tar = tarfile.open(fileobj=tar_data, mode='w', format=format)
+    info = tarfile.TarInfo('./usr/')
+    info.type = tarfile.DIRTYPE
+    tar.addfile(info)
+    for name in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(name)
+        tar.addfile(info, io.BytesIO(name.encode('utf-8')))
+    tar.close()
+    return tar_data.getvalue()
+
+
+class NonSeekable(object):
+    def __init__(self, data):
+        self.fileobj = io.BytesIO(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.fileobj.read(size)
+
+
+class TestAptPackage(object):
+    CONTROL = b'Package: test\nVersion: 1.0\nArchitecture: amd64\n'
+
+    def test_fixture(self):
+        pkg = AptPackage(fixture_path('depot_1.2.3-1_amd64.deb'))
+        assert pkg['Package'] == 'depot'
+        assert pkg['Version'] == '1.2.3-1'
+        assert pkg.pool_path == 'pool/{0}'.format(fixture_path('depot_1.2.3-1_amd64.deb'))
+
+    @pytest.mark.parametrize('ext', ['', '.gz', '.xz', '.zst'])
+    def test_control_formats(self, ext):
+        if ext == '.xz' and not utils.lzma:
+            pytest.skip('lzma not available')
+        if ext == '.zst' and not utils.zstandard:
+            pytest.skip('zstandard not available')
+        pkg = AptPackage('test.deb', NonSeekable(make_deb(self.CONTROL, ext)))
+        assert pkg['Package'] == 'test'
+        assert pkg['Architecture'] == 'amd64'
+
+    def test_streaming(self):
+        data = make_deb(self.CONTROL, data=b'x' * 10001)
+        fileobj = utils.ReplayFile(NonSeekable(data))
+        AptPackage('test.deb', fileobj)
+        # Only the headers and control member were read
+        assert len(b''.join(fileobj.buffer)) < len(data) - 10000
+        assert b''.join(fileobj.replay(chunk_size=1000)) == data
+
+    def test_ar_members(self):
+        data = make_deb(self.CONTROL, data=b'abc')
+        members = []
+        for member in iter_ar_members(io.BytesIO(data)):
+            members.append((member.name, member.size))
+            if member.name == 'data.tar':
+                assert member.read() == b'abc'
+        assert [m[0] for m in members] == ['debian-binary', 'control.tar.gz', 'data.tar']
+
+    def test_not_a_deb(self):
+        with pytest.raises(ValueError):
+            AptPackage('test.deb', io.BytesIO(b'not a deb'))
+
+
+class TestAptFileList(object):
+    LONG_NAME = './usr/share/' + 'x' * 120 + '/file'
+
+    @pytest.mark.parametrize('format', [tarfile.GNU_FORMAT, tarfile.PAX_FORMAT])
+    def test_files(self, format):
+        deb = make_deb(b'Package: test\nVersion: 1.0\n', data=make_data_tar(['./usr/bin/test', self.LONG_NAME], format))
+        pkg = AptPackage('test.deb', io.BytesIO(deb))
+        # Small chunks so headers are split between feeds
+        assert b''.join(pkg.tee_file_list(deb[i:i+7] for i in range(0, len(deb), 7))) == deb
+        assert pkg.files == ['usr/bin/test', self.LONG_NAME[2:]]
+
+    def test_one_chunk(self):
+        names = ['./usr/share/test/{0:04d}'.format(i) for i in range(500)]
+        deb = make_deb(b'Package: test\nVersion: 1.0\n', data=make_data_tar(names, tarfile.GNU_FORMAT))
+        pkg = AptPackage('test.deb', io.BytesIO(deb))
+        list(pkg.tee_file_list([deb]))
+        assert pkg.files == [name[2:] for name in names]
+
+    def test_not_a_tar(self):
+        pkg = AptPackage('test.deb', data='Package: test\nVersion: 1.0')
+        list(pkg.tee_file_list([make_deb(b'Package: test\nVersion: 1.0\n')]))
+        assert pkg.files is None
+
+    def test_merge_contents(self):
+        old = ['usr/bin/a\tutils/a', 'usr/bin/c\tutils/c']
+        new = {'usr/bin/b': set(['utils/b']), 'usr/bin/c': set(['admin/b']), 'usr/bin/d': set(['utils/d'])}
+        assert list(merge_contents(old, new)) == [
+            'usr/bin/a\tutils/a\n',
+            'usr/bin/b\tutils/b\n',
+            'usr/bin/c\tadmin/b,utils/c\n',
+            'usr/bin/d\tutils/d\n',
+        ]
+
+
 class TestAptPackages(object):
     @pytest.fixture
     def pgdg(self, storage):
@@ -48,6 +195,117 @@ class TestAptPackages(object):
     def test_serializing(self, pgdg):
         assert str(pgdg).strip() == pgdg._data.strip()
 
+    def test_lazy_stanzas(self, pgdg):
+        pkg = pgdg.packages[('libpq5', '8.2.23-1.pgdg12.4+1')]
+        assert isinstance(pkg, AptStanza)
+        assert pkg.meta is None
+        assert pkg['Architecture'] == 'amd64'
+        assert pkg.meta is None
+        raw = pkg.raw
+        pkg['Priority'] = 'extra'
+        assert pkg.meta is not None
+        assert str(pkg) == raw.replace('Priority: optional', 'Priority: extra')
+
+    def test_stanza_without_key(self):
+        with pytest.raises(ValueError):
+            AptStanza('Description: nope')
+
+
+class TestAptSplicedPackages(object):
+    @pytest.fixture
+    def data(self):
+        return open(fixture_path('pgdg_Packages'), 'rb').read()
+
+    def splice(self, storage, data, index, chunk_size=100):
+        pool_hashes = storage.hashes
+        storage.hashes = lambda path: {'sha256': hashlib.sha256(data)} if path == 'Packages' else pool_hashes(path)
+        chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+        return AptSplicedPackages(storage, 'Packages', chunks, index)
+
+    def make_index(self, storage, data):
+        full = AptPackages(storage, data)
+        raw = str(full)
+        full.index.sha256 = hashlib.sha256(raw).hexdigest()
+        return raw, AptPackagesIndex(str(full.index))
+
+    def test_index_round_trip(self, storage, data):
+        raw, index = self.make_index(storage, data)
+        assert len(index.entries) == 6
+        assert index.size == len(raw)
+        key, offset, length = index.entries[0]
+        assert key == ('libecpg-compat2', '8.2.23-1.pgdg12.4+1')
+        assert raw[offset:offset+length].startswith('Package: libecpg-compat2\n')
+
+    def test_unchanged(self, storage, data):
+        raw, index = self.make_index(storage, data)
+        spliced = self.splice(storage, raw, index)
+        assert str(spliced) == raw
+        assert spliced.index.entries == index.entries
+
+    @pytest.mark.parametrize('name,version', [
+        ('aaa', '1'),
+        ('libpq-dev', '8.2.23-1.pgdg12.4+1'),
+        ('libpq-dev', '9.0'),
+        ('zzz', '1'),
+    ])
+    def test_add(self, storage, data, name, version):
+        raw, index = self.make_index(storage, data)
+        spliced = self.splice(storage, raw, index)
+        full = AptPackages(storage, raw)
+        for packages in (spliced, full):
+            packages.add(AptPackage(None, data='Package: {0}\nVersion: {1}'.format(name, version)))
+        assert str(spliced) == str(full)
+        assert [e[1:] for e in spliced.index.entries] == [e[1:] for e in full.index.entries]
+
+    def test_stale(self, storage, data):
+        raw, index = self.make_index(storage, data)
+        spliced = self.splice(storage, raw + 'extra', index)
+        with pytest.raises(StaleIndexError):
+            str(spliced)
+
+
+class TestAptPackagesDiff(object):
+    @pytest.fixture
+    def raw(self, storage):
+        return str(AptPackages(storage, open(fixture_path('pgdg_Packages'), 'rb').read()))
+
+    @pytest.mark.parametrize('added', [
+        [('aaa', '1')],
+        [('libpq-dev', '8.2.23-1.pgdg12.4+1')],
+        [('libpq-dev', '9.0'), ('libpq-dev', '9.1'), ('zzz', '1')],
+    ])
+    def test_apply(self, storage, raw, added):
+        packages = AptPackages(storage, raw)
+        packages.diff = AptPackagesDiff()
+        for name, version in added:
+            packages.add(AptPackage(None, data='Package: {0}\nVersion: {1}'.format(name, version)))
+        new_raw = str(packages)
+        assert packages.diff.valid
+        assert len(packages.diff) == (1 if len(added) == 1 else 2)
+        assert apply_ed(raw, str(packages.diff)) == new_raw
+        assert packages.old_hashes['sha256'] == (hashlib.sha256(raw).hexdigest(), str(len(raw)))
+
+    def test_not_diffable(self, storage, raw):
+        # Written by something that doesn't end the file with a blank line
+        packages = AptPackages(storage, raw.rstrip('\n'))
+        packages.diff = AptPackagesDiff()
+        packages.add(AptPackage(None, data='Package: aaa\nVersion: 1'))
+        assert str(packages).startswith('Package: aaa\n')
+        assert packages.diff is None
+
+    def test_index_round_trip(self):
+        index = AptPackagesDiffIndex()
+        index.current = AptPackagesDiffIndex.hash_data('new')
+        index.add('2014-01-01-0000.00', AptPackagesDiffIndex.hash_data('old'), 'patch', 'patch.gz')
+        raw = str(index)
+        assert 'SHA256-Download:\n {0} 8 2014-01-01-0000.00.gz\n'.format(hashlib.sha256('patch.gz').hexdigest()) in raw
+        parsed = AptPackagesDiffIndex(raw)
+        assert parsed.current == index.current
+        assert parsed.patches == index.patches
+        assert str(parsed) == raw
+        assert parsed.prune(0) == ['2014-01-01-0000.00']
+        assert 'History' not in str(parsed)
+
 
 class TestAptRelease(object):
     @pytest.fixture
@@ -100,3 +358,367 @@ class TestAptRepository(object):
     def test_nonduplicate_upload(self, storage, package_path):
         repo = AptRepository(storage, None, None)
         assert repo.add_package(package_path, force=True)
+
+    def test_parallel_upload(self, memory_storage, package_path):
+        repo = AptRepository(memory_storage, None, None)
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(lambda n: repo.add_package(package_path, force=True), range(8))
+        finally:
+            pool.close()
+            pool.join()
+        assert results == [True] * 8
+        assert len(repo.dirty_packages['amd64']) == 8
+        # Every upload hashed its own copy of the data
+        with open(package_path, 'rb') as f:
+            data = f.read()
+        hashes = memory_storage.hashes('pool/depot_1.2.3-1_amd64.deb')
+        assert hashes['size'].size == len(data)
+        assert hashes['md5'].hexdigest() == hashlib.md5(data).hexdigest()
+        assert hashes['sha256'].hexdigest() == hashlib.sha256(data).hexdigest()
+
+    def test_add_packages(self, memory_storage, package_path):
+        other = make_deb(b'Package: other\nVersion: 1.0\nArchitecture: amd64\n')
+        memory_storage.upload('pool/depot_1.2.3-1_amd64.deb', b'old')
+        container = memory_storage.storage
+        del container.calls[:]
+        repo = AptRepository(memory_storage, None, None)
+        opened = {package_path: lambda: open(package_path, 'rb'), 'other.deb': lambda: io.BytesIO(other)}
+        results = repo.add_packages([package_path, 'other.deb'], jobs=2, open_fn=lambda path: opened[path]())
+        assert results == [False, True]
+        assert [call for call in container.calls if call[0] != 'upload'] == [('list', 'pool/')]
+        assert container.objects['pool/other.deb'].data == other
+        assert [pkg['Package'] for pkg in repo.dirty_packages['amd64']] == ['other']
+
+    def test_add_packages_lazy(self, memory_storage):
+        # Inputs are opened as they are needed, not all up front
+        debs = dict((name, make_deb('Package: {0}\nVersion: 1.0\nArchitecture: amd64\n'.format(name).encode('ascii'))) for name in 'abc')
+        open_files = []
+        most_open = [0]
+
+        class Input(io.BytesIO):
+            def close(self):
+                open_files.remove(self)
+                io.BytesIO.close(self)
+
+        def open_fn(path):
+            fileobj = Input(debs[path[0]])
+            open_files.append(fileobj)
+            most_open[0] = max(most_open[0], len(open_files))
+            return fileobj
+        repo = AptRepository(memory_storage, None, None)
+        assert repo.add_packages(['a.deb', 'b.deb', 'c.deb'], open_fn=open_fn) == [True, True, True]
+        assert most_open[0] == 1 and open_files == []
+
+    def test_commit_metadata(self, memory_storage, package_path):
+        gpg = stub(sign_release=lambda data: ('signed', 'sig'), public_key=lambda: 'key')
+        repo = AptRepository(memory_storage, gpg, 'lucid')
+        repo.add_package(package_path)
+        container = memory_storage.storage
+        timings = repo.commit_metadata()
+        uploads = [name for call, name in container.calls if call == 'upload']
+        release = uploads.index('dists/lucid/Release')
+        assert set(uploads[:release]) >= set(['dists/lucid/main/binary-amd64/Packages', 'dists/lucid/main/binary-amd64/Packages.gz'])
+        assert uploads.index('dists/lucid/InRelease') > release
+        assert uploads.index('dists/lucid/Release.gpg') > release
+        # by-hash copies are server-side copies, not uploads
+        assert set(timings) == set(name for name in uploads if '/by-hash/' not in name) - set(['pool/depot_1.2.3-1_amd64.deb'])
+        release_raw = container.objects['dists/lucid/Release'].data
+        packages_sha256 = hashlib.sha256(container.objects['dists/lucid/main/binary-amd64/Packages'].data).hexdigest()
+        assert packages_sha256 in release_raw
+        assert 'Package: depot' in container.objects['dists/lucid/main/binary-amd64/Packages'].data
+
+    def test_concurrent_commits(self, memory_storage):
+        repos = []
+        for name in ['one', 'two', 'three', 'four']:
+            repo = AptRepository(memory_storage, None, 'lucid')
+            repo.COMMIT_BACKOFF = 0.01
+            repo.add_package(name + '.deb', io.BytesIO(make_deb('Package: {0}\nVersion: 1.0\nArchitecture: amd64\n'.format(name).encode('ascii'))))
+            repos.append(repo)
+        pool = ThreadPool(len(repos))
+        pool.map(lambda repo: repo.commit_metadata(), repos)
+        pool.close()
+        container = memory_storage.storage
+        packages = AptPackages(memory_storage, container.objects['dists/lucid/main/binary-amd64/Packages'].data)
+        assert sorted(name for name, version in packages.packages) == ['four', 'one', 'three', 'two']
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        packages_sha256 = hashlib.sha256(container.objects['dists/lucid/main/binary-amd64/Packages'].data).hexdigest()
+        assert release.hashes['sha256']['main/binary-amd64/Packages'][0] == packages_sha256
+
+    def test_commit_not_atomic_storage(self, memory_storage):
+        # e.g. cloudfiles://, which can't do conditional writes
+        memory_storage.PROCESS_LOCAL = False
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.add_package('one.deb', io.BytesIO(make_deb(b'Package: one\nVersion: 1.0\nArchitecture: amd64\n')))
+        repo.commit_metadata()
+        repo.add_package('two.deb', io.BytesIO(make_deb(b'Package: two\nVersion: 1.0\nArchitecture: amd64\n')))
+        repo.commit_metadata()
+        packages = AptPackages(memory_storage, memory_storage.storage.objects['dists/lucid/main/binary-amd64/Packages'].data)
+        assert sorted(name for name, version in packages.packages) == ['one', 'two']
+
+    def test_commit_conflict_retries(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.COMMIT_BACKOFF = 0
+        repo.add_package('one.deb', io.BytesIO(make_deb(b'Package: one\nVersion: 1.0\nArchitecture: amd64\n')))
+        other = AptRepository(memory_storage, None, 'lucid')
+        other.add_package('two.deb', io.BytesIO(make_deb(b'Package: two\nVersion: 1.0\nArchitecture: i386\n')))
+        download = memory_storage.download
+        releases = []
+
+        def racing_download(path, *args, **kwargs):
+            data = download(path, *args, **kwargs)
+            if path == 'dists/lucid/Release' and not releases:
+                # Someone else commits between us reading Release and writing it
+                releases.append(path)
+                other.commit_metadata()
+            return data
+        memory_storage.download = racing_download
+        repo.commit_metadata()
+        assert repo.dirty_packages == {}
+        container = memory_storage.storage
+        assert len([name for call, name in container.calls if (call, name) == ('upload', 'dists/lucid/Release')]) == 2
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        assert release['Architectures'] == 'amd64 i386'
+
+    def test_commit_conflict_variants(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.COMMIT_BACKOFF = 0
+        repo.add_package('one.deb', io.BytesIO(make_deb(b'Package: one\nVersion: 1.0\nArchitecture: amd64\n')))
+        other = AptRepository(memory_storage, None, 'lucid')
+        other.add_package('two.deb', io.BytesIO(make_deb(b'Package: two\nVersion: 1.0\nArchitecture: amd64\n')))
+        container = memory_storage.storage
+        upload_if = memory_storage.upload_if
+        raced = []
+
+        def racing_upload_if(path, data, etag):
+            obj = upload_if(path, data, etag)
+            if path == 'dists/lucid/main/binary-amd64/Packages' and not raced:
+                raced.append(path)
+                # Someone else commits between our Packages and Packages.gz
+                other.commit_metadata()
+                raced.append(len(container.calls))
+            return obj
+        memory_storage.upload_if = racing_upload_if
+        repo.commit_metadata()
+        # Our stale Packages.gz never went over theirs, the retry rewrote both
+        packages_paths = ['dists/lucid/main/binary-amd64/Packages', 'dists/lucid/main/binary-amd64/Packages.gz']
+        assert [name for call, name in container.calls[raced[1]:] if call == 'upload' and name in packages_paths] == packages_paths
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        for ext in ['', '.gz', '.bz2']:
+            data = container.objects['dists/lucid/main/binary-amd64/Packages' + ext].data
+            assert release.hashes['sha256']['main/binary-amd64/Packages' + ext][0] == hashlib.sha256(data).hexdigest()
+
+    def test_commit_conflict_gives_up(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.COMMIT_ATTEMPTS = 2
+        repo.COMMIT_BACKOFF = 0
+        repo.add_package('one.deb', io.BytesIO(make_deb(b'Package: one\nVersion: 1.0\nArchitecture: amd64\n')))
+        memory_storage.upload_if = call_recorder(raiser(ConflictError))
+        with pytest.raises(ConflictError):
+            repo.commit_metadata()
+        assert len(memory_storage.upload_if.calls) == 2
+        assert 'amd64' in repo.dirty_packages
+        # Nothing that goes with the lost Packages was published either
+        assert [name for name in memory_storage.storage.objects if name.startswith('dists/lucid/main/binary-amd64/')] == []
+
+    def test_copy_package(self, memory_storage):
+        testing = AptRepository(memory_storage, None, 'testing')
+        testing.add_package('test.deb', io.BytesIO(make_deb(b'Package: test\nVersion: 1.0\nArchitecture: amd64\n')))
+        testing.commit_metadata()
+        container = memory_storage.storage
+        source_packages = AptPackages(memory_storage, container.objects['dists/testing/main/binary-amd64/Packages'].data)
+        del container.calls[:]
+        # A fresh process with nothing in memory
+        storage = type(memory_storage)('memory://bucket')
+        stable = AptRepository(storage, None, 'stable')
+        assert stable.copy_package('test@1.0', 'testing') == ['amd64']
+        stable.commit_metadata()
+        assert ('download', 'pool/test.deb') not in container.calls
+        assert ('upload', 'pool/test.deb') not in container.calls
+        packages = AptPackages(storage, container.objects['dists/stable/main/binary-amd64/Packages'].data)
+        assert str(packages.packages[('test', '1.0')]) == str(source_packages.packages[('test', '1.0')])
+
+    def test_copy_package_pool_path(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'testing')
+        repo.add_package('test.deb', io.BytesIO(make_deb(b'Package: test\nVersion: 1.0\nArchitecture: amd64\n')))
+        repo.commit_metadata()
+        repo.copy_package('test@1.0', pool_path='pool/t/test.deb')
+        repo.commit_metadata()
+        container = memory_storage.storage
+        assert container.objects['pool/t/test.deb'].data == container.objects['pool/test.deb'].data
+        packages = AptPackages(memory_storage, container.objects['dists/testing/main/binary-amd64/Packages'].data)
+        assert packages.packages[('test', '1.0')]['Filename'] == 'pool/t/test.deb'
+
+    @pytest.mark.parametrize('spec, source, error', [
+        ('test', 'testing', 'Unable to parse'),
+        ('test@2.0', 'testing', 'not found in testing/main'),
+        ('test@1.0', 'unstable', 'Codename unstable not found'),
+        ('test@1.0', 'stable', 'on to itself'),
+    ])
+    def test_copy_package_errors(self, memory_storage, spec, source, error):
+        repo = AptRepository(memory_storage, None, 'testing')
+        repo.add_package('test.deb', io.BytesIO(make_deb(b'Package: test\nVersion: 1.0\nArchitecture: amd64\n')))
+        repo.commit_metadata()
+        with pytest.raises(ValueError) as excinfo:
+            AptRepository(memory_storage, None, 'stable').copy_package(spec, source)
+        assert error in str(excinfo.value)
+
+    def test_copy_package_no_hashes(self, memory_storage):
+        memory_storage.upload('dists/testing/Release', 'Codename: testing\nArchitectures: amd64\nComponents: main\n')
+        memory_storage.upload('dists/testing/main/binary-amd64/Packages', 'Package: test\nVersion: 1.0\nFilename: pool/test.deb\nSize: 10\n')
+        repo = AptRepository(memory_storage, None, 'stable')
+        with pytest.raises(ValueError) as excinfo:
+            repo.copy_package('test@1.0', 'testing')
+        assert 'no size or hashes' in str(excinfo.value)
+        assert repo.dirty_packages == {}
+
+    def test_commit_multiple_archs(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        archs = ['amd64', 'arm64', 'armhf', 'i386', 'ppc64el']
+        for arch in archs:
+            deb = make_deb('Package: test\nVersion: 1.0\nArchitecture: {0}\n'.format(arch).encode('ascii'))
+            repo.add_package('test_{0}.deb'.format(arch), io.BytesIO(deb))
+        repo.commit_metadata()
+        container = memory_storage.storage
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        assert release['Architectures'] == ' '.join(archs)
+        for arch in archs:
+            packages = container.objects['dists/lucid/main/binary-{0}/Packages'.format(arch)].data
+            assert 'Architecture: {0}\n'.format(arch) in packages
+            assert release.hashes['sha256']['main/binary-{0}/Packages'.format(arch)][0] == hashlib.sha256(packages).hexdigest()
+
+    def test_commit_pdiffs(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.PDIFF_RETENTION = 2
+        container = memory_storage.storage
+        packages_path = 'dists/lucid/main/binary-amd64/Packages'
+        versions = []
+        for name in ['one', 'two', 'three', 'four']:
+            repo.add_package(name + '.deb', io.BytesIO(make_deb('Package: {0}\nVersion: 1.0\nArchitecture: amd64\n'.format(name).encode('ascii'))))
+            repo.commit_metadata()
+            versions.append(container.objects[packages_path].data)
+        index = AptPackagesDiffIndex(container.objects[packages_path + '.diff/Index'].data)
+        assert index.current['sha256'] == (hashlib.sha256(versions[-1]).hexdigest(), str(len(versions[-1])))
+        # The first commit had nothing to diff against and the oldest patch was pruned
+        assert len(index.patches) == 2
+        patches = sorted(name for name in container.objects if name.startswith(packages_path + '.diff/') and name.endswith('.gz'))
+        assert patches == sorted('{0}.diff/{1}.gz'.format(packages_path, name) for name in index.patches)
+        data = versions[1]
+        for name, entry in index.patches.items():
+            assert entry['history']['sha256'][0] == hashlib.sha256(data).hexdigest()
+            data = apply_ed(data, gzip.GzipFile(fileobj=io.BytesIO(container.objects['{0}.diff/{1}.gz'.format(packages_path, name)].data)).read())
+        assert data == versions[-1]
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        assert 'main/binary-amd64/Packages.diff/Index' in release.hashes['sha256']
+
+    def test_commit_by_hash(self, memory_storage, monkeypatch):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.BY_HASH_RETENTION = 60
+        container = memory_storage.storage
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        digests = []
+        for name in ['one', 'two', 'three', 'four']:
+            repo.add_package(name + '.deb', io.BytesIO(make_deb('Package: {0}\nVersion: 1.0\nArchitecture: amd64\n'.format(name).encode('ascii'))))
+            repo.commit_metadata()
+            packages = container.objects['dists/lucid/main/binary-amd64/Packages.gz'].data
+            digests.append(hashlib.sha256(packages).hexdigest())
+            now[0] += 50
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        assert release['Acquire-By-Hash'] == 'yes'
+        assert release.hashes['sha256']['main/binary-amd64/Packages.gz'][0] == digests[-1]
+        by_hash = 'dists/lucid/main/binary-amd64/by-hash/SHA256/{0}'
+        assert container.objects[by_hash.format(digests[-1])].data == packages
+        # The first was superseded at 1050 and has expired by 1150, the second only at 1100
+        assert by_hash.format(digests[0]) not in container.objects
+        assert by_hash.format(digests[1]) in container.objects
+        index = AptByHashIndex(container.objects['dists/lucid/main/binary-amd64/by-hash.idx'].data)
+        assert index.entries[digests[1]] == 1100
+        assert index.entries[digests[3]] is None
+        assert digests[0] not in index.entries
+
+    def test_commit_contents(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        for name in ['one', 'two']:
+            data = make_data_tar(['./usr/bin/{0}'.format(name), './usr/share/doc/shared'])
+            control = 'Package: {0}\nVersion: 1.0\nArchitecture: amd64\nSection: utils\n'.format(name).encode('ascii')
+            repo.add_package(name + '.deb', io.BytesIO(make_deb(control, data=data)))
+            repo.commit_metadata()
+        container = memory_storage.storage
+        contents = container.objects['dists/lucid/main/Contents-amd64.gz'].data
+        assert gzip.GzipFile(fileobj=io.BytesIO(contents)).read() == (
+            'usr/bin/one\tutils/one\nusr/bin/two\tutils/two\nusr/share/doc/shared\tutils/one,utils/two\n')
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        assert release.hashes['sha256']['main/Contents-amd64.gz'][0] == hashlib.sha256(contents).hexdigest()
+        # Copies take their files from the source Contents
+        stable = AptRepository(memory_storage, None, 'stable')
+        stable.copy_package('one@1.0', source_codename='lucid')
+        stable.commit_metadata()
+        contents = container.objects['dists/stable/main/Contents-amd64.gz'].data
+        assert gzip.GzipFile(fileobj=io.BytesIO(contents)).read() == 'usr/bin/one\tutils/one\nusr/share/doc/shared\tutils/one\n'
+
+
+    def test_commit_contents_by_hash(self, memory_storage, monkeypatch):
+        # Every Contents-<arch>.gz shares one by-hash directory
+        repo = AptRepository(memory_storage, None, 'lucid')
+        repo.BY_HASH_RETENTION = 60
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        for n, arch in enumerate(['i386', 'amd64', 'amd64', 'amd64']):
+            control = 'Package: p{0}\nVersion: 1.0\nArchitecture: {1}\n'.format(n, arch).encode('ascii')
+            repo.add_package('p{0}.deb'.format(n), io.BytesIO(make_deb(control, data=make_data_tar(['./usr/bin/p{0}'.format(n)]))))
+            repo.commit_metadata()
+            now[0] += 100
+        container = memory_storage.storage
+        release = AptRelease(memory_storage, 'lucid', container.objects['dists/lucid/Release'].data)
+        for path in ['main/Contents-i386.gz', 'main/binary-i386/Packages.gz', 'main/Contents-amd64.gz']:
+            by_hash = 'dists/lucid/{0}/by-hash/SHA256/{1}'.format(os.path.dirname(path), release.hashes['sha256'][path][0])
+            assert by_hash in container.objects
+
+class TestAptRepositoryGroup(object):
+    def test_add_packages(self, memory_storage):
+        codenames = ['focal', 'jammy', 'noble']
+        repo = AptRepositoryGroup(memory_storage, None, [(codename, component) for codename in codenames for component in ['main', 'contrib']])
+        deb = make_deb(b'Package: test\nVersion: 1.0\nArchitecture: amd64\n')
+        assert repo.add_packages(['test.deb'], open_fn=lambda path: io.BytesIO(deb)) == [True]
+        timings = repo.commit_metadata()
+        container = memory_storage.storage
+        uploads = [name for call, name in container.calls if call == 'upload']
+        assert uploads.count('pool/test.deb') == 1
+        for codename in codenames:
+            for component in ['main', 'contrib']:
+                packages_path = 'dists/{0}/{1}/binary-amd64/Packages'.format(codename, component)
+                assert 'Filename: pool/test.deb\n' in container.objects[packages_path].data
+                assert packages_path in timings
+            release = AptRelease(memory_storage, codename, container.objects['dists/{0}/Release'.format(codename)].data)
+            assert release['Components'] == 'contrib main'
+            for component in ['main', 'contrib']:
+                packages = container.objects['dists/{0}/{1}/binary-amd64/Packages'.format(codename, component)].data
+                assert release.hashes['sha256']['{0}/binary-amd64/Packages'.format(component)][0] == hashlib.sha256(packages).hexdigest()
+        assert all(repo.dirty_packages == {} for repo in repo.repos)
+        # One Release and signature per codename, not per component
+        assert all(uploads.count('dists/{0}/Release'.format(codename)) == 1 for codename in codenames)
+
+    def test_mark_dirty_copies(self, memory_storage):
+        repo = AptRepositoryGroup(memory_storage, None, [('lucid', 'main'), ('lucid', 'contrib')])
+        pkg = AptPackage('test.deb', data='Package: test\nVersion: 1.0\n')
+        pkg.files = ['usr/bin/test']
+        repo.mark_dirty(pkg, 'amd64')
+        main, contrib = [target.dirty_packages['amd64'][0] for target in repo.repos]
+        assert main is not contrib and main is not pkg
+        assert str(main) == str(contrib) == str(pkg)
+        assert main.files == ['usr/bin/test']
+
+    def test_copy_package_archs(self, memory_storage):
+        for component, arch in [('main', 'amd64'), ('contrib', 'i386')]:
+            testing = AptRepository(memory_storage, None, 'testing', component)
+            deb = make_deb('Package: test\nVersion: 1.0\nArchitecture: {0}\n'.format(arch).encode('ascii'))
+            testing.add_package('test_{0}.deb'.format(arch), io.BytesIO(deb))
+            testing.commit_metadata()
+        repo = AptRepositoryGroup(memory_storage, None, [('stable', 'main'), ('stable', 'contrib')])
+        assert repo.copy_package('test@1.0', 'testing') == ['amd64', 'i386']
+
+    def test_no_targets(self, memory_storage):
+        with pytest.raises(ValueError):
+            AptRepositoryGroup(memory_storage, None, [])
+
@@ -0,0 +1,107 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+
+from depot.cache import HashCache, MetadataCache
+
+
+class TestHashCache(object):
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join('sub', 'hashes.json'))
+        cache = HashCache(path)
+        cache.set('s3://bucket/pool/a.deb', 10, 'etag', 'md5', 'sha1', 'sha256')
+        cache.save()
+        cache = HashCache(path)
+        assert cache.get('s3://bucket/pool/a.deb', '10', 'etag')['sha256'] == 'sha256'
+
+    def test_invalidated(self, tmpdir):
+        cache = HashCache(str(tmpdir.join('hashes.json')))
+        cache.set('s3://bucket/pool/a.deb', 10, 'etag', 'md5', 'sha1', 'sha256')
+        assert cache.get('s3://bucket/pool/a.deb', 11, 'etag') is None
+        assert cache.get('s3://bucket/pool/a.deb', 10, 'other') is None
+        assert cache.get('s3://bucket/pool/b.deb', 10, 'etag') is None
+
+    def test_corrupt(self, tmpdir):
+        tmpdir.join('hashes.json').write('{nope')
+        cache = HashCache(str(tmpdir.join('hashes.json')))
+        assert cache.get('s3://bucket/pool/a.deb', 10, 'etag') is None
+
+
+class TestMetadataCache(object):
+    def put(self, cache, key, data, etag='etag'):
+        writer = cache.writer(key)
+        writer.write(data)
+        writer.commit(etag)
+
+    def test_round_trip(self, tmpdir):
+        cache = MetadataCache(str(tmpdir.join('metadata')))
+        self.put(cache, 's3://bucket/dists/lucid/Release', b'data')
+        assert cache.get('s3://bucket/dists/lucid/Release', 4, 'etag').read() == b'data'
+        assert cache.get('s3://bucket/dists/lucid/Release', 4, 'other') is None
+        assert cache.get('s3://bucket/dists/lucid/Release', 5, 'etag') is None
+        assert cache.get('s3://bucket/dists/lucid/InRelease', 4, 'etag') is None
+
+    def test_abort(self, tmpdir):
+        cache = MetadataCache(str(tmpdir.join('metadata')))
+        writer = cache.writer('key')
+        writer.write(b'data')
+        writer.abort()
+        assert cache.get('key', 4, 'etag') is None
+        assert os.listdir(cache.path) == []
+
+    def test_too_big(self, tmpdir):
+        cache = MetadataCache(str(tmpdir.join('metadata')), max_size=80)
+        self.put(cache, 'key', b'x' * 11)
+        assert cache.get('key', 11, 'etag') is None
+
+    def test_lru(self, tmpdir):
+        cache = MetadataCache(str(tmpdir.join('metadata')), max_size=80)
+        for i in range(8):
+            self.put(cache, 'k{0}'.format(i), b'x' * 10)
+        # Age them in order, oldest first
+        for i in range(8):
+            past = time.time() - 100 + i
+            os.utime(cache._paths('k{0}'.format(i))[0], (past, past))
+        # Make k0 the most recently used
+        cache.get('k0', 10, 'etag').close()
+        self.put(cache, 'k8', b'x' * 10)
+        assert cache.get('k0', 10, 'etag') is not None
+        assert cache.get('k1', 10, 'etag') is None
+        assert cache.get('k8', 10, 'etag') is not None
+
+    def test_size_tracked(self, tmpdir, monkeypatch):
+        cache = MetadataCache(str(tmpdir.join('metadata')), max_size=80)
+        self.put(cache, 'k0', b'x' * 10)
+        scans = []
+        listdir = os.listdir
+        monkeypatch.setattr(os, 'listdir', lambda path: scans.append(path) or listdir(path))
+        for i in range(1, 8):
+            self.put(cache, 'k{0}'.format(i), b'x' * 10)
+        # Replacing an entry doesn't count it twice
+        self.put(cache, 'k0', b'x' * 10)
+        assert scans == []
+        self.put(cache, 'k8', b'x' * 10)
+        assert len(scans) == 1
+        assert cache._size == 80
+
+    def test_wants(self, tmpdir):
+        cache = MetadataCache(str(tmpdir.join('metadata')))
+        assert cache.wants('s3://bucket/dists/lucid/Release')
+        assert not cache.wants('s3://bucket/pool/a.deb')
@@ -0,0 +1,130 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import distutils.spawn
+import subprocess
+import threading
+import time
+
+import pytest
+from depot import gpg as gpg_module
+from depot.gpg import GPG
+
+
+class FakeSign(object):
+    stderr = ''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data
+
+
+class FakeGnuPG(object):
+    """Stands in for gnupg.GPG, counting the gpg processes depot would have run."""
+
+    def __init__(self, use_agent=False, gnupghome=None):
+        self.gnupghome = gnupghome
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def sign(self, data, keyid=None, passphrase=None, detach=False):
+        with self.lock:
+            self.calls.append(('sign', data, detach))
+        signature = '-----BEGIN PGP SIGNATURE-----\nsig\n-----END PGP SIGNATURE-----\n'
+        return FakeSign(signature if detach else 'clearsigned\n' + signature)
+
+    def export_keys(self, keyid):
+        self.calls.append(('export_keys', keyid))
+        return 'public key'
+
+
+@pytest.fixture
+def fake_gnupg(monkeypatch, tmpdir):
+    home = tmpdir.mkdir('gnupg')
+    home.join('pubring.kbx').write('')
+    monkeypatch.setattr(gpg_module.gnupg, 'GPG', FakeGnuPG)
+    return str(home)
+
+
+class TestGPG(object):
+    def test_no_cache(self, fake_gnupg):
+        gpg = GPG('ABCD1234', home=fake_gnupg)
+        gpg.public_key()
+        gpg.public_key()
+        assert [call[0] for call in gpg.gpg.calls] == ['sign', 'export_keys']
+
+    def test_cached_verify(self, fake_gnupg, tmpdir):
+        cache_path = str(tmpdir.join('cache', 'gpg.json'))
+        gpg = GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        assert gpg.public_key() == 'public key'
+        gpg = GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        assert gpg.public_key() == 'public key'
+        assert gpg.gpg.calls == []
+
+    def test_cache_expired(self, fake_gnupg, tmpdir, monkeypatch):
+        cache_path = str(tmpdir.join('gpg.json'))
+        GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        monkeypatch.setattr(GPG, 'VERIFY_TTL', 0)
+        gpg = GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        assert [call[0] for call in gpg.gpg.calls] == ['sign']
+
+    def test_keyring_changed(self, fake_gnupg, tmpdir):
+        cache_path = str(tmpdir.join('gpg.json'))
+        GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        tmpdir.join('gnupg', 'pubring.kbx').setmtime(time.time() + 10)
+        gpg = GPG('ABCD1234', home=fake_gnupg, cache_path=cache_path)
+        assert [call[0] for call in gpg.gpg.calls] == ['sign']
+
+    def test_sign_release(self, fake_gnupg):
+        gpg = GPG('ABCD1234', home=fake_gnupg)
+        del gpg.gpg.calls[:]
+        in_release, release_gpg = gpg.sign_release('Origin: test\nSHA256:\n abc 1 main/Packages')
+        assert in_release.startswith('clearsigned\n') and in_release.endswith(release_gpg)
+        assert release_gpg.startswith('-----BEGIN PGP SIGNATURE-----')
+        # Both come out of a single gpg run
+        assert gpg.gpg.calls == [('sign', 'Origin: test\nSHA256:\n abc 1 main/Packages', False)]
+
+    @pytest.mark.parametrize('data', ['Origin: test\n', 'Origin: test \nCodename: lucid'])
+    def test_sign_release_not_canonical(self, fake_gnupg, data):
+        gpg = GPG('ABCD1234', home=fake_gnupg)
+        del gpg.gpg.calls[:]
+        gpg.sign_release(data)
+        assert gpg.gpg.calls == [('sign', data, False), ('sign', data, True)]
+
+
+@pytest.mark.skipif(not distutils.spawn.find_executable('gpgv'), reason='needs gpg and gpgv')
+def test_sign_release_verifies(tmpdir):
+    home = tmpdir.mkdir('gnupg')
+    subprocess.check_call(['gpg', '--homedir', str(home), '--batch', '--passphrase', '',
+                           '--quick-gen-key', 'Test <test@example.com>', 'rsa2048', 'sign', 'never'],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    keyid = subprocess.check_output(['gpg', '--homedir', str(home), '--list-secret-keys', '--with-colons']).split('fpr:::::::::')[1].split(':')[0]
+    gpg = GPG(keyid, home=str(home))
+    data = 'Origin: test\nDescription:\n - dashed\nSHA256:\n abc 1 main/binary-amd64/Packages'
+    in_release, release_gpg = gpg.sign_release(data)
+    tmpdir.join('Release').write(data)
+    tmpdir.join('Release.gpg').write(release_gpg)
+    tmpdir.join('InRelease').write(in_release)
+    # gpgv only reads binary keyrings
+    keyring = subprocess.check_output(['gpg', '--homedir', str(home), '--export', keyid])
+    tmpdir.join('keyring.gpg').write(keyring, mode='wb')
+    keyring = ['gpgv', '--homedir', str(home), '--keyring', str(tmpdir.join('keyring.gpg'))]
+    subprocess.check_call(keyring + [str(tmpdir.join('Release.gpg')), str(tmpdir.join('Release'))], stderr=subprocess.PIPE)
+    subprocess.check_call(keyring + [str(tmpdir.join('InRelease'))], stderr=subprocess.PIPE)
@@ -0,0 +1,88 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+
+import pytest
+
+from depot.publish import Publisher
+
+
+class RecordingStorage(object):
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def upload(self, path, data):
+        with self.lock:
+            self.events.append(('start', path))
+        time.sleep(0.01)
+        if path == 'fail':
+            raise IOError('boom')
+        with self.lock:
+            self.events.append(('end', path))
+
+
+class TestPublisher(object):
+    @pytest.mark.parametrize('jobs', [0, 4])
+    def test_stages(self, jobs):
+        storage = RecordingStorage()
+        publisher = Publisher(storage, jobs)
+        try:
+            for i in range(4):
+                publisher.upload('index{0}'.format(i), 'data')
+            publisher.wait()
+            publisher.upload('Release', 'data')
+            publisher.wait()
+        finally:
+            publisher.close()
+        release = storage.events.index(('start', 'Release'))
+        assert all(('end', 'index{0}'.format(i)) in storage.events[:release] for i in range(4))
+        assert list(publisher.timings) and set(publisher.timings) == set(['index0', 'index1', 'index2', 'index3', 'Release'])
+
+    def test_concurrent(self):
+        storage = RecordingStorage()
+        publisher = Publisher(storage, 4)
+        try:
+            for i in range(4):
+                publisher.upload('index{0}'.format(i), 'data')
+            publisher.wait()
+        finally:
+            publisher.close()
+        # All four started before any finished
+        assert [e[0] for e in storage.events[:4]] == ['start'] * 4
+
+    def test_callback(self):
+        storage = RecordingStorage()
+        publisher = Publisher(storage, 2)
+        try:
+            publisher.upload('Packages', 'data', callback=lambda: publisher.upload('Packages.idx', 'data'))
+            publisher.wait()
+        finally:
+            publisher.close()
+        assert storage.events[-1] == ('end', 'Packages.idx')
+
+    def test_error(self):
+        publisher = Publisher(RecordingStorage(), 2)
+        try:
+            publisher.upload('fail', 'data')
+            with pytest.raises(IOError):
+                publisher.wait()
+        finally:
+            publisher.close()
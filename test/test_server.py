@@ -0,0 +1,156 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import pytest
+from six.moves import http_client
+
+from depot.apt import AptRepository
+from depot.server import CommitQueue, make_server
+from depot.yum import YumRepoMD, YumPrimary, YumRepository
+
+from test_apt import make_deb
+from test_yum import make_rpm
+
+
+def deb(name):
+    return make_deb('Package: {0}\nVersion: 1.0\nArchitecture: amd64\n'.format(name).encode('ascii'))
+
+
+class TestCommitQueue(object):
+    def test_batched(self, memory_storage):
+        queue = CommitQueue(AptRepository(memory_storage, None, 'lucid'), window=0.2)
+        try:
+            pool = ThreadPool(3)
+            results = pool.map(lambda name: queue.add(name + '.deb', io.BytesIO(deb(name))), ['one', 'two', 'three'])
+            pool.close()
+        finally:
+            queue.close()
+        assert results == [True, True, True]
+        assert queue.commits == 1
+        container = memory_storage.storage
+        assert [name for call, name in container.calls if call == 'upload'].count('dists/lucid/Release') == 1
+        packages = container.objects['dists/lucid/main/binary-amd64/Packages'].data
+        assert all('Package: {0}\n'.format(name) in packages for name in ['one', 'two', 'three'])
+
+    def test_duplicate(self, memory_storage):
+        queue = CommitQueue(AptRepository(memory_storage, None, 'lucid'), window=0)
+        try:
+            assert queue.add('one.deb', io.BytesIO(deb('one')))
+            assert not queue.add('one.deb', io.BytesIO(deb('one')))
+        finally:
+            queue.close()
+        assert queue.commits == 1
+
+    def test_commit_error(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        queue = CommitQueue(repo, window=0)
+
+        def fail():
+            raise IOError('boom')
+        repo.commit_metadata = fail
+        try:
+            with pytest.raises(IOError):
+                queue.add('one.deb', io.BytesIO(deb('one')))
+            assert repo.dirty_packages == {}
+            # one.deb is in the pool now, so the next commit has to list it
+            del repo.commit_metadata
+            assert queue.add('two.deb', io.BytesIO(deb('two')))
+        finally:
+            queue.close()
+        packages = memory_storage.storage.objects['dists/lucid/main/binary-amd64/Packages'].data
+        assert 'Package: one\n' in packages and 'Package: two\n' in packages
+
+    def test_yum(self, memory_storage):
+        repo = YumRepository(memory_storage)
+        queue = CommitQueue(repo, window=0)
+        try:
+            assert queue.add('foo-1.0-1.x86_64.rpm', io.BytesIO(make_rpm('foo')))
+            assert not queue.add('foo-1.0-1.x86_64.rpm', io.BytesIO(make_rpm('foo')))
+        finally:
+            queue.close()
+        assert queue.commits == 1
+        objects = memory_storage.storage.objects
+        repomd = YumRepoMD.from_file(fileobj=io.BytesIO(objects['repodata/repomd.xml'].data))
+        primary = YumPrimary.from_file(fileobj=io.BytesIO(objects[repomd['primary']['location']].data))
+        assert ('foo', 'x86_64', '0:1.0-1') in primary
+
+    def test_upload_jobs(self, memory_storage):
+        repo = AptRepository(memory_storage, None, 'lucid')
+        queue = CommitQueue(repo)
+        queue.close()
+        # Not tied to the one-at-a-time default of --jobs
+        assert queue._upload_pool._processes == CommitQueue.UPLOAD_JOBS
+        queue = CommitQueue(repo, jobs=2)
+        queue.close()
+        assert queue._upload_pool._processes == 2
+
+
+class TestServer(object):
+    @pytest.fixture
+    def server(self, memory_storage):
+        queue = CommitQueue(AptRepository(memory_storage, None, 'lucid'), window=0.1)
+        server = make_server('127.0.0.1:0', queue)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+        queue.close()
+
+    def request(self, server, method, path, body=None):
+        conn = http_client.HTTPConnection('127.0.0.1', server.server_address[1])
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+    def test_put(self, server, memory_storage):
+        assert self.request(server, 'PUT', '/packages/one.deb', deb('one')) == (201, {'package': 'one.deb', 'uploaded': True})
+        assert self.request(server, 'PUT', '/packages/one.deb', deb('one')) == (200, {'package': 'one.deb', 'uploaded': False})
+        assert 'Package: one\n' in memory_storage.storage.objects['dists/lucid/main/binary-amd64/Packages'].data
+        status, data = self.request(server, 'GET', '/status')
+        assert status == 200
+        assert data['commits'] == 1 and data['pending'] == 0
+
+    def test_bad_package(self, server):
+        status, data = self.request(server, 'PUT', '/packages/one.deb', b'not a deb')
+        assert status == 400
+
+    @pytest.mark.parametrize('pool_path', ['other/one.deb', 'pool/../one.deb', 'pool//one.deb', 'pool/'])
+    def test_bad_pool_path(self, server, memory_storage, pool_path):
+        status, data = self.request(server, 'PUT', '/packages/one.deb?pool_path=' + pool_path, deb('one'))
+        assert status == 400
+        assert [name for call, name in memory_storage.storage.calls if call == 'upload'] == []
+
+    def test_pool_path(self, server, memory_storage):
+        assert self.request(server, 'PUT', '/packages/one.deb?pool_path=pool/o/one.deb', deb('one'))[0] == 201
+        assert 'pool/o/one.deb' in memory_storage.storage.objects
+
+    def test_duplicate_body_drained(self, server):
+        body = deb('one') + b'\0' * (8*1024*1024)
+        assert self.request(server, 'PUT', '/packages/one.deb', body)[0] == 201
+        assert self.request(server, 'PUT', '/packages/one.deb', body) == (200, {'package': 'one.deb', 'uploaded': False})
+
+    def test_not_found(self, server):
+        assert self.request(server, 'GET', '/nope')[0] == 404
+        assert self.request(server, 'PUT', '/nope', b'')[0] == 404
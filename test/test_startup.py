@@ -0,0 +1,54 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Only needed once depot has real work to do
+HEAVY_MODULES = ['libcloud', 'gnupg', 'lxml', 'defusedxml', 'tarfile', 'bz2', 'lzma', 'backports.lzma', 'zstandard']
+# Parts of depot that --help and --version shouldn't load either
+DEPOT_MODULES = ['depot.apt', 'depot.cache', 'depot.gpg', 'depot.server', 'depot.storage', 'depot.yum']
+
+STARTUP_SCRIPT = '''
+import json, sys
+import depot
+sys.argv = ['depot'] + sys.argv[1:]
+try:
+    depot.main()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+
+def run_startup(*args):
+    """Run the CLI in a fresh interpreter, returning the modules it imported."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT] + list(args), cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return set(json.loads(err.decode('utf-8').splitlines()[-1]))
+
+
+@pytest.mark.parametrize('arg', ['--version', '--help'])
+def test_import_is_light(arg):
+    modules = run_startup(arg)
+    assert [name for name in HEAVY_MODULES + DEPOT_MODULES if name in modules] == []
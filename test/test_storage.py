@@ -16,9 +16,21 @@
 # limitations under the License.
 #
 
+import hashlib
+import io
 import os
+import threading
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
-from depot.storage import StorageWrapper
+import pytest
+
+import depot.storage
+from depot.cache import HashCache, MetadataCache
+from depot.storage import ConflictError, StorageWrapper
+from depot.utils import iter_fixed_chunks
+
+from conftest import MemoryDriver
 
 class TestStorage(object):
     def test_file_abspath(self):
@@ -42,3 +54,336 @@ class TestStorage(object):
         fileobj = StorageWrapperTest.file('dummy://bucket/path/to/txt')
         assert isinstance(fileobj, file)
         assert fileobj.read() == 'path/to/txt'
+
+
+class TestStorageHashes(object):
+    def test_upload_hashes(self, memory_storage):
+        memory_storage.upload('pool/a.deb', b'data')
+        assert memory_storage.hashes('pool/a.deb')['sha256'].hexdigest() == hashlib.sha256(b'data').hexdigest()
+        assert memory_storage.hashes('pool/a.deb')['size'].size == 4
+
+    def test_parallel_upload(self, memory_storage):
+        # The first upload is still streaming when the second one to the same path starts and finishes
+        started, resume = threading.Event(), threading.Event()
+
+        def slow():
+            yield b'slow '
+            started.set()
+            resume.wait()
+            yield b'data'
+        thread = threading.Thread(target=memory_storage.upload, args=('pool/a.deb', slow()))
+        thread.start()
+        started.wait()
+        memory_storage.upload('pool/a.deb', b'fast data')
+        assert memory_storage.hashes('pool/a.deb')['sha256'].hexdigest() == hashlib.sha256(b'fast data').hexdigest()
+        resume.set()
+        thread.join()
+        hashes = memory_storage.hashes('pool/a.deb')
+        assert memory_storage.storage.objects['pool/a.deb'].data == b'slow data'
+        assert hashes['sha256'].hexdigest() == hashlib.sha256(b'slow data').hexdigest()
+        assert hashes['md5'].hexdigest() == hashlib.md5(b'slow data').hexdigest()
+        assert hashes['size'].size == 9
+
+    def test_hash_cache(self, memory_storage, tmpdir):
+        cache = HashCache(str(tmpdir.join('hashes.json')))
+        memory_storage.hash_cache = cache
+        memory_storage.upload('pool/a.deb', b'data')
+        cache.save()
+        # A fresh run against the same storage
+        storage = memory_storage.__class__('memory://bucket', hash_cache=HashCache(str(tmpdir.join('hashes.json'))))
+        container = storage.storage
+        del container.calls[:]
+        assert storage.hashes('pool/a.deb')['sha1'].hexdigest() == hashlib.sha1(b'data').hexdigest()
+        assert storage.hashes('pool/a.deb')['size'].size == 4
+        assert container.calls == [('get_object', 'pool/a.deb')]
+
+    def test_hash_cache_changed(self, memory_storage, tmpdir):
+        cache = HashCache(str(tmpdir.join('hashes.json')))
+        cache.set('memory://bucket/pool/a.deb', 4, 'stale', 'md5', 'sha1', 'sha256')
+        memory_storage.hash_cache = cache
+        memory_storage.storage.upload_object_via_stream(iter([b'data']), 'pool/a.deb')
+        assert memory_storage.hashes('pool/a.deb')['sha256'].hexdigest() == hashlib.sha256(b'data').hexdigest()
+        # And the cache was refreshed
+        assert cache.get('memory://bucket/pool/a.deb', 4, hashlib.md5(b'data').hexdigest())
+
+    def test_missing(self, memory_storage, tmpdir):
+        memory_storage.hash_cache = HashCache(str(tmpdir.join('hashes.json')))
+        assert memory_storage.hashes('pool/missing.deb')['size'].size == 0
+
+
+class TestStorageExists(object):
+    def test_batched(self, memory_storage):
+        container = memory_storage.storage
+        for name in ['pool/a.deb', 'pool/b.deb', 'dists/lucid/Release']:
+            container.upload_object_via_stream(iter([b'data']), name)
+        del container.calls[:]
+        paths = ['pool/a.deb', 'pool/b.deb', 'pool/c.deb']
+        assert memory_storage.exists(paths) == set(['pool/a.deb', 'pool/b.deb'])
+        assert container.calls == [('list', 'pool/')]
+        # Answered from the cached listing
+        assert 'pool/b.deb' in memory_storage
+        assert 'pool/c.deb' not in memory_storage
+        assert container.calls == [('list', 'pool/')]
+
+    def test_single(self, memory_storage):
+        container = memory_storage.storage
+        container.upload_object_via_stream(iter([b'data']), 'pool/a.deb')
+        del container.calls[:]
+        assert 'pool/a.deb' in memory_storage
+        assert 'pool/b.deb' not in memory_storage
+        assert container.calls == [('get_object', 'pool/a.deb'), ('get_object', 'pool/b.deb')]
+
+    def test_root(self, memory_storage):
+        container = memory_storage.storage
+        container.upload_object_via_stream(iter([b'data']), 'a.deb')
+        assert memory_storage.exists(['a.deb', 'b.deb']) == set(['a.deb'])
+        assert ('list', '') in container.calls
+
+    def test_upload_updates_listing(self, memory_storage):
+        assert memory_storage.exists(['pool/a.deb', 'pool/b.deb']) == set()
+        memory_storage.upload('pool/a.deb', b'data')
+        assert memory_storage.exists(['pool/a.deb', 'pool/b.deb']) == set(['pool/a.deb'])
+
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class FakeS3Connection(object):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def request(self, action, method='GET', data=None, headers=None):
+        path, _, query = action.partition('?')
+        with self.driver.lock:
+            self.driver.requests.append((method, path, query))
+        status = 200
+        response_headers = {}
+        body = None
+        if method == 'POST' and query == 'uploads':
+            body = '<InitiateMultipartUploadResult xmlns="{0}"><UploadId>up1</UploadId></InitiateMultipartUploadResult>'.format(S3_NS)
+        elif method == 'PUT' and 'x-amz-copy-source' in headers:
+            container = list(self.driver.containers.values())[0]
+            src = container.objects[headers['x-amz-copy-source'].split('/', 2)[2]]
+            container.upload_object_via_stream([src.data], path.split('/', 2)[2])
+            body = '<CopyObjectResult xmlns="{0}"><ETag>"{1}"</ETag></CopyObjectResult>'.format(S3_NS, src.hash)
+        elif method == 'PUT' and not query:
+            # Conditional single PUT
+            name = path.split('/', 2)[2]
+            container = list(self.driver.containers.values())[0]
+            current = container.objects.get(name)
+            if headers.get('If-None-Match') == '*' and current is not None:
+                status = 412
+            elif 'If-Match' in headers and (current is None or headers['If-Match'] != '"{0}"'.format(current.hash)):
+                status = 412
+            else:
+                obj = container.upload_object_via_stream([data], name)
+                response_headers['etag'] = '"{0}"'.format(obj.hash)
+        elif method == 'PUT':
+            number = int(dict(p.split('=') for p in query.split('&'))['partNumber'])
+            with self.driver.lock:
+                self.driver.parts[number] = data
+            response_headers['etag'] = '"{0}"'.format(hashlib.md5(data).hexdigest())
+        elif method == 'POST':
+            body = '<CompleteMultipartUploadResult xmlns="{0}"><ETag>"abc-2"</ETag></CompleteMultipartUploadResult>'.format(S3_NS)
+        return FakeS3Response(status, response_headers, body)
+
+
+class FakeS3Response(object):
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.object = ElementTree.fromstring(body) if body else None
+
+
+class TestStorageMultipart(object):
+    @pytest.fixture
+    def storage(self):
+        class Driver(MemoryDriver):
+            containers = {}
+            namespace = S3_NS
+            requests = []
+            parts = {}
+            lock = threading.Lock()
+
+            def __init__(self, *args, **kwargs):
+                self.connection = FakeS3Connection(self)
+
+            def _get_object_path(self, container, name):
+                return '/{0}/{1}'.format(container.name, name)
+
+        class S3StorageWrapper(StorageWrapper):
+            PART_SIZE = 1000
+            PART_JOBS = 2
+
+            @classmethod
+            def _get_driver(cls, name):
+                return Driver
+
+        return S3StorageWrapper('s3://key:secret@bucket')
+
+    def test_small(self, storage):
+        storage.upload('pool/a.deb', b'x' * 999)
+        assert storage.storage.driver.requests == []
+        assert storage.storage.objects['pool/a.deb'].data == b'x' * 999
+
+    def test_multipart(self, storage):
+        data = os.urandom(4500)
+        obj = storage.upload('pool/a.deb', io.BytesIO(data))
+        driver = storage.storage.driver
+        assert [r[0] for r in driver.requests if r[0] != 'PUT'] == ['POST', 'POST']
+        assert sorted(driver.parts) == [1, 2, 3, 4, 5]
+        assert b''.join(driver.parts[n] for n in sorted(driver.parts)) == data
+        assert obj.hash == 'abc-2'
+        assert obj.size == 4500
+        hashes = storage.hashes('pool/a.deb')
+        assert hashes['sha256'].hexdigest() == hashlib.sha256(data).hexdigest()
+        assert hashes['md5'].hexdigest() == hashlib.md5(data).hexdigest()
+        assert hashes['size'].size == 4500
+
+    def test_multipart_pool(self, storage, monkeypatch):
+        part_pools = []
+
+        def make_pool(processes):
+            part_pools.append(ThreadPool(processes))
+            return part_pools[-1]
+        monkeypatch.setattr(depot.storage, 'ThreadPool', make_pool)
+        pool = ThreadPool(4)
+        pool.map(lambda n: storage.upload('pool/{0}.deb'.format(n), io.BytesIO(os.urandom(2500))), range(8))
+        pool.close()
+        # Racing uploads all share one pool
+        assert len(part_pools) == 1
+        storage.close()
+        assert all(not thread.is_alive() for thread in part_pools[0]._pool)
+        storage.close()
+        # Started again if the storage is used after all
+        storage.upload('pool/a.deb', io.BytesIO(os.urandom(2500)))
+        assert len(part_pools) == 2
+        storage.close()
+
+    def test_upload_if(self, storage):
+        storage.upload('dists/lucid/Release', b'one')
+        etags = {}
+        assert storage.download('dists/lucid/Release', etags=etags) == b'one'
+        storage.upload_if('dists/lucid/Release', b'two', etags['dists/lucid/Release'])
+        method, path, query = storage.storage.driver.requests[-1]
+        assert method == 'PUT' and path.endswith('/dists/lucid/Release')
+        assert storage.storage.objects['dists/lucid/Release'].data == b'two'
+        with pytest.raises(ConflictError):
+            storage.upload_if('dists/lucid/Release', b'three', etags['dists/lucid/Release'])
+        with pytest.raises(ConflictError):
+            storage.upload_if('dists/lucid/Release', b'three', None)
+        assert storage.storage.objects['dists/lucid/Release'].data == b'two'
+
+    def test_upload_if_caches(self, storage, tmpdir):
+        storage.hash_cache = HashCache(str(tmpdir.join('hashes.json')))
+        storage.metadata_cache = MetadataCache(str(tmpdir.join('metadata')))
+        obj = storage.upload_if('dists/lucid/Release', b'one', None)
+        key = storage._cache_key('dists/lucid/Release')
+        assert storage.hash_cache.get(key, 3, obj.hash)['sha256'] == hashlib.sha256(b'one').hexdigest()
+        assert storage.metadata_cache.get(key, 3, obj.hash).read() == b'one'
+
+    def test_copy(self, storage):
+        storage.upload('pool/a.deb', b'package')
+        storage.copy('pool/a.deb', 'pool/b.deb')
+        method, path, query = storage.storage.driver.requests[-1]
+        assert method == 'PUT' and path.endswith('/pool/b.deb')
+        assert storage.storage.objects['pool/b.deb'].data == b'package'
+        assert storage.hashes('pool/b.deb')['sha256'].hexdigest() == hashlib.sha256(b'package').hexdigest()
+
+
+class TestStorageConditional(object):
+    @pytest.fixture
+    def storage(self, memory_storage):
+        return memory_storage
+
+    def test_create(self, storage):
+        storage.upload_if('a', b'one', None)
+        assert storage.download('a') == b'one'
+        with pytest.raises(ConflictError):
+            storage.upload_if('a', b'two', None)
+        assert storage.download('a') == b'one'
+
+    def test_replace(self, storage):
+        storage.upload('a', b'one')
+        etags = {}
+        storage.download('a', etags=etags)
+        storage.upload_if('a', b'two', etags['a'])
+        assert storage.download('a') == b'two'
+        with pytest.raises(ConflictError):
+            storage.upload_if('a', b'three', etags['a'])
+
+    def test_racing(self, storage):
+        storage.upload('a', b'0')
+        etags = {}
+        storage.download('a', etags=etags)
+        wins = []
+
+        def writer(n):
+            try:
+                storage.upload_if('a', str(n).encode('ascii'), etags['a'])
+                wins.append(n)
+            except ConflictError:
+                pass
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Everyone read the same version, so exactly one write can win
+        assert len(wins) == 1
+        assert storage.download('a') == str(wins[0]).encode('ascii')
+
+    def test_copy(self, storage):
+        storage.upload('a', b'one')
+        storage.copy('a', 'b')
+        assert storage.download('b') == b'one'
+
+    def test_not_atomic(self, storage, caplog):
+        # Shared storage other than S3 or local, e.g. cloudfiles://, still
+        # publishes but can only check for conflicts within this process
+        storage.PROCESS_LOCAL = False
+        storage.upload_if('a', b'one', None)
+        assert storage.download('a') == b'one'
+        with pytest.raises(ConflictError):
+            storage.upload_if('a', b'two', None)
+        storage.upload_if('b', b'one', None)
+        warnings = [record for record in caplog.records if record.name == 'depot.storage']
+        assert len(warnings) == 1 and 'not safe' in warnings[0].getMessage()
+
+    def test_delete(self, storage):
+        storage.upload('a', b'one')
+        assert storage.delete('a')
+        assert 'a' not in storage
+        assert not storage.delete('a')
+
+
+def test_iter_fixed_chunks():
+    assert list(iter_fixed_chunks([b'ab', b'cde', b'f', b'ghij'], 3)) == [b'abc', b'def', b'ghi', b'j']
+    assert list(iter_fixed_chunks([], 3)) == []
+
+
+class TestStorageMetadataCache(object):
+    def test_download_cached(self, memory_storage, tmpdir):
+        memory_storage.metadata_cache = MetadataCache(str(tmpdir))
+        container = memory_storage.storage
+        container.upload_object_via_stream(iter([b'Origin: test\n']), 'dists/lucid/Release')
+        assert memory_storage.download('dists/lucid/Release') == b'Origin: test\n'
+        del container.calls[:]
+        assert memory_storage.download('dists/lucid/Release') == b'Origin: test\n'
+        assert memory_storage.hashes('dists/lucid/Release')['sha1'].hexdigest() == hashlib.sha1(b'Origin: test\n').hexdigest()
+        assert container.calls == [('get_object', 'dists/lucid/Release')]
+
+    def test_upload_cached(self, memory_storage, tmpdir):
+        memory_storage.metadata_cache = MetadataCache(str(tmpdir))
+        memory_storage.upload('dists/lucid/Release', b'Origin: test\n')
+        container = memory_storage.storage
+        del container.calls[:]
+        assert memory_storage.download('dists/lucid/Release') == b'Origin: test\n'
+        assert ('download', 'dists/lucid/Release') not in container.calls
+
+    def test_changed(self, memory_storage, tmpdir):
+        memory_storage.metadata_cache = MetadataCache(str(tmpdir))
+        memory_storage.upload('dists/lucid/Release', b'Origin: test\n')
+        # Someone else rewrote it
+        memory_storage.storage.upload_object_via_stream(iter([b'Origin: other\n']), 'dists/lucid/Release')
+        assert memory_storage.download('dists/lucid/Release') == b'Origin: other\n'
@@ -0,0 +1,70 @@
+#
+# Author:: Noah Kantrowitz <noah@coderanger.net>
+#
+# Copyright 2014, Noah Kantrowitz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import bz2
+import gzip
+
+import pytest
+import six
+
+from depot.utils import encode_streams, gzip_compress, open_decompressed
+
+
+class TestEncodeStreams(object):
+    def test_round_trip(self):
+        chunks = ['Package: test{0}\nVersion: 1\n\n'.format(i) for i in range(5000)]
+        data = ''.join(chunks)
+        results = dict(encode_streams(iter(chunks), ['', '.gz', '.bz2'], buffer_size=1024))
+        assert results[''].read() == data
+        assert gzip.GzipFile(fileobj=results['.gz'], mode='rb').read() == data
+        assert bz2.decompress(results['.bz2'].read()) == data
+
+    def test_spooled(self):
+        results = encode_streams(['x' * 1024] * 64, [''], spool_size=1024)
+        assert results[0][1].read() == 'x' * 1024 * 64
+
+    def test_unknown_extension(self):
+        with pytest.raises(ValueError):
+            encode_streams(['data'], ['', '.zip'])
+
+    def test_error_in_input(self):
+        def chunks():
+            yield 'data'
+            raise IOError('boom')
+        with pytest.raises(IOError):
+            encode_streams(chunks(), ['', '.gz'])
+
+    def test_empty(self):
+        results = dict(encode_streams([], ['', '.gz']))
+        assert results[''].read() == six.b('')
+        assert gzip.GzipFile(fileobj=results['.gz'], mode='rb').read() == six.b('')
+
+
+class TestOpenDecompressed(object):
+    @pytest.mark.parametrize('encode', [
+        lambda data: data,
+        gzip_compress,
+        bz2.compress,
+        # Concatenated members, as written by parallel compressors
+        lambda data: gzip_compress(data[:1000]) + gzip_compress(data[1000:]),
+    ])
+    def test_formats(self, encode):
+        data = six.b('').join(six.b('line {0}\n'.format(i)) for i in range(5000))
+        fileobj = open_decompressed(six.BytesIO(encode(data)), read_size=100)
+        assert fileobj.read(10) == data[:10]
+        assert fileobj.read() == data[10:]
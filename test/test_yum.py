@@ -16,14 +16,22 @@
 # limitations under the License.
 #
 
+import bz2
 import gzip
+import hashlib
 import os
 import re
+import sqlite3
+import struct
+import time
 
 import pytest
 import six
 
-from depot.yum import YumRepoMD, YumPrimary, YumFileLists, YumOther
+from depot.yum import YumRepoMD, YumPrimary, YumFileLists, YumOther, YumRepository, RpmPackage
+from depot.storage import ConflictError
+from depot.yum import rpm
+from depot.yum.base import ElementMaker, lxml, YumRawPackage
 
 
 # Convert XML into a format that diffs nicely
@@ -124,3 +132,390 @@ class TestYumOther(object):
 
     def test_str_pgdg(self, pgdg):
         assert unify_spacing(pgdg.encode()) == unify_spacing(pgdg)
+
+
+class TestIterPackages(object):
+    def test_compressed_path(self):
+        # Read straight from the .gz without unpacking it first
+        path = os.path.join(os.path.dirname(__file__), 'data', 'epel_other.xml.gz')
+        other = YumOther.from_file(path)
+        assert other.filename == path
+        assert list(other) == [pkg.pkgid for pkg in YumOther.iter_packages(path)]
+        assert other.encode() == fixture(YumOther, 'epel_other.xml.gz').encode()
+
+    def test_streaming(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'pgdg_primary.xml')
+        packages = YumPrimary.iter_packages(path)
+        pkg = next(packages)
+        assert pkg['name'] == fixture(YumPrimary, 'pgdg_primary.xml').values()[0]['name']
+
+    def test_entities_not_expanded(self):
+        data = six.b('''<?xml version="1.0"?>
+<!DOCTYPE otherdata [<!ENTITY boom "boom">]>
+<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="1">
+  <package pkgid="abc" name="test" arch="noarch"><version epoch="0" ver="1" rel="1"/><changelog author="a" date="1">&boom;</changelog></package>
+</otherdata>''')
+        other = YumOther.from_file(fileobj=six.BytesIO(data))
+        assert other['abc'].changelogs[0][1] != 'boom'
+
+
+class TestRawPackages(object):
+    @pytest.mark.parametrize('cls,name', [
+        (YumPrimary, 'pgdg_primary.xml'),
+        (YumFileLists, 'pgdg_filelists.xml'),
+        (YumOther, 'pgdg_other.xml'),
+    ])
+    def test_round_trip(self, cls, name):
+        meta = fixture(cls, name)
+        data = meta.encode()
+        raw = cls.from_file(fileobj=six.BytesIO(data), raw=True)
+        assert list(raw) == list(meta)
+        assert raw.encode() == data
+        assert not any(pkg.materialized for pkg in raw.values())
+
+    def test_pretty_printed(self):
+        # Whitespace inside untouched packages is kept, which parses the same
+        path = os.path.join(os.path.dirname(__file__), 'data', 'pgdg_filelists.xml')
+        raw = YumFileLists.from_file(path, raw=True)
+        assert YumFileLists.from_file(fileobj=six.BytesIO(raw.encode())).encode() == fixture(YumFileLists, 'pgdg_filelists.xml').encode()
+
+    def test_materialize(self):
+        meta = fixture(YumPrimary, 'pgdg_primary.xml')
+        raw = YumPrimary.from_file(fileobj=six.BytesIO(meta.encode()), raw=True)
+        key = list(raw)[0]
+        pkg = raw[key]
+        assert isinstance(pkg, YumRawPackage)
+        assert pkg['checksum'] == meta[key]['checksum'] and not pkg.materialized
+        # Reading parses a copy that isn't kept
+        assert pkg['format']['license'] == meta[key]['format']['license']
+        assert not pkg.materialized and pkg.data is not None
+        pkg['summary'] = 'Changed'
+        assert pkg.materialized and pkg.data is None
+        meta[key]['summary'] = 'Changed'
+        assert raw.encode() == meta.encode()
+
+    def test_spooled(self):
+        meta = fixture(YumFileLists, 'pgdg_filelists.xml')
+        data = meta.encode()
+        # Small enough that the package bytes go to disk
+        raw_cls = type('YumFileLists', (YumFileLists,), {'RAW_SPOOL_SIZE': 1024})
+        raw = raw_cls.from_file(fileobj=six.BytesIO(data), raw=True)
+        pkg = list(raw.values())[0]
+        assert pkg._spool.fileobj._rolled
+        assert raw.encode() == data
+        assert pkg.files == list(meta.values())[0].files
+
+    def test_doctype(self):
+        data = six.b('''<?xml version="1.0"?>
+<!DOCTYPE otherdata [<!ENTITY boom "boom">]>
+<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="1">
+  <package pkgid="abc" name="test" arch="noarch"><version epoch="0" ver="1" rel="1"/><changelog author="a" date="1">&boom;</changelog></package>
+</otherdata>''')
+        other = YumOther.from_file(fileobj=six.BytesIO(data), raw=True)
+        assert not isinstance(other['abc'], YumRawPackage)
+        assert other['abc'].changelogs[0][1] != 'boom'
+
+    def test_escaped(self):
+        data = six.b('''<?xml version="1.0"?>
+<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="2">
+  <package pkgid="abc" name="a&amp;b" arch="noarch"><version epoch="0" ver="1" rel="1"/></package>
+  <package pkgid="def" name="c" arch="noarch"><version epoch="0" ver="1" rel="1"/><!-- note --></package>
+</otherdata>''')
+        other = YumOther.from_file(fileobj=six.BytesIO(data), raw=True)
+        assert other['abc'].name == 'a&b'
+        assert [isinstance(pkg, YumRawPackage) for pkg in other.values()] == [False, False]
+
+    def test_count_mismatch(self):
+        data = six.b('''<?xml version="1.0"?>
+<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="2">
+  <package pkgid="abc" name="test" arch="noarch"><version epoch="0" ver="1" rel="1"/></package>
+</otherdata>''')
+        with pytest.raises(ValueError):
+            YumOther.from_file(fileobj=six.BytesIO(data), raw=True)
+
+    def test_other_namespaces(self):
+        data = six.b('''<?xml version="1.0"?>
+<o:otherdata xmlns:o="http://linux.duke.edu/metadata/other" packages="1">
+  <o:package pkgid="abc" name="test" arch="noarch"><o:version epoch="0" ver="1" rel="1"/></o:package>
+</o:otherdata>''')
+        other = YumOther.from_file(fileobj=six.BytesIO(data), raw=True)
+        assert list(other) == ['abc'] and not isinstance(other['abc'], YumRawPackage)
+
+
+class TestStreamingEncode(object):
+    @pytest.mark.parametrize('cls,name', [
+        (YumPrimary, 'pgdg_primary.xml'),
+        (YumFileLists, 'pgdg_filelists.xml'),
+        (YumOther, 'pgdg_other.xml'),
+        (YumRepoMD, 'pgdg_repomd.xml'),
+    ])
+    def test_identical(self, cls, name):
+        meta = fixture(cls, name)
+        tree = lxml.tostring(meta.to_element(ElementMaker(nsmap=meta.nsmap)), xml_declaration=True, encoding='UTF-8')
+        assert meta.encode() == tree
+
+    def test_empty(self):
+        assert YumOther().encode().endswith(b'packages="0"/>')
+
+    def test_write(self):
+        meta = fixture(YumOther, 'pgdg_other.xml')
+        out = six.BytesIO()
+        info = meta.write(out)
+        data = out.getvalue()
+        assert info['checksum'] == hashlib.sha1(data).hexdigest()
+        assert info['size'] == str(len(data))
+        encoded = gzip.GzipFile(fileobj=six.BytesIO(data)).read()
+        assert encoded == meta.encode()
+        assert info['open-checksum'] == hashlib.sha1(encoded).hexdigest()
+        assert info['open-size'] == str(len(encoded))
+
+
+def make_header(tags, pad=False):
+    """Build an RPM header structure from {tag: value}, ints and lists of ints are INT32s."""
+    index, store = [], b''
+    for tag, value in sorted(tags.items()):
+        if isinstance(value, list) and value and isinstance(value[0], int):
+            store += b'\0' * (-len(store) % 4)
+            index.append(struct.pack('>iiii', tag, 4, len(store), len(value)))
+            store += struct.pack('>{0}I'.format(len(value)), *value)
+        elif isinstance(value, list):
+            index.append(struct.pack('>iiii', tag, 8, len(store), len(value)))
+            store += b''.join(v.encode('utf-8') + b'\0' for v in value)
+        else:
+            index.append(struct.pack('>iiii', tag, 6, len(store), 1))
+            store += value.encode('utf-8') + b'\0'
+    header = rpm.HEADER_MAGIC + b'\0' * 4 + struct.pack('>II', len(index), len(store)) + b''.join(index) + store
+    if pad:
+        header += b'\0' * (-len(header) % 8)
+    return header
+
+
+def make_rpm(name, version='1.0', release='1', arch='x86_64', files=(), tags=None):
+    """Build a minimal RPM in memory, with a dummy payload."""
+    header = {
+        rpm.NAME: name,
+        rpm.VERSION: version,
+        rpm.RELEASE: release,
+        rpm.ARCH: arch,
+        rpm.SUMMARY: 'The {0} package'.format(name),
+        rpm.SOURCERPM: '{0}-{1}-{2}.src.rpm'.format(name, version, release),
+        rpm.PROVIDENAME: [name],
+        rpm.PROVIDEFLAGS: [rpm.SENSE_EQUAL],
+        rpm.PROVIDEVERSION: ['{0}-{1}'.format(version, release)],
+    }
+    if files:
+        dirnames = sorted(set(os.path.dirname(path) + '/' for path in files))
+        header[rpm.DIRNAMES] = dirnames
+        header[rpm.DIRINDEXES] = [dirnames.index(os.path.dirname(path) + '/') for path in files]
+        header[rpm.BASENAMES] = [os.path.basename(path) for path in files]
+        header[rpm.FILEMODES] = [0o100644] * len(files)
+    header.update(tags or {})
+    lead = rpm.LEAD_MAGIC + b'\0' * 92
+    return lead + make_header({rpm.SIG_PAYLOADSIZE: [4]}, pad=True) + make_header(header) + b'data'
+
+
+class TestRpmPackage(object):
+    def test_parse(self):
+        data = make_rpm('foo', files=['/usr/bin/foo', '/usr/share/doc/foo/README'], tags={
+            rpm.EPOCH: [2],
+            rpm.REQUIRENAME: ['rpmlib(PayloadIsXz)', '/bin/sh', 'bar'],
+            rpm.REQUIREFLAGS: [rpm.SENSE_LESS | rpm.SENSE_EQUAL, rpm.SENSE_SCRIPT_PRE, rpm.SENSE_GREATER | rpm.SENSE_EQUAL],
+            rpm.REQUIREVERSION: ['5.2-1', '', '1:2.0'],
+        })
+        pkg = RpmPackage('foo-1.0-1.x86_64.rpm', six.BytesIO(data))
+        assert pkg.name == 'foo'
+        assert pkg.arch == 'x86_64'
+        assert pkg.full_version() == '2:1.0-1'
+        assert pkg.pool_path == 'Packages/foo-1.0-1.x86_64.rpm'
+        assert data[pkg.header_start:pkg.header_end].startswith(rpm.HEADER_MAGIC)
+        assert data[pkg.header_end:] == b'data'
+        assert pkg.files() == [(None, '/usr/bin/foo'), (None, '/usr/share/doc/foo/README')]
+        requires = pkg.primary('abc', 100, pkg.pool_path, 0)['format']['requires']
+        assert requires == [{'name': '/bin/sh', 'pre': '1'}, {'name': 'bar', 'flags': 'GE', 'epoch': '1', 'ver': '2.0'}]
+
+    def test_source(self):
+        pkg = RpmPackage('foo.src.rpm', six.BytesIO(make_rpm('foo', tags={rpm.SOURCEPACKAGE: [1]})))
+        assert pkg.arch == 'src'
+
+    def test_not_rpm(self):
+        with pytest.raises(ValueError):
+            RpmPackage('foo.rpm', six.BytesIO(b'not an rpm' * 20))
+
+    def test_metadata(self):
+        pkg = RpmPackage('foo.rpm', six.BytesIO(make_rpm('foo', files=['/usr/bin/foo', '/usr/lib/libfoo.so'])))
+        primary = YumPrimary()
+        primary.add_package(pkg.primary('abc', 100, pkg.pool_path, 1234))
+        data = primary.encode()
+        assert b'<checksum type="sha" pkgid="YES">abc</checksum>' in data
+        assert b'<location href="Packages/foo.rpm"/>' in data
+        assert b'<file>/usr/bin/foo</file>' in data and b'libfoo' not in data
+        assert YumPrimary.from_file(fileobj=six.BytesIO(data))[('foo', 'x86_64', '0:1.0-1')]['format']['header-range']
+        filelists = YumFileLists()
+        filelists.add_package(pkg.filelists('abc'))
+        assert b'<file>/usr/lib/libfoo.so</file>' in filelists.encode()
+
+
+class FakeGPG(object):
+    def sign(self, data, detach=False):
+        return 'signature of ' + hashlib.sha1(data).hexdigest()
+
+
+class TestYumRepository(object):
+    def repomd(self, memory_storage):
+        return YumRepoMD.from_file(fileobj=six.BytesIO(memory_storage.storage.objects['repodata/repomd.xml'].data))
+
+    def metadata(self, memory_storage, cls, repomd):
+        data = memory_storage.storage.objects[repomd[cls.__name__[3:].lower()]['location']].data
+        return cls.from_file(fileobj=six.BytesIO(data))
+
+    def test_commit(self, memory_storage):
+        repo = YumRepository(memory_storage)
+        assert repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        assert not repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.commit_metadata()
+        repomd = self.repomd(memory_storage)
+        assert list(repomd) == ['primary', 'primary_db', 'filelists', 'filelists_db', 'other', 'other_db']
+        data = memory_storage.storage.objects[repomd['primary']['location']].data
+        assert repomd['primary']['checksum'] == hashlib.sha1(data).hexdigest()
+        primary = self.metadata(memory_storage, YumPrimary, repomd)
+        pkgid = hashlib.sha1(make_rpm('foo')).hexdigest()
+        assert primary[('foo', 'x86_64', '0:1.0-1')]['checksum'] == pkgid
+        assert list(self.metadata(memory_storage, YumOther, repomd)) == [pkgid]
+
+    def test_incremental(self, memory_storage, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(time, 'time', lambda: now[0])
+        repo = YumRepository(memory_storage)
+        repo.METADATA_RETENTION = 60
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.commit_metadata()
+        old = self.repomd(memory_storage)
+        now[0] += 50
+        repo.add_package('bar-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('bar')))
+        # Replaces foo, with different contents
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo', files=['/usr/bin/foo'])), force=True)
+        repo.commit_metadata()
+        repomd = self.repomd(memory_storage)
+        assert repomd.revision > old.revision
+        primary = self.metadata(memory_storage, YumPrimary, repomd)
+        assert sorted(primary) == [('bar', 'x86_64', '0:1.0-1'), ('foo', 'x86_64', '0:1.0-1')]
+        pkgid = hashlib.sha1(make_rpm('foo', files=['/usr/bin/foo'])).hexdigest()
+        assert primary[('foo', 'x86_64', '0:1.0-1')]['checksum'] == pkgid
+        filelists = self.metadata(memory_storage, YumFileLists, repomd)
+        assert len(filelists) == 2 and filelists[pkgid].files == [(None, '/usr/bin/foo')]
+        # The previous metadata files are kept for anyone still reading the old repomd.xml
+        objects = memory_storage.storage.objects
+        for md_type in old:
+            assert old[md_type]['location'] in objects
+        # Superseded at 1050, so gone once that is more than 60 seconds ago
+        now[0] += 61
+        repo.commit_metadata()
+        for md_type in old:
+            assert old[md_type]['location'] not in objects
+        for data in self.repomd(memory_storage).values():
+            assert data['location'] in objects
+
+    def test_missing_metadata(self, memory_storage):
+        repo = YumRepository(memory_storage)
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.commit_metadata()
+        del memory_storage.storage.objects[self.repomd(memory_storage)['primary']['location']]
+        repo.add_package('bar-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('bar')))
+        with pytest.raises(ValueError):
+            repo.commit_metadata()
+        assert len(repo.dirty_packages) == 1
+
+    def test_signature(self, memory_storage):
+        repo = YumRepository(memory_storage, FakeGPG())
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.commit_metadata()
+        objects = memory_storage.storage.objects
+        assert objects['repodata/repomd.xml.asc'].data == FakeGPG().sign(objects['repodata/repomd.xml'].data)
+
+    def test_signature_conflict(self, memory_storage):
+        repo = YumRepository(memory_storage, FakeGPG())
+        repo.COMMIT_ATTEMPTS = 1
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        upload_if = memory_storage.upload_if
+
+        def racing_upload_if(path, data, etag):
+            if path == 'repodata/repomd.xml':
+                raise ConflictError('{0} has been modified'.format(path))
+            return upload_if(path, data, etag)
+        memory_storage.upload_if = racing_upload_if
+        with pytest.raises(ConflictError):
+            repo.commit_metadata()
+        assert 'repodata/repomd.xml.asc' not in memory_storage.storage.objects
+
+
+class TestYumDatabase(object):
+    def database(self, memory_storage, md_type, tmpdir):
+        repomd = YumRepoMD.from_file(fileobj=six.BytesIO(memory_storage.storage.objects['repodata/repomd.xml'].data))
+        data = memory_storage.storage.objects[repomd[md_type + '_db']['location']].data
+        path = str(tmpdir.join(md_type + '.sqlite'))
+        with open(path, 'wb') as f:
+            f.write(bz2.decompress(data))
+        conn = sqlite3.connect(path)
+        assert conn.execute('SELECT * FROM db_info').fetchall() == [(10, repomd[md_type]['checksum'])]
+        return conn
+
+    def test_commit(self, memory_storage, tmpdir):
+        repo = YumRepository(memory_storage)
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo', files=['/usr/bin/foo', '/usr/bin/bar', '/etc/foo'], tags={
+            rpm.REQUIRENAME: ['/bin/sh'],
+            rpm.REQUIREFLAGS: [rpm.SENSE_SCRIPT_PRE],
+            rpm.REQUIREVERSION: [''],
+            rpm.CHANGELOGTIME: [2, 1],
+            rpm.CHANGELOGNAME: ['b', 'a'],
+            rpm.CHANGELOGTEXT: ['second', 'first'],
+        })))
+        repo.commit_metadata()
+        pkgid = hashlib.sha1(memory_storage.storage.objects['Packages/foo-1.0-1.x86_64.rpm'].data).hexdigest()
+        primary = self.database(memory_storage, 'primary', tmpdir)
+        assert primary.execute('SELECT pkgId, name, arch, epoch, version, release, location_href FROM packages').fetchall() == [
+            (pkgid, 'foo', 'x86_64', '0', '1.0', '1', 'Packages/foo-1.0-1.x86_64.rpm')]
+        assert primary.execute('SELECT name, pre FROM requires').fetchall() == [('/bin/sh', 'TRUE')]
+        assert primary.execute('SELECT name, type FROM files ORDER BY name').fetchall() == [
+            ('/etc/foo', 'file'), ('/usr/bin/bar', 'file'), ('/usr/bin/foo', 'file')]
+        filelists = self.database(memory_storage, 'filelists', tmpdir)
+        assert filelists.execute('SELECT dirname, filenames, filetypes FROM filelist ORDER BY dirname').fetchall() == [
+            ('/etc', 'foo', 'f'), ('/usr/bin', 'foo/bar', 'ff')]
+        other = self.database(memory_storage, 'other', tmpdir)
+        assert other.execute('SELECT author, date, changelog FROM changelog').fetchall() == [('a', 1, 'first'), ('b', 2, 'second')]
+
+    def test_incremental(self, memory_storage, tmpdir):
+        repo = YumRepository(memory_storage)
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.add_package('bar-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('bar')))
+        repo.commit_metadata()
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo', files=['/usr/bin/foo'])), force=True)
+        repo.add_package('baz-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('baz')))
+        del memory_storage.storage.calls[:]
+        repo.commit_metadata()
+        # Updated from the published database rather than rebuilt
+        assert len([name for call, name in memory_storage.storage.calls if call == 'download' and name.endswith('.sqlite.bz2')]) == 3
+        primary = self.database(memory_storage, 'primary', tmpdir)
+        assert sorted(primary.execute('SELECT name FROM packages').fetchall()) == [('bar',), ('baz',), ('foo',)]
+        assert primary.execute('SELECT name FROM files').fetchall() == [('/usr/bin/foo',)]
+        filelists = self.database(memory_storage, 'filelists', tmpdir)
+        pkgid = hashlib.sha1(make_rpm('foo', files=['/usr/bin/foo'])).hexdigest()
+        assert filelists.execute('SELECT pkgId, dirname FROM packages JOIN filelist USING (pkgKey)').fetchall() == [(pkgid, '/usr/bin')]
+
+    def test_out_of_date(self, memory_storage, tmpdir):
+        repo = YumRepository(memory_storage)
+        repo.add_package('foo-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('foo')))
+        repo.commit_metadata()
+        # Something else rewrote primary.xml, leaving a primary_db missing foo
+        objects = memory_storage.storage.objects
+        conn = self.database(memory_storage, 'primary', tmpdir)
+        conn.execute("UPDATE db_info SET checksum = 'stale'")
+        conn.execute('DELETE FROM packages')
+        conn.commit()
+        conn.close()
+        repomd = YumRepoMD.from_file(fileobj=six.BytesIO(objects['repodata/repomd.xml'].data))
+        with open(str(tmpdir.join('primary.sqlite')), 'rb') as f:
+            objects[repomd['primary_db']['location']].data = bz2.compress(f.read())
+        repo.add_package('bar-1.0-1.x86_64.rpm', six.BytesIO(make_rpm('bar')))
+        repo.commit_metadata()
+        primary = self.database(memory_storage, 'primary', tmpdir)
+        assert sorted(primary.execute('SELECT name FROM packages').fetchall()) == [('bar',), ('foo',)]